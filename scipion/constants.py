@@ -9,6 +9,24 @@ COLUMN_NAME = "column_name"
 PROP_KEY = "key"
 PROP_VALUE = "value"
 
+# Properties table keys
+PROP_SELF = "self"
+PROP_STREAM_STATE = "_streamState"
+
+# Values of the property _streamState
+STREAM_OPEN = "1"
+STREAM_CLOSED = "2"
+
+# PROJECT ##############################################
+RUNS_DIR = "Runs"
+
+# Scipion set classes (value of the property self)
+SET_OF_TILT_SERIES = "SetOfTiltSeries"
+SET_OF_CTF_TOMO_SERIES = "SetOfCTFTomoSeries"
+SET_OF_TOMOGRAMS = "SetOfTomograms"
+SET_OF_COORDINATES_3D = "SetOfCoordinates3D"
+SET_OF_SUBTOMOGRAMS = "SetOfSubTomograms"
+
 # TILT-SERIES ##########################################
 # Field names
 TS_ID = "_tsId"
@@ -32,6 +50,7 @@ TILT_SERIES_FIELDS = [
 ]
 
 CTF_CORRECTED = "_ctfCorrected"
+SET_SIZE = "_size"  # Number of items of a set stored as a row, e.g. a tilt-series
 
 # CTF ###############################################
 DEFOCUS_U = "_defocusU"
@@ -1,29 +1,70 @@
 import os
+from contextlib import aclosing
 from pathlib import Path
-from typing import Dict, List, Any, Tuple
+from typing import Dict, List, Any, AsyncGenerator, Iterator, Tuple
+
+import numpy as np
 
 from cets_data_model.models.models import Affine, Translation
 from scipion.utils.utils import validate_file
+from scipion.utils.utils_async import AsyncRequest, DEFAULT_PREFETCH, get_request
+from scipion.utils.utils_models import check_batch, build_models
+from scipion.utils.utils_project import get_project_path
 
 
 class BaseConverter:
-    def __init__(self, sqlite_path: os.PathLike):
+    def __init__(self, sqlite_path: os.PathLike | str):
         self.db_path = validate_file(sqlite_path, ".sqlite")
         self.scipion_prj_path = self._get_prj_path()
 
     def scipion_to_cets(self, *args: Any, **kwargs: Any) -> Any:
         raise NotImplementedError
 
+    def iter_cets(self, *args: Any, **kwargs: Any) -> Iterator[Any]:
+        """Streaming counterpart of scipion_to_cets, which yields the converted
+        objects one at a time."""
+        raise NotImplementedError
+
+    async def ascipion_to_cets(
+        self, *args: Any, request: AsyncRequest | None = None, **kwargs: Any
+    ) -> Any:
+        """Async counterpart of scipion_to_cets, with the same arguments. It runs
+        in a thread of request, so the event loop is not blocked by the sqlite
+        reads, MRC header reads and YAML writes. If cancelled, the conversion
+        finishes in the background. See AsyncRequest.
+
+        :param request: request in which the conversion runs. If None, a new one
+        on the default pool.
+        """
+        return await get_request(request).run(self.scipion_to_cets, *args, **kwargs)
+
+    async def aiter_cets(
+        self,
+        *args: Any,
+        request: AsyncRequest | None = None,
+        prefetch: int = DEFAULT_PREFETCH,
+        **kwargs: Any,
+    ) -> AsyncGenerator[Any, None]:
+        """Async counterpart of iter_cets, with the same arguments. Each object is
+        converted in a thread of request, and up to prefetch objects are kept
+        ready, so their conversion overlaps with the processing of the consumer
+        (e.g. awrite_objs_yaml). Breaking the loop, closing the iterator or
+        cancelling the consumer stops the conversion after the object in
+        progress.
+
+        :param request: request in which the objects are converted. If None, a
+        new one on the default pool.
+        :param prefetch: max number of objects kept ready for the consumer.
+        """
+        request = get_request(request)
+        objs = await request.run(self.iter_cets, *args, **kwargs)
+        async with aclosing(request.iterate(objs, prefetch=prefetch)) as async_objs:
+            async for obj in async_objs:
+                yield obj
+
     def _get_prj_path(self) -> Path:
-        orig_dir = os.getcwd()
-        # Move to the project directory and get the full path
-        os.chdir(
-            self.db_path.parent / ".." / ".."
-        )  # PathToScipionUserData/projects/ProjectName/Runs/ProtocolDir/extra/sqlite
-        prj_path = os.getcwd()
-        # Move to the original working dir
-        os.chdir(orig_dir)
-        return Path(prj_path)
+        # PathToScipionUserData/projects/ProjectName/Runs/ProtocolDir/extra/sqlite
+        return get_project_path(self.db_path)
 
     @staticmethod
     def _get_sql_fields(mapped_class_dict: Dict[str, str], fields: List[str]) -> str:
@@ -39,26 +80,46 @@ class BaseConverter:
         ]
         return ", ".join(present_fields)
 
-    @staticmethod
+    @classmethod
     def _gen_subvolume_transforms(
-        euler_matrix: List[List[float]], is_coordinate: bool = True
+        cls, euler_matrix: List[List[float]] | np.ndarray, is_coordinate: bool = True
     ) -> Tuple[Translation, Affine]:
+        return cls._gen_subvolume_transforms_batch(
+            np.asarray(euler_matrix, dtype=np.float64)[np.newaxis],
+            is_coordinate=is_coordinate,
+        )[0]
+
+    @staticmethod
+    def _gen_subvolume_transforms_batch(
+        euler_matrices: np.ndarray, is_coordinate: bool = True
+    ) -> List[Tuple[Translation, Affine]]:
+        """Generates the translation and orientation of a batch of subvolumes.
+        :param euler_matrices: array of shape (N, 4, 4) containing the Scipion
+        transformation matrices, e.g. as returned by parse_matrices.
+        :param is_coordinate: if True, the translations are set to zero, as the
+        matrices of the coordinates contain only the orientation. The same zero
+        translation is then shared by all the subvolumes of the batch.
+        """
+        euler_matrices = check_batch(euler_matrices, (4, 4), "euler matrices")
         if is_coordinate:
             name = "Coordinate 3D"
-            translation_vector = [0.0, 0.0, 0.0]
+            zero_translation = Translation(
+                name="Particle Translation, in pixels", translation=[0.0] * 3
+            )
+            translations = [zero_translation] * len(euler_matrices)
         else:
             name = "Subtomogram"
-            translation_vector = [
-                euler_matrix[0][-1],
-                euler_matrix[1][-1],
-                euler_matrix[2][-1],
-            ]
-        angular_matrix = [
-            sublist[:3] for sublist in euler_matrix[:3]
-        ]  # Take only the angular 3x3 sub-matrix
-        return (
-            Translation(
-                name="Particle Translation, in pixels", translation=translation_vector
-            ),
-            Affine(name=f"{name} orientation", affine=angular_matrix),
+            translations = build_models(
+                Translation,
+                "translation",
+                euler_matrices[:, :3, -1].tolist(),
+                name="Particle Translation, in pixels",
+            )
+        # Take only the angular 3x3 sub-matrices
+        rotations = build_models(
+            Affine,
+            "affine",
+            euler_matrices[:, :3, :3].tolist(),
+            name=f"{name} orientation",
         )
+        return list(zip(translations, rotations))
@@ -0,0 +1,505 @@
+import sqlite3
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+from typing import Any, Dict, Generator, List, Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+
+from cets_data_model.models.models import (
+    Particle3DSet,
+    Particle3D,
+)
+from scipion.constants import OBJECTS_TBL
+from scipion.converters.base_converter import BaseConverter
+from scipion.converters.particle_table import (
+    coordinates_system,
+    ParticleTable,
+    ParticleTableBuilder,
+)
+from scipion.utils.utils import ParticleSetYamlWriter, get_coords_yaml_file
+from scipion.utils.utils_filters import (
+    ConversionFilter,
+    get_id_condition,
+    get_where_clause,
+    join_conditions,
+)
+from scipion.utils.utils_incremental import Signature
+from scipion.utils.utils_instrumentation import Stage, MODEL_BUILD
+from scipion.utils.utils_matrix import parse_matrices
+from scipion.utils.utils_mrc import get_mrc_infos_cached
+from scipion.utils.utils_sqlite import (
+    connect_db,
+    map_classes_table,
+    execute_query,
+    fetch_all,
+    fetch_in_chunks,
+    get_tuple_cursor,
+    RowExtractor,
+    FETCH_CHUNK_SIZE,
+)
+
+# Memory held per particle while it is converted and written in chunks: the row,
+# the Particle3D, its dumped dict and its YAML text. Measured with tracemalloc as
+# the growth of the peak memory of write_cets_yaml_chunked per particle added to
+# the chunk: about 13 KiB for coordinates and 27 KiB for subtomograms, whose
+# particles also have a subtomogram file and transform. Rounded up from the
+# largest, so a memory budget is not exceeded (see test_particle_memory)
+PARTICLE_MEMORY_BYTES = 32 * 1024
+
+
+def _tomo_id_sort_key(tomo_id: str | None) -> Tuple[bool, str]:
+    """Sort key of a tomogram identifier matching the ascending order of the
+    database, in which the empty (NULL) identifiers come first."""
+    return tomo_id is not None, tomo_id or ""
+
+
+class BaseParticlesConverter(BaseConverter):
+    """Base class of the converters of Scipion sets of particles (coordinates 3D
+    and subtomograms). In Scipion, the particles from all the tomograms are stored
+    together in the same table, tagged with the identifier of their tomogram."""
+
+    # Labelled names of the fields read from each particle and of the one
+    # containing the tomogram identifier. To be defined by the subclasses.
+    particle_fields: List[str] = []
+    tomo_id_field: str = ""
+    # Labelled names of the fields stored in the columnar particle table
+    position_fields: List[str] = []
+    coord_matrix_field: str = ""
+    subtomo_matrix_field: Optional[str] = None
+    file_field: Optional[str] = None
+
+    def scipion_to_cets_by_tomo(
+        self,
+        tomo_ids: Iterable[str] | None = None,
+        filters: ConversionFilter | None = None,
+    ) -> Dict[str, Particle3DSet] | None:
+        """Converts the whole set of particles into CETS metadata reading the
+        sqlite only once, grouping the particles by tomogram.
+
+        :param tomo_ids: Scipion tomogram identifiers of the tomograms whose
+        particles will be returned. If provided, the resulting dictionary will
+        contain exactly these keys and in the same order. If not, all the
+        tomograms present in the set will be returned.
+        :type tomo_ids: Iterable[str] or None, optional. Defaults to None.
+
+        :param filters: selection of the tomograms (ids, patterns, min number of
+        particles) and max number of particles per tomogram, pushed into the query.
+        :type filters: ConversionFilter or None, optional. Defaults to None.
+        """
+        if tomo_ids is not None:
+            tomo_ids = list(tomo_ids)
+        db_connection = connect_db(self.db_path)
+        if db_connection is not None:
+            with db_connection as conn:
+                particles_dict = self._read_particles(
+                    conn, tomo_ids=tomo_ids, filters=filters
+                )
+            if tomo_ids is None:
+                return {
+                    tomo_id: self._gen_particle_set(particle_list)
+                    for tomo_id, particle_list in particles_dict.items()
+                }
+            particle_sets = {}
+            for tomo_id in tomo_ids:
+                particle_list = particles_dict.get(tomo_id, [])
+                self._check_particles_found(particle_list, tomo_id)
+                particle_sets[tomo_id] = self._gen_particle_set(particle_list)
+            return particle_sets
+        return None
+
+    def get_tomo_signatures(self) -> Dict[str, Signature]:
+        """Returns, for each tomogram with particles, the number of particles and
+        the max row id, computed in a single aggregated query. They change
+        whenever particles are added to (or removed from) the tomogram."""
+        conn = connect_db(self.db_path)
+        if conn is None:
+            return {}
+        class_dict = map_classes_table(conn)
+        tomo_id_col_name = class_dict[self.tomo_id_field]
+        rows = fetch_all(
+            conn.cursor(),
+            f'SELECT "{tomo_id_col_name}", COUNT(*), MAX(id) FROM "{OBJECTS_TBL}" '
+            f'GROUP BY "{tomo_id_col_name}"',
+        )
+        return {tomo_id: [n_particles, max_id] for tomo_id, n_particles, max_id in rows}
+
+    def iter_cets(
+        self, filters: ConversionFilter | None = None
+    ) -> Generator[Tuple[str, Particle3DSet], None, None]:
+        """Converts the whole set of particles into CETS metadata, yielding the
+        tomogram identifier and the Particle3DSet of one tomogram at a time, so
+        only the particles of one tomogram are kept in memory. The rows are
+        read sorted by tomogram identifier, so the tomograms are yielded in that
+        order. The result can be written directly with write_particle_sets_yaml.
+
+        :param filters: selection of the particles. See scipion_to_cets_by_tomo.
+        :type filters: ConversionFilter or None, optional. Defaults to None.
+        """
+        db_connection = connect_db(self.db_path)
+        if db_connection is None:
+            return
+        with db_connection as conn:
+            class_dict = map_classes_table(conn)
+            extractor = RowExtractor(class_dict, self.particle_fields)
+            query, params = self._get_particles_query(
+                class_dict, extractor.sql_fields, filters=filters, sort_by_tomo=True
+            )
+            cursor = get_tuple_cursor(conn)
+            execute_query(cursor, query, params)
+            # Never yielded before the first row, whose tomogram starts a set
+            current_tomo_id = ""
+            particle_list: List[Particle3D] = []
+            for rows in fetch_in_chunks(cursor):
+                particles = self._build_particles(rows, extractor)
+                row_tomo_ids = extractor.column(rows, self.tomo_id_field)
+                for row_tomo_id, particle in zip(row_tomo_ids, particles):
+                    if row_tomo_id != current_tomo_id:
+                        if particle_list:
+                            yield current_tomo_id, self._gen_particle_set(particle_list)
+                        current_tomo_id = row_tomo_id
+                        particle_list = []
+                    particle_list.append(particle)
+            if particle_list:
+                yield current_tomo_id, self._gen_particle_set(particle_list)
+
+    def iter_cets_by_tomo(
+        self, tomo_ids: Iterable[str], filters: ConversionFilter | None = None
+    ) -> Iterator[Tuple[str, Particle3DSet]]:
+        """Streaming counterpart of scipion_to_cets_by_tomo: yields the tomogram
+        identifier and the Particle3DSet of each introduced tomogram, merging
+        them with the particles streamed by iter_cets.
+
+        :param tomo_ids: Scipion tomogram identifiers, sorted in ascending order
+        as the database sorts them, i.e. with the empty (NULL) ones first. The
+        particles without tomogram identifier do not belong to any tomogram.
+        :type tomo_ids: Iterable[str].
+
+        :param filters: selection of the particles. See scipion_to_cets_by_tomo.
+        :type filters: ConversionFilter or None, optional. Defaults to None.
+        """
+        particle_sets = self.iter_cets(filters=filters)
+        try:
+            next_set = next(particle_sets, None)
+            prev_tomo_id: str | None = None
+            for i, tomo_id in enumerate(tomo_ids):
+                key = _tomo_id_sort_key(tomo_id)
+                if i and key < _tomo_id_sort_key(prev_tomo_id):
+                    raise ValueError(
+                        "The tomogram identifiers must be sorted in ascending "
+                        f"order: {tomo_id} found after {prev_tomo_id}"
+                    )
+                prev_tomo_id = tomo_id
+                # Skip the particles of tomograms not requested
+                while next_set is not None and _tomo_id_sort_key(next_set[0]) < key:
+                    next_set = next(particle_sets, None)
+                if (
+                    tomo_id is not None
+                    and next_set is not None
+                    and next_set[0] == tomo_id
+                ):
+                    yield next_set
+                    next_set = next(particle_sets, None)
+                else:
+                    self._check_particles_found([], tomo_id)
+                    yield tomo_id, self._gen_particle_set([])
+        finally:
+            particle_sets.close()
+
+    def write_cets_yaml_chunked(
+        self,
+        out_directory: Path | str,
+        tomo_ids: Iterable[str] | None = None,
+        filters: ConversionFilter | None = None,
+        chunk_rows: int = FETCH_CHUNK_SIZE,
+        memory_budget_mb: float | None = None,
+        compact_yaml: bool = False,
+    ) -> List[Path]:
+        """Converts the set of particles into one .yaml file per tomogram, as
+        write_particle_sets_yaml does with the result of scipion_to_cets_by_tomo,
+        but converting and writing chunk_rows particles at a time. The files are
+        identical to the ones of the one-shot conversion, while the memory used
+        does not depend on the number of particles of the set or of a tomogram.
+
+        :param out_directory: directory in which the files are written. It is
+        created if it does not exist.
+        :type out_directory: pathlib.Path or str.
+
+        :param tomo_ids: Scipion tomogram identifiers of the tomograms whose
+        particles will be written. If provided, a file is written for each of
+        them, even if it has no particles. If not, one per tomogram in the set.
+        :type tomo_ids: Iterable[str] or None, optional. Defaults to None.
+
+        :param filters: selection of the particles. See scipion_to_cets_by_tomo.
+        :type filters: ConversionFilter or None, optional. Defaults to None.
+
+        :param chunk_rows: max number of particles converted at once.
+        :type chunk_rows: int, optional. Defaults to FETCH_CHUNK_SIZE.
+
+        :param memory_budget_mb: approximate max memory, in MiB, used by the
+        particles converted at once. If provided, chunk_rows is reduced to fit it.
+        :type memory_budget_mb: float or None, optional. Defaults to None.
+
+        :param compact_yaml: if True, the files are written in compact YAML, with
+        the repeated blocks of each chunk written once and referenced. See
+        ParticleSetYamlWriter.
+        :type compact_yaml: bool, optional. Defaults to False.
+
+        :return: the files written, sorted by tomogram identifier.
+        """
+        chunk_rows = self._get_chunk_rows(chunk_rows, memory_budget_mb)
+        if tomo_ids is not None:
+            tomo_ids = list(tomo_ids)
+        out_directory = Path(out_directory)
+        db_connection = connect_db(self.db_path)
+        if db_connection is None:
+            return []
+        out_directory.mkdir(parents=True, exist_ok=True)
+        written: Dict[str, Path] = {}
+        with db_connection as conn:
+            class_dict = map_classes_table(conn)
+            extractor = RowExtractor(class_dict, self.particle_fields)
+            query, params = self._get_particles_query(
+                class_dict, extractor.sql_fields, tomo_ids, filters, sort_by_tomo=True
+            )
+            cursor = get_tuple_cursor(conn)
+            execute_query(cursor, query, params)
+            current_tomo_id = ""
+            writer: ParticleSetYamlWriter | None = None
+            try:
+                for rows in fetch_in_chunks(cursor, chunk_rows):
+                    particles = self._build_particles(rows, extractor)
+                    row_tomo_ids = extractor.column(rows, self.tomo_id_field)
+                    # The rows are sorted by tomogram, so a chunk may contain
+                    # the end of a tomogram and the beginning of the next ones
+                    for row_tomo_id, group in groupby(
+                        zip(row_tomo_ids, particles), key=itemgetter(0)
+                    ):
+                        if writer is None or row_tomo_id != current_tomo_id:
+                            if writer is not None:
+                                writer.close()
+                                written[current_tomo_id] = writer.yaml_file
+                            current_tomo_id = row_tomo_id
+                            writer = ParticleSetYamlWriter(
+                                get_coords_yaml_file(row_tomo_id, out_directory),
+                                self._gen_particle_set([]),
+                                compact=compact_yaml,
+                            )
+                        writer.write([particle for _, particle in group])
+                if writer is not None:
+                    writer.close()
+                    written[current_tomo_id] = writer.yaml_file
+            except BaseException:
+                if writer is not None:
+                    writer.discard()
+                raise
+        # Tomograms requested without any particle selected
+        for tomo_id in tomo_ids or []:
+            if tomo_id not in written:
+                self._check_particles_found([], tomo_id)
+                with ParticleSetYamlWriter(
+                    get_coords_yaml_file(tomo_id, out_directory),
+                    self._gen_particle_set([]),
+                    compact=compact_yaml,
+                ) as writer:
+                    pass
+                written[tomo_id] = writer.yaml_file
+        return [written[tomo_id] for tomo_id in sorted(written)]
+
+    @staticmethod
+    def _get_chunk_rows(chunk_rows: int, memory_budget_mb: float | None) -> int:
+        if chunk_rows < 1:
+            raise ValueError(f"The chunk size must be greater than 0: {chunk_rows}")
+        if memory_budget_mb is None:
+            return chunk_rows
+        budget_rows = int(memory_budget_mb * 2**20 // PARTICLE_MEMORY_BYTES)
+        return max(1, min(chunk_rows, budget_rows))
+
+    def scipion_to_table(
+        self,
+        tomo_ids: Iterable[str] | None = None,
+        filters: ConversionFilter | None = None,
+    ) -> ParticleTable | None:
+        """Converts the whole set of particles into a columnar ParticleTable, which
+        stores the positions, rotations, shifts, file indices and tomogram
+        identifiers as contiguous NumPy arrays instead of one pydantic object per
+        particle. Use ParticleTable.to_particle3d_set to get CETS metadata for
+        a subset.
+
+        :param tomo_ids: Scipion tomogram identifiers of the tomograms whose
+        particles will be read. If not provided, all the particles are read.
+        :type tomo_ids: Iterable[str] or None, optional. Defaults to None.
+
+        :param filters: selection of the particles. See scipion_to_cets_by_tomo.
+        :type filters: ConversionFilter or None, optional. Defaults to None.
+        """
+        db_connection = connect_db(self.db_path)
+        if db_connection is not None:
+            with db_connection as conn:
+                class_dict = map_classes_table(conn)
+                extractor = RowExtractor(class_dict, self.particle_fields)
+                query, params = self._get_particles_query(
+                    class_dict, extractor.sql_fields, tomo_ids, filters
+                )
+                cursor = get_tuple_cursor(conn)
+                execute_query(cursor, query, params)
+                builder = ParticleTableBuilder(
+                    is_subtomogram=self.subtomo_matrix_field is not None
+                )
+                for rows in fetch_in_chunks(cursor):
+                    self._append_to_table(builder, rows, extractor)
+                return builder.build()
+        return None
+
+    def _append_to_table(
+        self,
+        builder: ParticleTableBuilder,
+        rows: List[Tuple[Any, ...]],
+        extractor: RowExtractor,
+    ) -> None:
+        get_position = extractor.getter(*self.position_fields)
+        positions = np.array(
+            [get_position(row) for row in rows], dtype=np.float64
+        ).reshape(-1, 3)
+        coord_matrices = parse_matrices(
+            extractor.column(rows, self.coord_matrix_field),
+            shape=(4, 4),
+            column=self.coord_matrix_field,
+        )
+        subtomo_matrices = None
+        if self.subtomo_matrix_field is not None:
+            subtomo_matrices = parse_matrices(
+                extractor.column(rows, self.subtomo_matrix_field),
+                shape=(4, 4),
+                column=self.subtomo_matrix_field,
+            )
+        file_names = None
+        if self.file_field is not None:
+            file_names = [
+                str(
+                    self.scipion_prj_path / file_name
+                    if file_name
+                    else self.scipion_prj_path
+                )
+                for file_name in extractor.column(rows, self.file_field)
+            ]
+            # The headers of the new files of the batch are read concurrently and
+            # added in order of appearance
+            new_file_names = [
+                file_name
+                for file_name in dict.fromkeys(file_names)
+                if not builder.has_file(file_name)
+            ]
+            for file_name, img_info in zip(
+                new_file_names, get_mrc_infos_cached(new_file_names)
+            ):
+                builder.add_file(
+                    file_name, (img_info.size_x, img_info.size_y, img_info.size_z)
+                )
+        builder.append(
+            extractor.column(rows, self.tomo_id_field),
+            positions,
+            coord_matrices,
+            subtomo_matrices=subtomo_matrices,
+            file_names=file_names,
+        )
+
+    def _get_particles_query(
+        self,
+        class_dict: Dict[str, str],
+        sql_fields: str,
+        tomo_ids: Iterable[str] | None = None,
+        filters: ConversionFilter | None = None,
+        sort_by_tomo: bool = False,
+    ) -> Tuple[str, tuple]:
+        """Returns the query to read the particles and its parameters.
+
+        :param tomo_ids: if provided, only the particles of these tomograms are read.
+        :param filters: selection of the particles, see scipion_to_cets_by_tomo.
+        :param sort_by_tomo: if True, the particles are sorted by tomogram.
+        """
+        tomo_id_col_name = class_dict[self.tomo_id_field]
+        conditions = [get_id_condition(tomo_id_col_name, tomo_ids, filters)]
+        if filters is not None and (filters.min_particles or 0) > 0:
+            conditions.append(
+                (
+                    f'"{tomo_id_col_name}" IN (SELECT "{tomo_id_col_name}" '
+                    f'FROM "{OBJECTS_TBL}" GROUP BY "{tomo_id_col_name}" '
+                    f"HAVING COUNT(*) >= ?)",
+                    [filters.min_particles],
+                )
+            )
+        where, params = get_where_clause(join_conditions(conditions))
+        if filters is not None and filters.max_particles is not None:
+            # Rank of each particle within its tomogram, in order of the set
+            query = (
+                f"SELECT {sql_fields} FROM (SELECT *, ROW_NUMBER() OVER "
+                f'(PARTITION BY "{tomo_id_col_name}" ORDER BY id) AS particle_rank '
+                f'FROM "{OBJECTS_TBL}"{where}) WHERE particle_rank <= ?'
+            )
+            params.append(filters.max_particles)
+            order_by = [f'"{tomo_id_col_name}"', "id"] if sort_by_tomo else ["id"]
+        else:
+            query = f'SELECT {sql_fields} FROM "{OBJECTS_TBL}"{where}'
+            order_by = [f'"{tomo_id_col_name}"', "id"] if sort_by_tomo else []
+        if order_by:
+            query += f" ORDER BY {', '.join(order_by)}"
+        return query, tuple(params)
+
+    def _read_particles(
+        self,
+        conn: sqlite3.Connection,
+        tomo_ids: Iterable[str] | None = None,
+        filters: ConversionFilter | None = None,
+    ) -> Dict[str, List[Particle3D]]:
+        """Reads the particles from the table Objects in one pass and groups them
+        by tomogram identifier.
+
+        :param conn: connection to the particles sqlite file.
+        :param tomo_ids: if provided, only the particles of these tomograms are read.
+        :param filters: selection of the particles, see scipion_to_cets_by_tomo.
+        """
+        # Map the table Classes and get the sqlite fields to be read
+        class_dict = map_classes_table(conn)
+        extractor = RowExtractor(class_dict, self.particle_fields)
+
+        query, params = self._get_particles_query(
+            class_dict, extractor.sql_fields, tomo_ids, filters
+        )
+        cursor = get_tuple_cursor(conn)
+        execute_query(cursor, query, params)
+        particles_dict: Dict[str, List[Particle3D]] = {}
+        # The rows are converted in batches, so the matrices are parsed at once
+        for rows in fetch_in_chunks(cursor):
+            particles = self._build_particles(rows, extractor)
+            row_tomo_ids = extractor.column(rows, self.tomo_id_field)
+            for row_tomo_id, particle in zip(row_tomo_ids, particles):
+                particles_dict.setdefault(row_tomo_id, []).append(particle)
+        return particles_dict
+
+    def _build_particles(
+        self, rows: List[Tuple[Any, ...]], extractor: RowExtractor
+    ) -> List[Particle3D]:
+        with Stage(MODEL_BUILD, items=len(rows)):
+            return self._particles_from_sqlite_rows(rows, extractor)
+
+    def _particles_from_sqlite_rows(
+        self, rows: List[Tuple[Any, ...]], extractor: RowExtractor
+    ) -> List[Particle3D]:
+        """Converts a batch of rows, read as plain tuples with the fields of
+        particle_fields, into particles. To be defined by the subclasses."""
+        raise NotImplementedError
+
+    def _check_particles_found(
+        self, particle_list: List[Particle3D], tomo_id: str
+    ) -> None:
+        """Hook to validate the particles read for a tomogram. Nothing is checked
+        by default."""
+        pass
+
+    @staticmethod
+    def _gen_particle_set(particle_list: List[Particle3D]) -> Particle3DSet:
+        return Particle3DSet(
+            particles=particle_list,
+            coordinate_systems=coordinates_system,
+        )
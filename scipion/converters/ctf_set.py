@@ -1,5 +1,8 @@
+import logging
 import sqlite3
-from typing import List, Dict
+from typing import Any, List, Dict, Iterable, Iterator, Tuple
+
+import numpy as np
 
 from cets_data_model.models.models import CTFMetadata
 from scipion.constants import (
@@ -7,86 +10,214 @@ from scipion.constants import (
     CTF_TOMO_SERIES_FIELDS,
     CLASSES_TBL,
     OBJECTS_TBL,
-    DEFOCUS_U,
-    DEFOCUS_V,
-    DEFOCUS_ANGLE,
-    ACQUISITION_ORDER,
-    PHASE_SHIFT,
 )
 from scipion.converters.base_converter import BaseConverter
+from scipion.converters.ctf_table import CTFSeries
+from scipion.utils.utils_filters import (
+    ConversionFilter,
+    get_id_condition,
+    get_where_clause,
+)
 from scipion.utils.utils_sqlite import (
     connect_db,
     map_classes_table,
-    get_from_obj_tbl,
-    get_row_value,
+    get_tuple_cursor,
+    fetch_all,
 )
 
 
+logger = logging.getLogger(__name__)
+
+# Max number of CTFTomoSeries tables read by a single query (SQLite limits the
+# number of terms of a compound SELECT to 500 by default)
+MAX_TABLES_PER_QUERY = 500
+
+
 class ScipionSetOfCtf(BaseConverter):
     def scipion_to_cets(
         self,
+        ts_ids: Iterable[str] | None = None,
+        filters: ConversionFilter | None = None,
     ) -> Dict[str, List[CTFMetadata]] | None:
-        """Converts a set of CTF from Scipion into CETS metadata."""
+        """Converts a set of CTF from Scipion into CETS metadata.
+
+        :param ts_ids: identifiers of the tilt-series whose CTF will be converted.
+        If not provided, all the CTFTomoSeries of the set are converted.
+        :type ts_ids: Iterable[str] or None, optional, Defaults to None
+
+        :param filters: selection of the tilt-series (ids, patterns) whose CTF
+        will be read, pushed into the query.
+        :type filters: ConversionFilter or None, optional, Defaults to None
+        """
+        return dict(self.iter_cets(ts_ids=ts_ids, filters=filters))
+
+    def iter_cets(
+        self,
+        ts_ids: Iterable[str] | None = None,
+        filters: ConversionFilter | None = None,
+    ) -> Iterator[Tuple[str, List[CTFMetadata]]]:
+        """Converts a set of CTF from Scipion into CETS metadata, yielding the
+        tilt-series identifier and the CTFMetadata list of one CTFTomoSeries at
+        a time.
+
+        :param ts_ids: identifiers of the tilt-series whose CTF will be converted.
+        The tables of the CTFTomoSeries not selected are not read.
+        :type ts_ids: Iterable[str] or None, optional, Defaults to None
+
+        :param filters: selection of the tilt-series (ids, patterns) whose CTF
+        will be read, pushed into the query.
+        :type filters: ConversionFilter or None, optional, Defaults to None
+        """
+        for ts_id, ctf_series in self.iter_ctf_series(ts_ids=ts_ids, filters=filters):
+            yield ts_id, ctf_series.to_list()
+
+    def scipion_to_ctf_series(
+        self,
+        ts_ids: Iterable[str] | None = None,
+        filters: ConversionFilter | None = None,
+    ) -> Dict[str, CTFSeries]:
+        """Reads a set of CTF from Scipion into NumPy arrays, one CTFSeries per
+        tilt-series. The CTFMetadata are only created when accessed, so it is
+        much faster than scipion_to_cets for large sets, and the result can be
+        passed as the ctf_md of ScipionSetOfTiltSeries.scipion_to_cets.
+
+        :param ts_ids: identifiers of the tilt-series whose CTF will be read.
+        If not provided, all the CTFTomoSeries of the set are read.
+        :type ts_ids: Iterable[str] or None, optional, Defaults to None
+
+        :param filters: selection of the tilt-series (ids, patterns) whose CTF
+        will be read, pushed into the query.
+        :type filters: ConversionFilter or None, optional, Defaults to None
+        """
+        return dict(self.iter_ctf_series(ts_ids=ts_ids, filters=filters))
+
+    def iter_ctf_series(
+        self,
+        ts_ids: Iterable[str] | None = None,
+        filters: ConversionFilter | None = None,
+    ) -> Iterator[Tuple[str, CTFSeries]]:
+        """Yields the tilt-series identifier and the CTFSeries of each
+        CTFTomoSeries. The tables of the CTFTomoSeries are read together, with
+        a single UNION ALL query per MAX_TABLES_PER_QUERY tables.
+
+        :param ts_ids: identifiers of the tilt-series whose CTF will be read.
+        The tables of the CTFTomoSeries not selected are not read.
+        :type ts_ids: Iterable[str] or None, optional, Defaults to None
+
+        :param filters: selection of the tilt-series (ids, patterns) whose CTF
+        will be read, pushed into the query.
+        :type filters: ConversionFilter or None, optional, Defaults to None
+        """
         db_connection = connect_db(self.db_path)
-        if db_connection is not None:
-            with db_connection as conn:
-                # Map the table Classes and get some values from the table Objects
-                ctf_set_class_dict = map_classes_table(conn)
-                ts_ids = get_from_obj_tbl(conn, TS_ID, ctf_set_class_dict)
-
-                # Map the table Classes of the first CTFTomoSeries
-                ctf_tomo_class_dict = map_classes_table(
-                    conn, self._get_ctf_classes_tbl_name(1)
-                )
-
-                # Sqlite fields of the data to be read from each CTFTomoSeries
-                ctf_sql_fields = self._get_sql_fields(
-                    ctf_tomo_class_dict, CTF_TOMO_SERIES_FIELDS
-                )
-
-                cursor = conn.cursor()
-                ctf_tomo_dict = {}
-                for i, ts_id in enumerate(ts_ids):
-                    print(f"tsId = {ts_id}. Loading the CTF series...")
-                    # Read the CTF table
-                    ctf_list = []
-                    ctf_list_table_name = self._get_ctf_obj_tbl_name(i + 1)
-                    query = f'SELECT {ctf_sql_fields} FROM "{ctf_list_table_name}"'
-                    cursor.execute(query)  # execute the query
-                    for row in cursor.fetchall():
-                        ctf = self._ctf_from_sqlite_row(row, ctf_tomo_class_dict)
-                        ctf_list.append(ctf)
-                    ctf_tomo_dict[ts_id] = ctf_list
-                return ctf_tomo_dict
-        return None
+        if db_connection is None:
+            return
+        with db_connection as conn:
+            # Get the CTFTomoSeries from the table Objects
+            ctf_series_rows = self._read_ctf_series_rows(conn, ts_ids, filters)
+            if not ctf_series_rows:
+                return
+            cursor = get_tuple_cursor(conn)
+
+            # Map the table Classes of the first CTFTomoSeries
+            ctf_tomo_class_dict = map_classes_table(
+                conn, self._get_ctf_classes_tbl_name(ctf_series_rows[0][0])
+            )
+            # Sqlite fields of the data to be read from each CTFTomoSeries, in the
+            # order of CTF_COLUMNS. The missing ones are read as NULL
+            ctf_sql_fields = ", ".join(
+                f'"{ctf_tomo_class_dict[field]}"'
+                if ctf_tomo_class_dict.get(field, None)
+                else "NULL"
+                for field in CTF_TOMO_SERIES_FIELDS
+            )
+            for start in range(0, len(ctf_series_rows), MAX_TABLES_PER_QUERY):
+                rows_chunk = ctf_series_rows[start : start + MAX_TABLES_PER_QUERY]
+                yield from self._read_ctf_tables(cursor, rows_chunk, ctf_sql_fields)
+
+    def get_signatures(
+        self,
+        ts_ids: Iterable[str] | None = None,
+        filters: ConversionFilter | None = None,
+    ) -> Dict[str, List[Any]]:
+        """Returns the number of CTF values and the max id of the table of each
+        CTFTomoSeries, with a COUNT query per MAX_TABLES_PER_QUERY tables, so the
+        changes of the set can be detected without reading the CTF values.
+
+        :param ts_ids: identifiers of the tilt-series. If not provided, all the
+        CTFTomoSeries of the set are considered.
+        :param filters: selection of the tilt-series (ids, patterns).
+        """
+        db_connection = connect_db(self.db_path)
+        if db_connection is None:
+            return {}
+        ctf_series_rows = self._read_ctf_series_rows(db_connection, ts_ids, filters)
+        cursor = get_tuple_cursor(db_connection)
+        signatures = {}
+        for start in range(0, len(ctf_series_rows), MAX_TABLES_PER_QUERY):
+            rows_chunk = ctf_series_rows[start : start + MAX_TABLES_PER_QUERY]
+            query = " UNION ALL ".join(
+                f'SELECT {tag}, COUNT(*), MAX(id) FROM "{self._get_ctf_obj_tbl_name(obj_id)}"'
+                for tag, (obj_id, _) in enumerate(rows_chunk)
+            )
+            for tag, n_ctf, max_id in fetch_all(cursor, query):
+                signatures[rows_chunk[tag][1]] = [n_ctf, max_id]
+        return signatures
+
+    @staticmethod
+    def _read_ctf_series_rows(
+        conn: sqlite3.Connection,
+        ts_ids: Iterable[str] | None = None,
+        filters: ConversionFilter | None = None,
+    ) -> List[Tuple[int, str]]:
+        """Row id and tilt-series identifier of the selected CTFTomoSeries of the
+        table Objects. The tables of each one are named after its row id."""
+        ts_id_col_name = map_classes_table(conn)[TS_ID]
+        where, params = get_where_clause(
+            get_id_condition(ts_id_col_name, ts_ids, filters)
+        )
+        return fetch_all(
+            get_tuple_cursor(conn),
+            f'SELECT id, "{ts_id_col_name}" FROM "{OBJECTS_TBL}"{where} ORDER BY id',
+            params,
+        )
+
+    def _read_ctf_tables(
+        self,
+        cursor: sqlite3.Cursor,
+        ctf_series_rows: List[Tuple[int, str]],
+        ctf_sql_fields: str,
+    ) -> Iterator[Tuple[str, CTFSeries]]:
+        """Reads the tables of several CTFTomoSeries with a single query, tagging
+        each row with the position of its CTFTomoSeries in ctf_series_rows."""
+        query = " UNION ALL ".join(
+            f'SELECT {tag}, id, {ctf_sql_fields} FROM "{self._get_ctf_obj_tbl_name(obj_id)}"'
+            for tag, (obj_id, _) in enumerate(ctf_series_rows)
+        )
+        rows = fetch_all(cursor, f"{query} ORDER BY 1, 2")  # execute the query
+        # NULL -> NaN
+        values = np.array(rows, dtype=np.float64).reshape(
+            -1, 2 + len(CTF_TOMO_SERIES_FIELDS)
+        )
+        counts = np.bincount(
+            values[:, 0].astype(np.int64), minlength=len(ctf_series_rows)
+        )
+        ctf_values_list = np.split(values[:, 2:], np.cumsum(counts)[:-1])
+        for (_, ts_id), ctf_values in zip(ctf_series_rows, ctf_values_list):
+            logger.debug("tsId = %s. Loading the CTF series...", ts_id)
+            yield ts_id, CTFSeries(ctf_values)
 
     @staticmethod
     def _get_ctf_classes_tbl_name(ctf_set_row_index: int) -> str:
         """Returns the classes table name for each CTFTomoSeries (they are
         named id1_Classes, id2_classes, etc.).
-        :param ctf_set_row_index: CTFTomoSeries index, from 1.
+        :param ctf_set_row_index: CTFTomoSeries row id, from 1.
         """
         return f"id{ctf_set_row_index}_{CLASSES_TBL}"
 
     @staticmethod
     def _get_ctf_obj_tbl_name(ctf_set_row_index: int) -> str:
-        """Returns the classes table name for each CTFTomoSeries (they are
-        named id1_Classes, id2_classes, etc.).
-        :param ctf_set_row_index: CTFTomoSeries index, from 1.
+        """Returns the objects table name for each CTFTomoSeries (they are
+        named id1_Objects, id2_Objects, etc.).
+        :param ctf_set_row_index: CTFTomoSeries row id, from 1.
         """
         return f"id{ctf_set_row_index}_{OBJECTS_TBL}"
-
-    @staticmethod
-    def _ctf_from_sqlite_row(
-        row: sqlite3.Row,
-        ctf_tomo_class_dict: Dict[str, str],
-    ) -> CTFMetadata:
-        return CTFMetadata(
-            defocus_u=get_row_value(row, ctf_tomo_class_dict, DEFOCUS_U),
-            defocus_v=get_row_value(row, ctf_tomo_class_dict, DEFOCUS_V),
-            defocus_angle=get_row_value(row, ctf_tomo_class_dict, DEFOCUS_ANGLE),
-            phase_shift=get_row_value(row, ctf_tomo_class_dict, PHASE_SHIFT),
-            acquisition_order=get_row_value(
-                row, ctf_tomo_class_dict, ACQUISITION_ORDER
-            ),
-        )
@@ -0,0 +1,131 @@
+from typing import List, Optional, Sequence, overload
+
+import numpy as np
+
+from cets_data_model.models.models import CTFMetadata
+
+# Columns of the CTF values, in the same order as CTF_TOMO_SERIES_FIELDS
+CTF_COLUMNS = [
+    "defocus_u",
+    "defocus_v",
+    "defocus_angle",
+    "phase_shift",
+    "acquisition_order",
+]
+
+
+class CTFSeries(Sequence[CTFMetadata]):
+    """CTF of the tilt-images of a tilt-series, stored as a NumPy array with one
+    row per tilt-image and one column per CTF value (see CTF_COLUMNS). Empty
+    values are stored as NaN. It behaves as a read-only list of CTFMetadata,
+    created on demand when an item is accessed, so it can be used wherever the
+    CTFMetadata list returned by ScipionSetOfCtf.scipion_to_cets is expected.
+
+    :param values: array of shape (N, len(CTF_COLUMNS)).
+    """
+
+    def __init__(self, values: np.ndarray):
+        if values.ndim != 2 or values.shape[1] != len(CTF_COLUMNS):
+            raise ValueError(
+                f"Invalid CTF values shape {values.shape}. Expected: "
+                f"(N, {len(CTF_COLUMNS)})"
+            )
+        self.values = values
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    @overload
+    def __getitem__(self, index: int) -> CTFMetadata: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> List[CTFMetadata]: ...
+
+    def __getitem__(self, index: int | slice) -> CTFMetadata | List[CTFMetadata]:
+        if isinstance(index, slice):
+            return self._to_ctf_list(self.values[index])
+        return self._to_ctf_list(self.values[index][np.newaxis])[0]
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, CTFSeries):
+            return np.array_equal(self.values, other.values, equal_nan=True)
+        if isinstance(other, list):
+            return self.to_list() == other
+        return NotImplemented
+
+    @property
+    def defocus_u(self) -> np.ndarray:
+        return self.values[:, 0]
+
+    @property
+    def defocus_v(self) -> np.ndarray:
+        return self.values[:, 1]
+
+    @property
+    def defocus_angle(self) -> np.ndarray:
+        return self.values[:, 2]
+
+    @property
+    def phase_shift(self) -> np.ndarray:
+        return self.values[:, 3]
+
+    @property
+    def acquisition_order(self) -> np.ndarray:
+        return self.values[:, 4]
+
+    @classmethod
+    def from_ctf_list(cls, ctf_list: Sequence[CTFMetadata]) -> "CTFSeries":
+        """Creates a CTFSeries from a list of CTFMetadata, e.g. as returned by
+        ScipionSetOfCtf.scipion_to_cets."""
+        if isinstance(ctf_list, CTFSeries):
+            return ctf_list
+        values = np.array(
+            [[getattr(ctf, column) for column in CTF_COLUMNS] for ctf in ctf_list],
+            dtype=np.float64,
+        )
+        return cls(values.reshape(-1, len(CTF_COLUMNS)))
+
+    def match(
+        self, acquisition_orders: Sequence[int | None]
+    ) -> List[Optional[CTFMetadata]]:
+        """Returns the CTFMetadata of each tilt-image, matched by acquisition
+        order, or None if there is no CTF with its acquisition order. The keys are
+        matched with a binary search over the sorted acquisition orders of the
+        CTF. If several CTF share an acquisition order, the first one is used.
+
+        :param acquisition_orders: acquisition order of each tilt-image.
+        """
+        keys = np.array(acquisition_orders, dtype=np.float64).reshape(-1)  # None -> NaN
+        ctf_orders = self.acquisition_order
+        ctf_indices = np.flatnonzero(~np.isnan(ctf_orders))
+        ctf_indices = ctf_indices[np.argsort(ctf_orders[ctf_indices], kind="stable")]
+        sorted_orders, first = np.unique(ctf_orders[ctf_indices], return_index=True)
+        ctf_indices = ctf_indices[first]
+        positions = np.searchsorted(sorted_orders, keys)
+        positions[positions == len(sorted_orders)] = 0
+        found = np.zeros(len(keys), dtype=bool)
+        if len(sorted_orders):
+            found = sorted_orders[positions] == keys  # NaN never matches
+        matched = iter(self._to_ctf_list(self.values[ctf_indices[positions[found]]]))
+        return [next(matched) if is_found else None for is_found in found.tolist()]
+
+    def to_list(self) -> List[CTFMetadata]:
+        """Materializes all the CTFMetadata."""
+        return self._to_ctf_list(self.values)
+
+    @staticmethod
+    def _to_ctf_list(values: np.ndarray) -> List[CTFMetadata]:
+        # NaN -> None, and the acquisition order back to int
+        object_values = values.astype(object)
+        object_values[np.isnan(values)] = None
+        rows = object_values.tolist()
+        return [
+            CTFMetadata(
+                defocus_u=defocus_u,
+                defocus_v=defocus_v,
+                defocus_angle=defocus_angle,
+                phase_shift=phase_shift,
+                acquisition_order=int(acq_order) if acq_order is not None else None,
+            )
+            for defocus_u, defocus_v, defocus_angle, phase_shift, acq_order in rows
+        ]
@@ -0,0 +1,450 @@
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Sequence as SequenceABC
+from typing import (
+    Any,
+    Callable,
+    Generic,
+    Hashable,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    overload,
+)
+
+from cets_data_model.models.models import (
+    CTFMetadata,
+    Particle3DSet,
+    TiltImage,
+    TiltSeries,
+    Tomogram,
+)
+from scipion.constants import (
+    TS_ID,
+    CTF_CORRECTED,
+    SET_SIZE,
+    TILT_ANGLE,
+    ACCUMULATED_DOSE,
+    OBJECTS_TBL,
+)
+from scipion.converters.tilt_series_set import ScipionSetOfTiltSeries
+from scipion.converters.tomograms_set import ScipionSetOfTomograms
+from scipion.utils.utils_filters import (
+    ConversionFilter,
+    get_id_condition,
+    get_tilt_image_condition,
+    get_where_clause,
+)
+from scipion.utils.utils_instrumentation import (
+    REPORT,
+    LAZY_CACHE_HITS,
+    LAZY_CACHE_MISSES,
+)
+from scipion.utils.utils_sqlite import (
+    connect_db,
+    map_classes_table,
+    get_tuple_cursor,
+    fetch_all,
+    RowExtractor,
+)
+
+DEFAULT_LAZY_CACHE_SIZE = 16
+
+T = TypeVar("T")
+H = TypeVar("H")
+
+
+class LRUCache(Generic[T]):
+    """Bounded and thread-safe LRU cache of the objects materialized by the lazy
+    sets. When full, the least recently used object is evicted, so only the
+    last max_size tilt-series or tomograms accessed are kept in memory."""
+
+    def __init__(self, max_size: int = DEFAULT_LAZY_CACHE_SIZE):
+        if max_size < 1:
+            raise ValueError(f"The cache size must be greater than 0: {max_size}")
+        self.max_size = max_size
+        self._entries: OrderedDict[Hashable, T] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable, loader: Callable[[], T]) -> T:
+        """Returns the object of key, calling loader to materialize it if it is
+        not cached."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                REPORT.count(LAZY_CACHE_HITS)
+                return self._entries[key]
+        REPORT.count(LAZY_CACHE_MISSES)
+        # Loaded out of the lock, so other threads can use the cached objects
+        value = loader()
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class _LazySet(SequenceABC, ABC, Generic[H]):
+    """Sequence of handles to the items of a Scipion set, which can be indexed
+    by position or looked up by identifier with get. The items are materialized
+    by the handles on first access, and kept in a bounded LRU cache."""
+
+    def __init__(self, handles: List[H], cache_size: int):
+        self._handles = handles
+        self._positions = {
+            self._get_handle_id(handle): i for i, handle in enumerate(handles)
+        }
+        self.cache: LRUCache[Any] = LRUCache(cache_size)
+
+    def __len__(self) -> int:
+        return len(self._handles)
+
+    @overload
+    def __getitem__(self, index: int) -> H: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> List[H]: ...
+
+    def __getitem__(self, index: int | slice) -> H | List[H]:
+        return self._handles[index]
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({len(self)} items, {len(self.cache)} loaded)"
+
+    @property
+    def ids(self) -> List[str]:
+        return list(self._positions)
+
+    def get(self, item_id: str) -> H:
+        """Handle of the item of identifier item_id. Raises KeyError if it is not
+        in the set (or not selected by the filters)."""
+        return self._handles[self._positions[item_id]]
+
+    def load(self, item_id: str) -> Any:
+        """Materializes the item of identifier item_id, or returns it from the
+        cache if it has been accessed recently."""
+        if item_id not in self._positions:
+            raise KeyError(item_id)
+        return self.cache.get(item_id, lambda: self._materialize(item_id))
+
+    def is_loaded(self, item_id: str) -> bool:
+        return item_id in self.cache
+
+    def clear_cache(self) -> None:
+        self.cache.clear()
+
+    @staticmethod
+    @abstractmethod
+    def _get_handle_id(handle: H) -> str:
+        """Identifier of the item referenced by handle."""
+
+    @abstractmethod
+    def _materialize(self, item_id: str) -> Any:
+        """Converts the item of identifier item_id."""
+
+
+class TiltSeriesHandle:
+    """Lightweight reference to a tilt-series of a LazySetOfTiltSeries. The
+    identifier and the fields of the tilt-series are read from the table Objects
+    of the set, and the tilt-images (with their CTF) are converted on first
+    access to tilt_series, images or ctf_metadata."""
+
+    __slots__ = ("_owner", "obj_id", "ts_id", "ctf_corrected", "_n_tilt_images")
+
+    def __init__(
+        self,
+        owner: "LazySetOfTiltSeries",
+        obj_id: int,
+        ts_id: str,
+        ctf_corrected: bool,
+        n_tilt_images: int | None = None,
+    ):
+        self._owner = owner
+        self.obj_id = obj_id
+        self.ts_id = ts_id
+        self.ctf_corrected = ctf_corrected
+        self._n_tilt_images = n_tilt_images
+
+    def __repr__(self) -> str:
+        return (
+            f"TiltSeriesHandle(ts_id={self.ts_id!r}, "
+            f"loaded={self._owner.is_loaded(self.ts_id)})"
+        )
+
+    @property
+    def n_tilt_images(self) -> int:
+        """Number of tilt-images selected, without converting them. It is the
+        size stored in the set or, if the filters select the tilt-images (or the
+        size is not stored), it is counted in the tilt-series table."""
+        if self._n_tilt_images is None:
+            self._n_tilt_images = self._owner._count_tilt_images(self.ts_id)
+        return self._n_tilt_images
+
+    @property
+    def tilt_series(self) -> TiltSeries | None:
+        """Converted tilt-series. None if the filters select none of its
+        tilt-images."""
+        return self._owner.load(self.ts_id)
+
+    @property
+    def images(self) -> List[TiltImage]:
+        tilt_series = self.tilt_series
+        return list(tilt_series.images) if tilt_series is not None else []
+
+    @property
+    def ctf_metadata(self) -> List[Optional[CTFMetadata]]:
+        """CTF of each tilt-image, None for the ones without CTF."""
+        return [ti.ctf_metadata for ti in self.images]
+
+
+class LazySetOfTiltSeries(_LazySet[TiltSeriesHandle]):
+    """Lazy counterpart of ScipionSetOfTiltSeries.scipion_to_cets: a sequence of
+    TiltSeriesHandle, in the order of the set, built reading only the table
+    Objects. Each tilt-series is converted, reading its table and its CTF, when
+    it is accessed, and the last cache_size tilt-series accessed are kept.
+
+    Example:
+        ts_set = LazySetOfTiltSeries(ts_db_path, ctf_db_path=ctf_db_path)
+        print(len(ts_set), ts_set.ids)
+        images = ts_set.get("TS_01").images
+    """
+
+    def __init__(
+        self,
+        sqlite_path: os.PathLike | str,
+        ctf_md: Mapping[str, Sequence[CTFMetadata]] | None = None,
+        ctf_db_path: os.PathLike | str | None = None,
+        filters: ConversionFilter | None = None,
+        cache_size: int = DEFAULT_LAZY_CACHE_SIZE,
+    ):
+        """
+        :param sqlite_path: path of the sqlite file of the set of tilt-series.
+
+        :param ctf_md: CTF of the tilt-series. See
+        ScipionSetOfTiltSeries.scipion_to_cets.
+        :type ctf_md: Mapping[str, Sequence[CTFMetadata]] or None, optional, Defaults to None
+
+        :param ctf_db_path: path of the sqlite file of a Scipion set of CTF. The
+        CTF of each tilt-series is read when it is accessed.
+        :type ctf_db_path: os.PathLike or str, optional, Defaults to None
+
+        :param filters: selection of the tilt-series and tilt-images.
+        :type filters: ConversionFilter or None, optional, Defaults to None
+
+        :param cache_size: max number of tilt-series kept in memory.
+        :type cache_size: int, optional, Defaults to DEFAULT_LAZY_CACHE_SIZE
+        """
+        if ctf_md and ctf_db_path:
+            raise ValueError("ctf_md and ctf_db_path cannot be used together")
+        self.converter = ScipionSetOfTiltSeries(sqlite_path)
+        self.ctf_md = ctf_md
+        self.ctf_db_path = ctf_db_path
+        self.filters = filters
+        super().__init__(self._read_handles(), cache_size)
+
+    def _read_handles(self) -> List[TiltSeriesHandle]:
+        conn = connect_db(self.converter.db_path)
+        if conn is None:
+            return []
+        class_dict = map_classes_table(conn)
+        extractor = RowExtractor(class_dict, [TS_ID, CTF_CORRECTED, SET_SIZE])
+        where, params = get_where_clause(
+            get_id_condition(class_dict[TS_ID], None, self.filters)
+        )
+        rows = fetch_all(
+            get_tuple_cursor(conn),
+            f'SELECT id, {extractor.sql_fields} FROM "{OBJECTS_TBL}"{where} '
+            f"ORDER BY id",
+            params,
+        )
+        # The stored size is not the number of tilt-images selected by filters
+        use_size = self.filters is None or (
+            self.filters.min_tilt_angle is None
+            and self.filters.max_tilt_angle is None
+            and self.filters.max_dose is None
+        )
+        return [
+            TiltSeriesHandle(
+                self,
+                obj_id,
+                ts_id,
+                bool(ctf_corrected),
+                size if use_size else None,
+            )
+            for obj_id, ts_id, ctf_corrected, size in rows
+        ]
+
+    def _count_tilt_images(self, ts_id: str) -> int:
+        conn = connect_db(self.converter.db_path)
+        if conn is None:
+            return 0
+        ts_class_dict = map_classes_table(
+            conn, self.converter._get_ts_classes_tbl_name(ts_id)
+        )
+        where, params = get_where_clause(
+            get_tilt_image_condition(
+                ts_class_dict.get(TILT_ANGLE, None),
+                ts_class_dict.get(ACCUMULATED_DOSE, None),
+                self.filters,
+            )
+        )
+        ((n_images,),) = fetch_all(
+            get_tuple_cursor(conn),
+            f'SELECT COUNT(*) FROM "{self.converter._get_ts_obj_tbl_name(ts_id)}"'
+            f"{where}",
+            params,
+        )
+        return n_images
+
+    @staticmethod
+    def _get_handle_id(handle: TiltSeriesHandle) -> str:
+        return handle.ts_id
+
+    def _materialize(self, ts_id: str) -> TiltSeries | None:
+        return next(
+            self.converter.iter_cets(
+                ctf_md=self.ctf_md,
+                ts_ids=[ts_id],
+                filters=self.filters,
+                ctf_db_path=self.ctf_db_path,
+            ),
+            None,
+        )
+
+
+class TomogramHandle:
+    """Lightweight reference to a tomogram of a LazySetOfTomograms. The fields of
+    the tomogram are read from the table Objects of the set and the number of
+    particles with one aggregated query, while the tomogram (with the header of
+    its file) and its particles are converted on first access to tomogram or
+    particle_set."""
+
+    __slots__ = ("_owner", "tomo_id", "path", "ctf_corrected", "n_particles", "_values")
+
+    def __init__(
+        self,
+        owner: "LazySetOfTomograms",
+        tomo_values: Tuple[Any, ...],
+        n_particles: int | None = None,
+    ):
+        self._owner = owner
+        self._values = tomo_values
+        tomo_id, tomo_file, ctf_corrected, _ = tomo_values
+        prj_path = owner.converter.scipion_prj_path
+        self.tomo_id = tomo_id
+        self.path = str(prj_path / tomo_file if tomo_file else prj_path)
+        self.ctf_corrected = ctf_corrected
+        self.n_particles = n_particles
+
+    def __repr__(self) -> str:
+        return (
+            f"TomogramHandle(tomo_id={self.tomo_id!r}, "
+            f"loaded={self._owner.is_loaded(self.tomo_id)})"
+        )
+
+    @property
+    def tomogram(self) -> Tomogram:
+        return self._owner.load(self.tomo_id)
+
+    @property
+    def particle_set(self) -> Particle3DSet | None:
+        return self.tomogram.particle_set
+
+
+class LazySetOfTomograms(_LazySet[TomogramHandle]):
+    """Lazy counterpart of ScipionSetOfTomograms.scipion_to_cets: a sequence of
+    TomogramHandle, sorted by identifier as in iter_cets, built reading only the
+    table Objects and counting the particles of each tomogram. Each tomogram is
+    converted, reading only its own particles, when it is accessed, and the last
+    cache_size tomograms accessed are kept.
+    """
+
+    def __init__(
+        self,
+        sqlite_path: os.PathLike | str,
+        particles_db_path: os.PathLike | str | None = None,
+        filters: ConversionFilter | None = None,
+        cache_size: int = DEFAULT_LAZY_CACHE_SIZE,
+    ):
+        """
+        :param sqlite_path: path of the sqlite file of the set of tomograms.
+
+        :param particles_db_path: path of the sqlite file containing the
+        coordinates picked or the subtomograms.
+        :type particles_db_path: os.PathLike or str, optional. Defaults to None.
+
+        :param filters: selection of the tomograms and particles.
+        :type filters: ConversionFilter, optional. Defaults to None.
+
+        :param cache_size: max number of tomograms (with their particles) kept in
+        memory.
+        :type cache_size: int, optional. Defaults to DEFAULT_LAZY_CACHE_SIZE.
+        """
+        self.converter = ScipionSetOfTomograms(sqlite_path)
+        self.particles_reader = self.converter._get_particles_reader(particles_db_path)
+        self.filters = filters
+        super().__init__(self._read_handles(), cache_size)
+
+    def _read_handles(self) -> List[TomogramHandle]:
+        tomo_ids = self.converter._select_by_n_particles(
+            self.particles_reader, None, self.filters
+        )
+        conn = connect_db(self.converter.db_path)
+        if conn is None:
+            return []
+        tomo_extractor, rows = self.converter._read_tomo_rows(
+            conn, sort_by_id=True, tomo_ids=tomo_ids, filters=self.filters
+        )
+        get_tomo_values = tomo_extractor.getter(*self.converter.TOMO_VALUES_FIELDS)
+        n_particles_dict = {}
+        if self.particles_reader is not None:
+            max_particles = self.filters.max_particles if self.filters else None
+            n_particles_dict = {
+                tomo_id: n if max_particles is None else min(n, max_particles)
+                for tomo_id, (
+                    n,
+                    _,
+                ) in self.particles_reader.get_tomo_signatures().items()
+            }
+        handles = []
+        for row in rows:
+            tomo_values = get_tomo_values(row)
+            n_particles = (
+                n_particles_dict.get(tomo_values[0], 0)
+                if self.particles_reader is not None
+                else None
+            )
+            handles.append(TomogramHandle(self, tomo_values, n_particles))
+        return handles
+
+    @staticmethod
+    def _get_handle_id(handle: TomogramHandle) -> str:
+        return handle.tomo_id
+
+    def _materialize(self, tomo_id: str) -> Tomogram:
+        handle = self.get(tomo_id)
+        particle_sets = (
+            self.particles_reader.scipion_to_cets_by_tomo(
+                [tomo_id], filters=self.filters
+            )
+            if self.particles_reader is not None
+            else None
+        )
+        particle_set = particle_sets[tomo_id] if particle_sets is not None else None
+        return self.converter._tomo_from_sqlite_row(handle._values, particle_set)
@@ -0,0 +1,263 @@
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+from cets_data_model.models.models import (
+    Particle3DSet,
+    CoordinateSystem,
+    Axis,
+    AxisType,
+    AxisUnit,
+    SpaceAxis,
+    Particle3D,
+)
+from scipion.converters.base_converter import BaseConverter
+
+
+coordinates_system = [
+    CoordinateSystem(
+        name="Scipion",
+        axes=[
+            Axis(name=SpaceAxis.ZYZ, axis_type=AxisType.space, axis_unit=AxisUnit.pixel)
+        ],
+    )
+]
+
+# One record per particle. The tomogram identifiers and the file names are
+# stored once in the table and referenced by index (-1 if there is no file).
+PARTICLE_DTYPE = np.dtype(
+    [
+        ("tomo_index", np.int32),
+        ("file_index", np.int32),
+        ("position", np.float64, (3,)),
+        ("coord_rotation", np.float64, (3, 3)),
+        ("shift", np.float64, (3,)),
+        ("rotation", np.float64, (3, 3)),
+    ]
+)
+
+
+class ParticleTable:
+    """Compact columnar representation of a Scipion set of particles, backed by a
+    NumPy structured array. It holds the same information as a Particle3DSet
+    without creating a pydantic object per particle, which can be done on demand
+    for subsets with to_particle3d_set.
+
+    :param data: structured array of dtype PARTICLE_DTYPE.
+    :param tomo_ids: tomogram identifiers, referenced by data["tomo_index"].
+    :param file_names: particle file names, referenced by data["file_index"].
+    :param file_sizes: array of shape (n_files, 3) with the size x, y, z of each file.
+    :param is_subtomogram: True if the particles are subtomograms, so their file,
+    shift and rotation are meaningful, False if they are coordinates.
+    """
+
+    def __init__(
+        self,
+        data: np.ndarray,
+        tomo_ids: List[str],
+        file_names: List[str] | None = None,
+        file_sizes: np.ndarray | None = None,
+        is_subtomogram: bool = False,
+    ):
+        if data.dtype != PARTICLE_DTYPE:
+            raise ValueError(
+                f"Invalid particle table dtype {data.dtype}. Expected: {PARTICLE_DTYPE}"
+            )
+        self.data = data
+        self.tomo_ids = tomo_ids
+        self.file_names = file_names if file_names is not None else []
+        self.file_sizes = (
+            file_sizes if file_sizes is not None else np.empty((0, 3), dtype=np.int64)
+        )
+        self.is_subtomogram = is_subtomogram
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    @property
+    def positions(self) -> np.ndarray:
+        return self.data["position"]
+
+    @property
+    def coord_rotations(self) -> np.ndarray:
+        return self.data["coord_rotation"]
+
+    @property
+    def shifts(self) -> np.ndarray:
+        return self.data["shift"]
+
+    @property
+    def rotations(self) -> np.ndarray:
+        return self.data["rotation"]
+
+    @property
+    def file_indices(self) -> np.ndarray:
+        return self.data["file_index"]
+
+    @property
+    def tomo_indices(self) -> np.ndarray:
+        return self.data["tomo_index"]
+
+    def get_tomo_id_array(self) -> np.ndarray:
+        """Returns the tomogram identifier of each particle."""
+        return np.asarray(self.tomo_ids, dtype=object)[self.tomo_indices]
+
+    def take(self, indices: Sequence[int] | np.ndarray) -> "ParticleTable":
+        """Returns a new table with the introduced particles (indices or boolean
+        mask). The tomogram and file tables are shared with this one."""
+        indices = np.asarray(indices)
+        if not indices.size:
+            # An empty list is a float array for NumPy
+            indices = indices.astype(np.intp)
+        return ParticleTable(
+            self.data[indices],
+            self.tomo_ids,
+            file_names=self.file_names,
+            file_sizes=self.file_sizes,
+            is_subtomogram=self.is_subtomogram,
+        )
+
+    def select(self, tomo_id: str) -> "ParticleTable":
+        """Returns a new table with the particles of the introduced tomogram."""
+        try:
+            tomo_index = self.tomo_ids.index(tomo_id)
+        except ValueError:
+            return self.take(np.zeros(len(self), dtype=bool))
+        return self.take(self.tomo_indices == tomo_index)
+
+    def group_by_tomo(self) -> Dict[str, "ParticleTable"]:
+        """Splits the table into one table per tomogram, in order of appearance."""
+        if not len(self):
+            return {}
+        tomo_indices = self.tomo_indices
+        order = np.argsort(tomo_indices, kind="stable")
+        present, starts = np.unique(tomo_indices[order], return_index=True)
+        groups = np.split(order, starts[1:])
+        first_rows = [group[0] for group in groups]
+        return {
+            self.tomo_ids[present[i]]: self.take(groups[i])
+            for i in np.argsort(first_rows)
+        }
+
+    def to_particle3d_set(
+        self, indices: Sequence[int] | np.ndarray | None = None
+    ) -> Particle3DSet:
+        """Materializes the particles (all of them or the introduced indices) as a
+        CETS Particle3DSet. Intended for small subsets.
+        """
+        table = self if indices is None else self.take(indices)
+        n_particles = len(table)
+        coord_matrices = np.zeros((n_particles, 4, 4))
+        coord_matrices[:, :3, :3] = table.coord_rotations
+        coord_transforms = BaseConverter._gen_subvolume_transforms_batch(coord_matrices)
+        positions = table.positions.tolist()
+        if not table.is_subtomogram:
+            particle_list = [
+                Particle3D(
+                    position=position,
+                    coordinate_transformations=[coordinate_transform],
+                )
+                for position, (_, coordinate_transform) in zip(
+                    positions, coord_transforms
+                )
+            ]
+        else:
+            subtomo_matrices = np.zeros((n_particles, 4, 4))
+            subtomo_matrices[:, :3, :3] = table.rotations
+            subtomo_matrices[:, :3, 3] = table.shifts
+            subtomo_transforms = BaseConverter._gen_subvolume_transforms_batch(
+                subtomo_matrices, is_coordinate=False
+            )
+            particle_list = []
+            for file_index, position, (_, coord_transform), (tr, rot) in zip(
+                table.file_indices.tolist(),
+                positions,
+                coord_transforms,
+                subtomo_transforms,
+            ):
+                size_x, size_y, size_z = table.file_sizes[file_index].tolist()
+                particle_list.append(
+                    Particle3D(
+                        path=table.file_names[file_index],
+                        width=size_x,
+                        height=size_y,
+                        depth=size_z,
+                        position=position,
+                        coordinate_transformations=[coord_transform, tr, rot],
+                    )
+                )
+        return Particle3DSet(
+            particles=particle_list,
+            coordinate_systems=coordinates_system,
+        )
+
+
+class ParticleTableBuilder:
+    """Accumulates chunks of particles into a ParticleTable, indexing the
+    tomogram identifiers and the file names across chunks."""
+
+    def __init__(self, is_subtomogram: bool = False):
+        self.is_subtomogram = is_subtomogram
+        self._chunks: List[np.ndarray] = []
+        self._tomo_index: Dict[str, int] = {}
+        self._file_index: Dict[str, int] = {}
+        self._file_sizes: List[List[int]] = []
+
+    def add_file(self, file_name: str, size: Sequence[int]) -> None:
+        """Registers a particle file and its size x, y, z."""
+        if file_name not in self._file_index:
+            self._file_index[file_name] = len(self._file_index)
+            self._file_sizes.append(list(size))
+
+    def has_file(self, file_name: str) -> bool:
+        return file_name in self._file_index
+
+    def append(
+        self,
+        tomo_ids: Sequence[str],
+        positions: np.ndarray,
+        coord_matrices: np.ndarray,
+        subtomo_matrices: np.ndarray | None = None,
+        file_names: Sequence[str] | None = None,
+    ) -> None:
+        """Adds a chunk of particles.
+
+        :param tomo_ids: tomogram identifier of each particle.
+        :param positions: array of shape (N, 3).
+        :param coord_matrices: array of shape (N, 4, 4) with the coordinates matrices.
+        :param subtomo_matrices: array of shape (N, 4, 4) with the subtomogram
+        transformation matrices, if the particles are subtomograms.
+        :param file_names: file of each particle, which must have been registered
+        with add_file, if the particles are subtomograms.
+        """
+        chunk = np.zeros(len(tomo_ids), dtype=PARTICLE_DTYPE)
+        tomo_index = self._tomo_index
+        chunk["tomo_index"] = [
+            tomo_index.setdefault(tomo_id, len(tomo_index)) for tomo_id in tomo_ids
+        ]
+        chunk["position"] = positions
+        chunk["coord_rotation"] = coord_matrices[:, :3, :3]
+        if subtomo_matrices is not None:
+            chunk["shift"] = subtomo_matrices[:, :3, 3]
+            chunk["rotation"] = subtomo_matrices[:, :3, :3]
+        else:
+            chunk["rotation"] = np.eye(3)
+        if file_names is not None:
+            chunk["file_index"] = [self._file_index[fn] for fn in file_names]
+        else:
+            chunk["file_index"] = -1
+        self._chunks.append(chunk)
+
+    def build(self) -> ParticleTable:
+        data = (
+            np.concatenate(self._chunks)
+            if self._chunks
+            else np.zeros(0, dtype=PARTICLE_DTYPE)
+        )
+        return ParticleTable(
+            data,
+            list(self._tomo_index),
+            file_names=list(self._file_index),
+            file_sizes=np.array(self._file_sizes, dtype=np.int64).reshape(-1, 3),
+            is_subtomogram=self.is_subtomogram,
+        )
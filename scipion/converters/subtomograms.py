@@ -1,16 +1,10 @@
-import ast
+from typing import Any, List, Tuple
+
 from cets_data_model.models.models import (
     Particle3DSet,
-    CoordinateSystem,
-    Axis,
-    AxisType,
-    AxisUnit,
-    SpaceAxis,
     Particle3D,
 )
-from cets_data_model.utils.image_utils import get_mrc_info
 from scipion.constants import (
-    OBJECTS_TBL,
     SUBTOMO_FIELDS,
     SUBTOMO_ID,
     FILE_NAME,
@@ -20,21 +14,20 @@ from scipion.constants import (
     SUBTOMO_COORD_MATRIX,
     SUBTOMO_TRANSFORM_MATRIX,
 )
-from scipion.converters.base_converter import BaseConverter
-from scipion.utils.utils_sqlite import connect_db, map_classes_table, get_row_value
-
+from scipion.converters.base_particles_converter import BaseParticlesConverter
+from scipion.utils.utils_matrix import parse_matrices
+from scipion.utils.utils_sqlite import connect_db, RowExtractor
+from scipion.utils.utils_mrc import get_mrc_infos_cached
 
-coordinates_system = [
-    CoordinateSystem(
-        name="Scipion",
-        axes=[
-            Axis(name=SpaceAxis.ZYZ, axis_type=AxisType.space, axis_unit=AxisUnit.pixel)
-        ],
-    )
-]
 
+class ScipionSetOfSubtomogras(BaseParticlesConverter):
+    particle_fields = SUBTOMO_FIELDS
+    tomo_id_field = SUBTOMO_ID
+    position_fields = [SUBTOMO_X, SUBTOMO_Y, SUBTOMO_Z]
+    coord_matrix_field = SUBTOMO_COORD_MATRIX
+    subtomo_matrix_field = SUBTOMO_TRANSFORM_MATRIX
+    file_field = FILE_NAME
 
-class ScipionSetOfSubtomogras(BaseConverter):
     def scipion_to_cets(
         self,
         tomo_id: str,
@@ -51,72 +44,71 @@ class ScipionSetOfSubtomogras(BaseConverter):
         db_connection = connect_db(self.db_path)
         if db_connection is not None:
             with db_connection as conn:
-                # Map the table Classes and get some values from the table Objects
-                coord_set_class_dict = map_classes_table(conn)
-
-                # Sqlite fields of the data to be read from each tomogram
-                coord_sql_fields = self._get_sql_fields(
-                    coord_set_class_dict, SUBTOMO_FIELDS
-                )
-
-                cursor = conn.cursor()
-                tomo_id_col_name = coord_set_class_dict[SUBTOMO_ID]
-                query = f'SELECT {coord_sql_fields} FROM "{OBJECTS_TBL}" WHERE {tomo_id_col_name}="{tomo_id}"'
-                cursor.execute(query)  # execute the query
-                particle_list = []
-                for row in cursor:
-                    subtomo_fn = get_row_value(row, coord_set_class_dict, FILE_NAME)
-                    subtomo_fn = (
-                        self.scipion_prj_path / subtomo_fn
-                        if subtomo_fn
-                        else self.scipion_prj_path
-                    )
-                    img_info = get_mrc_info(subtomo_fn)
-
-                    euler_matrix = ast.literal_eval(
-                        get_row_value(row, coord_set_class_dict, SUBTOMO_COORD_MATRIX)
-                    )
-                    _, coordinate_transform = self._gen_subvolume_transforms(
-                        euler_matrix
-                    )
-                    subtomo_euler_matrix = ast.literal_eval(
-                        get_row_value(
-                            row, coord_set_class_dict, SUBTOMO_TRANSFORM_MATRIX
-                        )
-                    )
-                    subtomo_tr, subtomo_rot = self._gen_subvolume_transforms(
-                        subtomo_euler_matrix, is_coordinate=False
-                    )
-                    position = [
-                        get_row_value(row, coord_set_class_dict, SUBTOMO_X),
-                        get_row_value(row, coord_set_class_dict, SUBTOMO_Y),
-                        get_row_value(row, coord_set_class_dict, SUBTOMO_Z),
-                    ]
-                    particle_list.append(
-                        Particle3D(
-                            path=str(subtomo_fn),
-                            width=img_info.size_x,
-                            height=img_info.size_y,
-                            depth=img_info.size_z,
-                            position=position,
-                            coordinate_transformations=[
-                                coordinate_transform,
-                                subtomo_tr,
-                                subtomo_rot,
-                            ],
-                        )
-                    )
-                if not particle_list:
-                    raise Exception(
-                        f"No particle files were found matching the introduced Scipion's "
-                        f"tomogram identifier [{tomo_id}]."
-                    )
-                coordinates = Particle3DSet(
-                    particles=particle_list,
-                    coordinate_systems=coordinates_system,
-                )
+                particles_dict = self._read_particles(conn, tomo_ids=[tomo_id])
+                particle_list = particles_dict.get(tomo_id, [])
+                self._check_particles_found(particle_list, tomo_id)
+                coordinates = self._gen_particle_set(particle_list)
                 # if out_directory:
                 #     write_coords_set_yaml(coordinates, Path(out_directory))
                 return coordinates
         return None
         # return None
+
+    def _particles_from_sqlite_rows(
+        self, rows: List[Tuple[Any, ...]], extractor: RowExtractor
+    ) -> List[Particle3D]:
+        coord_matrices = parse_matrices(
+            extractor.column(rows, SUBTOMO_COORD_MATRIX),
+            shape=(4, 4),
+            column=SUBTOMO_COORD_MATRIX,
+        )
+        coord_transforms = self._gen_subvolume_transforms_batch(coord_matrices)
+        subtomo_matrices = parse_matrices(
+            extractor.column(rows, SUBTOMO_TRANSFORM_MATRIX),
+            shape=(4, 4),
+            column=SUBTOMO_TRANSFORM_MATRIX,
+        )
+        subtomo_transforms = self._gen_subvolume_transforms_batch(
+            subtomo_matrices, is_coordinate=False
+        )
+
+        get_position = extractor.getter(SUBTOMO_X, SUBTOMO_Y, SUBTOMO_Z)
+        subtomo_fns = [
+            self.scipion_prj_path / subtomo_fn if subtomo_fn else self.scipion_prj_path
+            for subtomo_fn in extractor.column(rows, FILE_NAME)
+        ]
+        # The headers of the whole batch are read concurrently
+        img_infos = get_mrc_infos_cached(subtomo_fns)
+        particle_list = []
+        for (
+            row,
+            subtomo_fn,
+            img_info,
+            (_, coordinate_transform),
+            (subtomo_tr, subtomo_rot),
+        ) in zip(rows, subtomo_fns, img_infos, coord_transforms, subtomo_transforms):
+            position = list(get_position(row))
+            particle_list.append(
+                Particle3D(
+                    path=str(subtomo_fn),
+                    width=img_info.size_x,
+                    height=img_info.size_y,
+                    depth=img_info.size_z,
+                    position=position,
+                    coordinate_transformations=[
+                        coordinate_transform,
+                        subtomo_tr,
+                        subtomo_rot,
+                    ],
+                )
+            )
+        return particle_list
+
+    def _check_particles_found(
+        self, particle_list: List[Particle3D], tomo_id: str
+    ) -> None:
+        if not particle_list:
+            raise Exception(
+                f"No particle files were found matching the introduced Scipion's "
+                f"tomogram identifier [{tomo_id}]."
+            )
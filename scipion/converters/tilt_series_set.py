@@ -1,7 +1,7 @@
-import ast
-import sqlite3
+import logging
+import os
 from pathlib import Path
-from typing import Dict, List
+from typing import Any, Dict, List, Iterable, Iterator, Mapping, Sequence, Tuple
 
 import numpy as np
 
@@ -14,13 +14,10 @@ from cets_data_model.models.models import (
     CoordinateSystem,
     CoordinateTransformation,
     Translation,
-    Vector3D,
     Affine,
-    Matrix3x3,
     TiltSeries,
     CTFMetadata,
 )
-from cets_data_model.utils.image_utils import get_mrc_info
 from scipion.constants import (
     TS_ID,
     TILT_SERIES_FIELDS,
@@ -36,128 +33,385 @@ from scipion.constants import (
     OBJECTS_TBL,
 )
 from scipion.converters.base_converter import BaseConverter
-from scipion.utils.utils import write_ts_set_yaml
+from scipion.converters.ctf_set import ScipionSetOfCtf, MAX_TABLES_PER_QUERY
+from scipion.converters.ctf_table import CTFSeries
+from scipion.utils.utils import write_ts_set_yaml, get_ts_yaml_file
+from scipion.utils.utils_cache import ConversionCache
+from scipion.utils.utils_filters import (
+    ConversionFilter,
+    get_id_condition,
+    get_tilt_image_condition,
+    get_where_clause,
+)
+from scipion.utils.utils_incremental import ConversionState, Signature
+from scipion.utils.utils_instrumentation import Stage, MODEL_BUILD
+from scipion.utils.utils_matrix import parse_matrices
+from scipion.utils.utils_models import check_batch, build_models
+from scipion.utils.utils_mrc import get_mrc_info_cached
 from scipion.utils.utils_sqlite import (
     connect_db,
     map_classes_table,
-    get_from_obj_tbl,
-    get_row_value,
+    get_tuple_cursor,
+    fetch_all,
+    RowExtractor,
 )
 
 
+logger = logging.getLogger(__name__)
+
+
 class ScipionSetOfTiltSeries(BaseConverter):
+    # Fields of each tilt-image row passed to _ti_from_sqlite_row, in order
+    TI_VALUES_FIELDS = (
+        TS_ID,
+        FILE_NAME,
+        INDEX,
+        ACQUISITION_ORDER,
+        TILT_ANGLE,
+        ACCUMULATED_DOSE,
+        ODD_EVEN_FN,
+    )
+
     def scipion_to_cets(
         self,
-        ctf_md: Dict[str, List[CTFMetadata]] | None = None,
-        out_directory: str | None = None,
+        ctf_md: Mapping[str, Sequence[CTFMetadata]] | None = None,
+        out_directory: Path | str | None = None,
+        ts_ids: Iterable[str] | None = None,
+        incremental: bool = False,
+        filters: ConversionFilter | None = None,
+        ctf_db_path: os.PathLike | str | None = None,
+        cache: ConversionCache | None = None,
+        compact_yaml: bool = False,
     ) -> List[TiltSeries] | None:
         """Converts a set of tilt-series from Scipion into CETS metadata.
 
         :param ctf_md: dictionary of type key: tilt-series id, value: list of CTF Metadata
         containing the CTFMetadata of corresponding to all the tilt-images that compose the tilt-series
         of id equal to the key of the dictionary. It can be obtained using the method
-        ScipionCtfSeries.scipion_to_cets.
-        :type ctf_md: Dict[str, List[CTFMetadata]] or None, optional, Defaults to None
+        ScipionSetOfCtf.scipion_to_cets or, faster, ScipionSetOfCtf.scipion_to_ctf_series.
+        :type ctf_md: Mapping[str, Sequence[CTFMetadata]] or None, optional, Defaults to None
 
         :param out_directory: name of the directory in which the tilt-series
         .yaml files (one per tilt-series) will be written.
         :type out_directory: pathlib.Path or str, optional, Defaults to None
+
+        :param ts_ids: identifiers of the tilt-series to be converted. If not
+        provided, all the tilt-series of the set are converted.
+        :type ts_ids: Iterable[str] or None, optional, Defaults to None
+
+        :param incremental: if True, only the tilt-series that are new or have
+        changed (different number of tilt-images or CTF) since the last
+        incremental conversion into out_directory are converted and written, so
+        a set that Scipion is still streaming can be kept up to date cheaply.
+        The state is kept in a file in out_directory, which is required.
+        :type incremental: bool, optional, Defaults to False
+
+        :param filters: selection of the tilt-series (ids, patterns) and of the
+        tilt-images (tilt angle, dose) to be converted, pushed into the queries.
+        :type filters: ConversionFilter or None, optional, Defaults to None
+
+        :param ctf_db_path: path of the sqlite file of a Scipion set of CTF. It is
+        an alternative to ctf_md: the CTF of the tilt-series are read while they
+        are converted, a chunk of tilt-series at a time, so the whole set of CTF
+        is never kept in memory.
+        :type ctf_db_path: os.PathLike or str, optional, Defaults to None
+
+        :param cache: on-disk cache of the conversions. If the same tilt-series
+        have already been converted with the same parameters and neither the
+        sqlite files nor the MRC files referenced have changed, the cached
+        result is returned instead of converting them again.
+        :type cache: ConversionCache or None, optional, Defaults to None
+
+        :param compact_yaml: if True, the .yaml files are written in compact YAML,
+        with the repeated blocks written once and referenced. See write_obj_yaml.
+        :type compact_yaml: bool, optional, Defaults to False
         """
-        db_connection = connect_db(self.db_path)
-        if db_connection is not None:
-            with db_connection as conn:
-                # Map the table Classes and get some values from the table Objects
-                ts_set_class_dict = map_classes_table(conn)
-                ts_ids = get_from_obj_tbl(conn, TS_ID, ts_set_class_dict)
-                ctf_corrected_list = get_from_obj_tbl(
-                    conn, CTF_CORRECTED, ts_set_class_dict
+        if ts_ids is not None:
+            ts_ids = list(ts_ids)
+        state, signatures = None, {}
+        if incremental:
+            if not out_directory:
+                raise ValueError("An output directory is required in incremental mode")
+            state = ConversionState.load(out_directory)
+            signatures = self.get_signatures(
+                ctf_md=ctf_md, ts_ids=ts_ids, filters=filters, ctf_db_path=ctf_db_path
+            )
+            ts_ids = state.get_changed(str(self.db_path), signatures)
+            logger.info("%d new or changed tilt-series to be converted.", len(ts_ids))
+            if not ts_ids:
+                return []
+
+        def convert() -> List[TiltSeries]:
+            return list(
+                self.iter_cets(
+                    ctf_md=ctf_md,
+                    ts_ids=ts_ids,
+                    filters=filters,
+                    ctf_db_path=ctf_db_path,
                 )
+            )
 
-                # Map the table Classes of the first tilt-series
-                ts_class_dict = map_classes_table(
-                    conn, self._get_ts_classes_tbl_name(ts_ids[0])
+        if cache is None:
+            tilt_series_list = convert()
+        else:
+            key = cache.get_key(
+                f"{self.__class__.__name__}.scipion_to_cets",
+                [self.db_path, ctf_db_path],
+                ctf_md=ctf_md,
+                ts_ids=ts_ids,
+                filters=filters,
+            )
+            tilt_series_list = cache.get_or_convert(key, convert)
+        if out_directory:
+            out_path = Path(out_directory)
+            written = set(
+                write_ts_set_yaml(tilt_series_list, out_path, compact=compact_yaml)
+            )
+            if state is not None:
+                state.update(
+                    str(self.db_path),
+                    signatures,
+                    obj_ids=[
+                        ts.ts_id
+                        for ts in tilt_series_list
+                        if get_ts_yaml_file(ts.ts_id, out_path) in written
+                    ],
                 )
+                state.save()
+        return tilt_series_list
+
+    def get_signatures(
+        self,
+        ctf_md: Mapping[str, Sequence[CTFMetadata]] | None = None,
+        ts_ids: Iterable[str] | None = None,
+        filters: ConversionFilter | None = None,
+        ctf_db_path: os.PathLike | str | None = None,
+    ) -> Dict[str, Signature]:
+        """Returns the signature of each tilt-series of the set: its row id, the
+        number of tilt-images and the max id of its table and, if ctf_md or
+        ctf_db_path are provided, the number of CTF values (and the max id of
+        their table, for ctf_db_path). It only reads the table Objects and
+        aggregates of the tilt-series tables, so it is cheap even for large sets.
+
+        :param ctf_md: dictionary of type key: tilt-series id, value: list of CTF
+        Metadata. See scipion_to_cets.
+        :param ts_ids: identifiers of the tilt-series. If not provided, all the
+        tilt-series of the set are considered.
+        :param filters: selection of the tilt-series and tilt-images. See
+        scipion_to_cets. As they change the result, they are part of the signature.
+        :param ctf_db_path: path of the sqlite file of a set of CTF. See
+        scipion_to_cets.
+        """
+        conn = connect_db(self.db_path)
+        if conn is None:
+            return {}
+        ts_set_class_dict = map_classes_table(conn)
+        ts_id_col_name = ts_set_class_dict[TS_ID]
+        where, params = get_where_clause(
+            get_id_condition(ts_id_col_name, ts_ids, filters)
+        )
+        cursor = get_tuple_cursor(conn)
+        ts_rows = fetch_all(
+            cursor, f'SELECT id, "{ts_id_col_name}" FROM "{OBJECTS_TBL}"{where}', params
+        )
+        ctf_signatures = (
+            ScipionSetOfCtf(ctf_db_path).get_signatures(
+                ts_ids=[ts_id for _, ts_id in ts_rows]
+            )
+            if ctf_db_path
+            else {}
+        )
+        filters_signature = filters.get_signature() if filters else []
+        signatures = {}
+        for obj_id, ts_id in ts_rows:
+            ((n_images, max_id),) = fetch_all(
+                cursor,
+                f'SELECT COUNT(*), MAX(id) FROM "{self._get_ts_obj_tbl_name(ts_id)}"',
+            )
+            n_ctf: int | Signature | None = (
+                len(ctf_md.get(ts_id, [])) if ctf_md else None
+            )
+            if ctf_db_path:
+                n_ctf = ctf_signatures.get(ts_id, None)
+            signatures[ts_id] = [obj_id, n_images, max_id, n_ctf, *filters_signature]
+        return signatures
+
+    def iter_cets(
+        self,
+        ctf_md: Mapping[str, Sequence[CTFMetadata]] | None = None,
+        ts_ids: Iterable[str] | None = None,
+        filters: ConversionFilter | None = None,
+        ctf_db_path: os.PathLike | str | None = None,
+    ) -> Iterator[TiltSeries]:
+        """Converts a set of tilt-series from Scipion into CETS metadata, yielding
+        one tilt-series at a time, so only one of them is kept in memory. The
+        result can be written directly with write_ts_set_yaml.
+
+        :param ctf_md: dictionary of type key: tilt-series id, value: list of CTF Metadata.
+        See scipion_to_cets.
+        :type ctf_md: Mapping[str, Sequence[CTFMetadata]] or None, optional, Defaults to None
 
-                # Sqlite fields of the data to be read from each tilt-image
-                ti_sql_fields = self._get_sql_fields(ts_class_dict, TILT_SERIES_FIELDS)
+        :param ts_ids: identifiers of the tilt-series to be converted. The tables
+        of the tilt-series not selected are not read.
+        :type ts_ids: Iterable[str] or None, optional, Defaults to None
 
-                # Coordinate system
-                axis_xy = Axis(
-                    name=SpaceAxis.Z,
-                    axis_unit=AxisUnit.pixel,
-                    axis_type=AxisType.space,
+        :param filters: selection of the tilt-series and tilt-images to be
+        converted. See scipion_to_cets. The tilt-series without any tilt-image
+        selected are skipped.
+        :type filters: ConversionFilter or None, optional, Defaults to None
+
+        :param ctf_db_path: path of the sqlite file of a Scipion set of CTF, read
+        MAX_TABLES_PER_QUERY tilt-series at a time. The CTF of each tilt-series is
+        released once it is yielded. See scipion_to_cets.
+        :type ctf_db_path: os.PathLike or str, optional, Defaults to None
+
+        The CTF of each tilt-image is the one with its same acquisition order.
+        """
+        if ctf_md and ctf_db_path:
+            raise ValueError("ctf_md and ctf_db_path cannot be used together")
+        ctf_reader = ScipionSetOfCtf(ctf_db_path) if ctf_db_path else None
+        db_connection = connect_db(self.db_path)
+        if db_connection is None:
+            return
+        with db_connection as conn:
+            # Map the table Classes and get the selected rows of the table Objects
+            ts_set_class_dict = map_classes_table(conn)
+            where, params = get_where_clause(
+                get_id_condition(ts_set_class_dict[TS_ID], ts_ids, filters)
+            )
+            obj_extractor = RowExtractor(ts_set_class_dict, [TS_ID, CTF_CORRECTED])
+            cursor = get_tuple_cursor(conn)
+            ts_rows = fetch_all(
+                cursor,
+                f'SELECT {obj_extractor.sql_fields} FROM "{OBJECTS_TBL}"{where} '
+                f"ORDER BY id",
+                params,
+            )
+            if not ts_rows:
+                return
+
+            # Map the table Classes of the first tilt-series
+            ts_class_dict = map_classes_table(
+                conn, self._get_ts_classes_tbl_name(ts_rows[0][0])
+            )
+
+            # Positional extractor of the data to be read from each tilt-image
+            ti_extractor = RowExtractor(ts_class_dict, TILT_SERIES_FIELDS)
+            get_ti_values = ti_extractor.getter(*self.TI_VALUES_FIELDS)
+            ti_where, ti_params = get_where_clause(
+                get_tilt_image_condition(
+                    ts_class_dict.get(TILT_ANGLE, None),
+                    ts_class_dict.get(ACCUMULATED_DOSE, None),
+                    filters,
+                )
+            )
+
+            # Coordinate system
+            axis_xy = Axis(
+                name=SpaceAxis.Z,
+                axis_unit=AxisUnit.pixel,
+                axis_type=AxisType.space,
+            )
+            coordinate_systems = CoordinateSystem(name="SCIPION", axes=[axis_xy])
+
+            ctf_chunk: Dict[str, CTFSeries] = {}
+            for i, (ts_id, ctf_corrected) in enumerate(ts_rows):
+                if ctf_reader is not None and i % MAX_TABLES_PER_QUERY == 0:
+                    # Read the CTF of the next chunk of tilt-series
+                    chunk_ids = [
+                        row[0] for row in ts_rows[i : i + MAX_TABLES_PER_QUERY]
+                    ]
+                    ctf_chunk = ctf_reader.scipion_to_ctf_series(ts_ids=chunk_ids)
+                logger.debug("tsId = %s. Loading the tilt-series...", ts_id)
+                # Manage the CTFMetadata
+                ctf_series: Sequence[CTFMetadata] | None
+                if ctf_reader is not None:
+                    ctf_series = ctf_chunk.pop(ts_id, None)  # Released once yielded
+                else:
+                    ctf_series = ctf_md.get(ts_id, None) if ctf_md else None
+                # Read the tilt-images table
+                ti_list = []
+                tilt_images_table_name = self._get_ts_obj_tbl_name(ts_id)
+                query = (
+                    f"SELECT {ti_extractor.sql_fields} "
+                    f'FROM "{tilt_images_table_name}"{ti_where}'
+                )
+                rows = fetch_all(cursor, query, ti_params)  # execute the query
+                if not rows:
+                    logger.info(
+                        "tsId = %s. No tilt-images selected. Skipping...", ts_id
+                    )
+                    continue
+                # Parse all the transformation matrices of the tilt-series at once
+                tr_matrices = parse_matrices(
+                    ti_extractor.column(rows, TRANSFORMATION_MATRIX),
+                    column=TRANSFORMATION_MATRIX,
                 )
-                coordinate_systems = CoordinateSystem(name="SCIPION", axes=[axis_xy])
-
-                cursor = conn.cursor()
-                tilt_series_list = []
-                for i, ts_id in enumerate(ts_ids):
-                    print(f"tsId = {ts_id}. Loading the tilt-series...")
-                    # Manage the CTFMetadata
-                    ctf_md_list = ctf_md.get(ts_id, None) if ctf_md else None
-                    # Read the tilt-images table
-                    ti_list = []
-                    tilt_images_table_name = self._get_ts_obj_tbl_name(ts_id)
-                    query = f'SELECT {ti_sql_fields} FROM "{tilt_images_table_name}"'
-                    cursor.execute(query)  # execute the query
-                    for row in cursor.fetchall():
+                with Stage(MODEL_BUILD, items=len(rows) + 1):
+                    translations = self._gen_translation_transforms(tr_matrices)
+                    rotations = self._gen_rotation_transforms(tr_matrices)
+                    ti_ctf_list = self._match_ctf_md(
+                        ti_extractor.column(rows, ACQUISITION_ORDER), ctf_series
+                    )
+                    for row, translation, rotation, ti_ctf in zip(
+                        rows, translations, rotations, ti_ctf_list
+                    ):
                         ti = self._ti_from_sqlite_row(
-                            row, ts_class_dict, coordinate_systems
+                            get_ti_values(row),
+                            coordinate_systems,
+                            [translation, rotation],
                         )
-                        self._add_ctf_md(ti, i, ctf_md_list)
+                        ti.ctf_metadata = ti_ctf
                         ti_list.append(ti)
 
                     # Tilt-series
-                    ts = TiltSeries(
+                    tilt_series = TiltSeries(
                         path=ti_list[-1].path,
                         ts_id=ts_id,
                         # pixel_size=pixel_size,
-                        ctf_corrected=bool(ctf_corrected_list[i]),
+                        ctf_corrected=bool(ctf_corrected),
                         images=ti_list,
                     )
-                    tilt_series_list.append(ts)
-
-                if out_directory:
-                    write_ts_set_yaml(tilt_series_list, Path(out_directory))
-                return tilt_series_list
-        return None
+                yield tilt_series
 
     def _ti_from_sqlite_row(
         self,
-        row: sqlite3.Row,
-        ts_class_dict: Dict[str, str],
+        ti_values: Tuple[Any, ...],
         coord_system: CoordinateSystem,
+        coord_transforms: List[CoordinateTransformation],
     ) -> TiltImage:
+        """Creates a tilt-image from the values of TI_VALUES_FIELDS of a row."""
+        (
+            ts_id,
+            ts_file,
+            index,
+            acq_order,
+            tilt_angle,
+            accum_dose,
+            odd_even_fn,
+        ) = ti_values
         # Read image info
-        ts_file = get_row_value(row, ts_class_dict, FILE_NAME)
         ts_fn = self.scipion_prj_path / ts_file if ts_file else self.scipion_prj_path
-        img_info = get_mrc_info(ts_fn)
+        img_info = get_mrc_info_cached(ts_fn)
         # Get the odd / even filenames
         even_fn, odd_fn = None, None
-        odd_even_fn = get_row_value(row, ts_class_dict, ODD_EVEN_FN)
         if odd_even_fn:
             even_fn, odd_fn = sorted(odd_even_fn.split(","))
-        # Get the transformation matrix
-        tr_matrix_str = get_row_value(row, ts_class_dict, TRANSFORMATION_MATRIX)
-        tr_matrix = np.array(ast.literal_eval(tr_matrix_str))
 
         # Create the tilt-image
         return TiltImage(
-            ts_id=get_row_value(row, ts_class_dict, TS_ID),
+            ts_id=ts_id,
             path=str(ts_fn),
             even_path=even_fn,
             odd_path=odd_fn,
-            acquisition_order=get_row_value(row, ts_class_dict, ACQUISITION_ORDER),
-            section=get_row_value(row, ts_class_dict, INDEX),
-            nominal_tilt_angle=get_row_value(row, ts_class_dict, TILT_ANGLE),
-            accumulated_dose=get_row_value(row, ts_class_dict, ACCUMULATED_DOSE),
+            acquisition_order=acq_order,
+            section=index,
+            nominal_tilt_angle=tilt_angle,
+            accumulated_dose=accum_dose,
             width=img_info.size_x,
             height=img_info.size_y,
             coordinate_systems=[coord_system],
-            coordinate_transformations=[
-                self._gen_translation_transform(tr_matrix),
-                self._gen_rotation_transform(tr_matrix),
-            ],
+            coordinate_transformations=coord_transforms,
         )
 
     @staticmethod
@@ -168,37 +422,71 @@ class ScipionSetOfTiltSeries(BaseConverter):
     def _get_ts_obj_tbl_name(ts_id: str) -> str:
         return f"{ts_id}_{OBJECTS_TBL}"
 
+    @classmethod
+    def _gen_translation_transform(
+        cls, transformation_matrix: np.ndarray
+    ) -> Translation:
+        return cls._gen_translation_transforms(transformation_matrix[np.newaxis])[0]
+
     @staticmethod
-    def _gen_translation_transform(transformation_matrix: np.ndarray) -> Translation:
-        translation: Vector3D = [
-            transformation_matrix[0, 2],
-            transformation_matrix[1, 2],
-            0,
-        ]
-        return Translation(
-            translation=translation,
+    def _gen_translation_transforms(
+        transformation_matrices: np.ndarray,
+    ) -> List[Translation]:
+        """Generates the translations of a batch of tilt-images.
+        :param transformation_matrices: array of shape (N, 3, 3) containing the
+        Scipion transformation matrices, e.g. as returned by parse_matrices.
+        """
+        transformation_matrices = check_batch(
+            transformation_matrices, (3, 3), "transformation matrices"
+        )
+        translations = np.zeros((len(transformation_matrices), 3))
+        translations[:, :2] = transformation_matrices[:, :2, 2]
+        return build_models(
+            Translation,
+            "translation",
+            translations.tolist(),
             name="Scipion stored translation. Shifts in pixels.",
             input="Tilt-image",
             output="Tilt-image",
         )
 
-    @staticmethod
+    @classmethod
     def _gen_rotation_transform(
+        cls,
         transformation_matrix: np.ndarray,
     ) -> CoordinateTransformation:
-        row1: Vector3D = transformation_matrix[0, :].tolist()
-        row1[-1] = 0
-        row2: Vector3D = transformation_matrix[1, :].tolist()
-        row2[-1] = 0
-        row3: Vector3D = [0, 0, 1]
-        affine_matrix: Matrix3x3 = [row1, row2, row3]
-        return Affine(
-            affine=affine_matrix,
+        return cls._gen_rotation_transforms(transformation_matrix[np.newaxis])[0]
+
+    @staticmethod
+    def _gen_rotation_transforms(
+        transformation_matrices: np.ndarray,
+    ) -> List[CoordinateTransformation]:
+        """Generates the rotations of a batch of tilt-images.
+        :param transformation_matrices: array of shape (N, 3, 3) containing the
+        Scipion transformation matrices, e.g. as returned by parse_matrices.
+        """
+        transformation_matrices = check_batch(
+            transformation_matrices, (3, 3), "transformation matrices"
+        )
+        affine_matrices = np.zeros((len(transformation_matrices), 3, 3))
+        affine_matrices[:, :2, :2] = transformation_matrices[:, :2, :2]
+        affine_matrices[:, 2, 2] = 1
+        return build_models(
+            Affine,
+            "affine",
+            affine_matrices.tolist(),
             name="Scipion stored rotation",
             input="Tilt-image",
             output="Tilt-image",
         )
 
     @staticmethod
-    def _add_ctf_md(ti: TiltImage, index: int, ctf_md: List[CTFMetadata] | None = None):
-        ti.ctf_metadata = ctf_md[index] if ctf_md else None
+    def _match_ctf_md(
+        acquisition_orders: List[int | None],
+        ctf_md: Sequence[CTFMetadata] | None = None,
+    ) -> List[CTFMetadata | None]:
+        """Returns the CTFMetadata of each tilt-image of a tilt-series, matched by
+        acquisition order. None for all of them if there is no CTF."""
+        if not ctf_md:
+            return [None] * len(acquisition_orders)
+        return CTFSeries.from_ctf_list(ctf_md).match(acquisition_orders)
@@ -1,10 +1,11 @@
+import logging
 import os
+import sqlite3
 from os.path import basename
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
-from cets_data_model.models.models import Tomogram
-from cets_data_model.utils.image_utils import get_mrc_info
+from cets_data_model.models.models import Tomogram, Particle3DSet
 from scipion.constants import (
     TOMOGRAM_FIELDS,
     OBJECTS_TBL,
@@ -14,89 +15,374 @@ from scipion.constants import (
     CTF_CORRECTED,
 )
 from scipion.converters.base_converter import BaseConverter
+from scipion.converters.base_particles_converter import BaseParticlesConverter
 from scipion.converters.coodinates3d import ScipionSetOfCoordinates3D
 from scipion.converters.subtomograms import ScipionSetOfSubtomogras
-from scipion.utils.utils import write_tomo_set_yaml
-from scipion.utils.utils_sqlite import connect_db, map_classes_table, get_row_value
+from scipion.utils.utils import write_tomo_set_yaml, get_tomo_yaml_file
+from scipion.utils.utils_cache import ConversionCache
+from scipion.utils.utils_filters import (
+    ConversionFilter,
+    get_id_condition,
+    get_where_clause,
+)
+from scipion.utils.utils_incremental import ConversionState, Signature
+from scipion.utils.utils_instrumentation import Stage, MODEL_BUILD
+from scipion.utils.utils_mrc import get_mrc_info_cached, get_mrc_infos_cached
+from scipion.utils.utils_sqlite import (
+    connect_db,
+    map_classes_table,
+    get_tuple_cursor,
+    fetch_all,
+    RowExtractor,
+)
+
+
+logger = logging.getLogger(__name__)
 
 
 class ScipionSetOfTomograms(BaseConverter):
+    # Fields of each tomogram row passed to _tomo_from_sqlite_row, in order
+    TOMO_VALUES_FIELDS = (TS_ID, FILE_NAME, CTF_CORRECTED, ODD_EVEN_TOMOS_FN)
+
     def scipion_to_cets(
         self,
-        particles_db_path: Optional[os.PathLike] = None,
-        out_directory: Optional[os.PathLike] = None,
+        particles_db_path: Optional[os.PathLike | str] = None,
+        out_directory: Optional[os.PathLike | str] = None,
+        tomo_ids: Optional[Iterable[str]] = None,
+        incremental: bool = False,
+        filters: Optional[ConversionFilter] = None,
+        cache: Optional[ConversionCache] = None,
+        compact_yaml: bool = False,
     ) -> List[Tomogram] | None:
         """Converts a set of tomograms from Scipion into CETS metadata.
 
         :param particles_db_path: path of the sqlite file containing the
         coordinates picked or the subtomograms.
-        :type particles_db_path: os.PathLike, optional. Defaults to None.
+        :type particles_db_path: os.PathLike or str, optional. Defaults to None.
 
         :param out_directory: name of the directory in which the tilt-series
         .yaml files (one per tilt-series) will be written.
-        :type out_directory: os.PathLike, optional. Defaults to None.
+        :type out_directory: os.PathLike or str, optional. Defaults to None.
+
+        :param tomo_ids: identifiers of the tomograms to be converted. If not
+        provided, all the tomograms of the set are converted.
+        :type tomo_ids: Iterable[str], optional. Defaults to None.
+
+        :param incremental: if True, only the tomograms that are new or whose
+        particles have changed since the last incremental conversion into
+        out_directory are converted and written, so a set that Scipion is still
+        streaming can be kept up to date cheaply. The state is kept in a file in
+        out_directory, which is required.
+        :type incremental: bool, optional. Defaults to False.
+
+        :param filters: selection of the tomograms (ids, patterns, min number of
+        particles) and max number of particles per tomogram, pushed into the
+        queries.
+        :type filters: ConversionFilter, optional. Defaults to None.
+
+        :param cache: on-disk cache of the conversions. If the same tomograms
+        have already been converted with the same parameters and neither the
+        sqlite files nor the MRC files referenced have changed, the cached
+        result is returned instead of converting them again.
+        :type cache: ConversionCache, optional. Defaults to None.
+
+        :param compact_yaml: if True, the .yaml files are written in compact YAML,
+        with the repeated blocks written once and referenced. See write_obj_yaml.
+        :type compact_yaml: bool, optional. Defaults to False.
         """
-        are_coordinates = True if "coord" in basename(str(particles_db_path)) else False
-        particles_reader = None
-        coordinates3d_set = None
-        if particles_db_path:
-            particles_reader = (
-                ScipionSetOfCoordinates3D(particles_db_path)
-                if are_coordinates
-                else ScipionSetOfSubtomogras(particles_db_path)
+        particles_reader = self._get_particles_reader(particles_db_path)
+        tomo_ids = self._select_by_n_particles(particles_reader, tomo_ids, filters)
+        state, signatures = None, {}
+        state_key = self._get_state_key(particles_reader)
+        if incremental:
+            if not out_directory:
+                raise ValueError("An output directory is required in incremental mode")
+            state = ConversionState.load(out_directory)
+            signatures = self.get_signatures(
+                particles_reader, tomo_ids=tomo_ids, filters=filters
+            )
+            tomo_ids = state.get_changed(state_key, signatures)
+            logger.info("%d new or changed tomograms to be converted.", len(tomo_ids))
+            if not tomo_ids:
+                return []
+
+        def convert() -> List[Tomogram] | None:
+            return self._convert(particles_reader, tomo_ids=tomo_ids, filters=filters)
+
+        if cache is None:
+            tomo_list = convert()
+        else:
+            key = cache.get_key(
+                f"{self.__class__.__name__}.scipion_to_cets",
+                [self.db_path, particles_reader.db_path if particles_reader else None],
+                tomo_ids=tomo_ids,
+                filters=filters,
+            )
+            tomo_list = cache.get_or_convert(key, convert)
+        if tomo_list is not None and out_directory:
+            out_directory = Path(out_directory)
+            written = set(
+                write_tomo_set_yaml(tomo_list, out_directory, compact=compact_yaml)
             )
+            if state is not None:
+                state.update(
+                    state_key,
+                    signatures,
+                    obj_ids=[
+                        tomo.tomo_id
+                        for tomo in tomo_list
+                        if get_tomo_yaml_file(tomo.tomo_id, out_directory) in written
+                    ],
+                )
+                state.save()
+        return tomo_list
+
+    def _convert(
+        self,
+        particles_reader: BaseParticlesConverter | None = None,
+        tomo_ids: Optional[Iterable[str]] = None,
+        filters: Optional[ConversionFilter] = None,
+    ) -> List[Tomogram] | None:
+        db_connection = connect_db(self.db_path)
+        if db_connection is None:
+            return None
+        with db_connection as conn:
+            tomo_extractor, rows = self._read_tomo_rows(
+                conn, tomo_ids=tomo_ids, filters=filters
+            )
+            tomo_ids = tomo_extractor.column(rows, TS_ID)
+            get_tomo_values = tomo_extractor.getter(*self.TOMO_VALUES_FIELDS)
+            # Read all the particles at once, grouped by tomogram
+            particles_dict = (
+                particles_reader.scipion_to_cets_by_tomo(tomo_ids, filters=filters)
+                if particles_reader
+                else None
+            )
+            tomo_values = [get_tomo_values(row) for row in rows]
+            img_infos = self._read_tomo_headers(tomo_values)
+            tomo_list = []
+            for tomo_id, values, img_info in zip(tomo_ids, tomo_values, img_infos):
+                # Manage the coordinates
+                coordinates3d_set = (
+                    particles_dict.get(tomo_id, None) if particles_dict else None
+                )
+                tomo_list.append(
+                    self._tomo_from_sqlite_row(values, coordinates3d_set, img_info)
+                )
+            return tomo_list
+
+    def get_signatures(
+        self,
+        particles_reader: BaseParticlesConverter | None = None,
+        tomo_ids: Optional[Iterable[str]] = None,
+        filters: Optional[ConversionFilter] = None,
+    ) -> Dict[str, Signature]:
+        """Returns the signature of each tomogram of the set: its row id and,
+        if a particles reader is provided, the number of particles and the max
+        particle row id of the tomogram.
+
+        :param particles_reader: converter of the particles of the tomograms.
+        :param tomo_ids: identifiers of the tomograms. If not provided, all the
+        tomograms of the set are considered.
+        :param filters: selection of the tomograms and particles. As they change
+        the result, they are part of the signature.
+        """
+        conn = connect_db(self.db_path)
+        if conn is None:
+            return {}
+        tomo_set_class_dict = map_classes_table(conn)
+        tomo_id_col_name = tomo_set_class_dict[TS_ID]
+        where, params = get_where_clause(
+            get_id_condition(tomo_id_col_name, tomo_ids, filters)
+        )
+        tomo_rows = fetch_all(
+            get_tuple_cursor(conn),
+            f'SELECT id, "{tomo_id_col_name}" FROM "{OBJECTS_TBL}"{where}',
+            params,
+        )
+        particle_signatures = (
+            particles_reader.get_tomo_signatures() if particles_reader else {}
+        )
+        filters_signature = filters.get_signature() if filters else []
+        return {
+            tomo_id: [
+                obj_id,
+                *particle_signatures.get(tomo_id, [0, None]),
+                *filters_signature,
+            ]
+            for obj_id, tomo_id in tomo_rows
+        }
+
+    def _get_state_key(
+        self, particles_reader: BaseParticlesConverter | None = None
+    ) -> str:
+        # The same tomograms may be converted with different particle sets
+        if particles_reader is None:
+            return str(self.db_path)
+        return f"{self.db_path}::{particles_reader.db_path}"
+
+    def iter_cets(
+        self,
+        particles_db_path: Optional[os.PathLike | str] = None,
+        tomo_ids: Optional[Iterable[str]] = None,
+        filters: Optional[ConversionFilter] = None,
+    ) -> Iterator[Tomogram]:
+        """Converts a set of tomograms from Scipion into CETS metadata, yielding
+        one tomogram (with its particles) at a time, so only the particles of one
+        tomogram are kept in memory. The tomograms are yielded sorted by their
+        identifier. The result can be written directly with write_tomo_set_yaml.
+
+        :param particles_db_path: path of the sqlite file containing the
+        coordinates picked or the subtomograms.
+        :type particles_db_path: os.PathLike or str, optional. Defaults to None.
+
+        :param tomo_ids: identifiers of the tomograms to be converted. If not
+        provided, all the tomograms of the set are converted.
+        :type tomo_ids: Iterable[str], optional. Defaults to None.
+
+        :param filters: selection of the tomograms and particles. See
+        scipion_to_cets.
+        :type filters: ConversionFilter, optional. Defaults to None.
+        """
+        particles_reader = self._get_particles_reader(particles_db_path)
+        tomo_ids = self._select_by_n_particles(particles_reader, tomo_ids, filters)
         db_connection = connect_db(self.db_path)
-        if db_connection is not None:
-            with db_connection as conn:
-                # Map the table Classes and get some values from the table Objects
-                tomo_set_class_dict = map_classes_table(conn)
-
-                # Sqlite fields of the data to be read from each tomogram
-                tomo_sql_fields = self._get_sql_fields(
-                    tomo_set_class_dict, TOMOGRAM_FIELDS
+        if db_connection is None:
+            return
+        with db_connection as conn:
+            tomo_extractor, rows = self._read_tomo_rows(
+                conn, sort_by_id=True, tomo_ids=tomo_ids, filters=filters
+            )
+            tomo_ids = tomo_extractor.column(rows, TS_ID)
+            get_tomo_values = tomo_extractor.getter(*self.TOMO_VALUES_FIELDS)
+            # Particles streamed in the same order as the tomograms
+            particle_sets = (
+                particles_reader.iter_cets_by_tomo(tomo_ids, filters=filters)
+                if particles_reader
+                else None
+            )
+            tomo_values = [get_tomo_values(row) for row in rows]
+            img_infos = self._read_tomo_headers(tomo_values)
+            for values, img_info in zip(tomo_values, img_infos):
+                coordinates3d_set = (
+                    next(particle_sets)[1] if particle_sets is not None else None
                 )
+                yield self._tomo_from_sqlite_row(values, coordinates3d_set, img_info)
 
-                cursor = conn.cursor()
-                query = f'SELECT {tomo_sql_fields} FROM "{OBJECTS_TBL}"'
-                cursor.execute(query)  # execute the query
-                tomo_list = []
-                for row in cursor:
-                    tomo_id = get_row_value(row, tomo_set_class_dict, TS_ID)
-                    # Read tomogram info
-                    tomo_file = get_row_value(row, tomo_set_class_dict, FILE_NAME)
-                    tomo_fn = (
-                        self.scipion_prj_path / tomo_file
-                        if tomo_file
-                        else self.scipion_prj_path
-                    )
-                    img_info = get_mrc_info(tomo_fn)
-                    # Get the odd / even filenames
-                    even_fn, odd_fn = None, None
-                    odd_even_fn = get_row_value(
-                        row, tomo_set_class_dict, ODD_EVEN_TOMOS_FN
-                    )
-                    if odd_even_fn:
-                        even_fn, odd_fn = sorted(odd_even_fn.split(","))
-                    # Manage the coordinates
-                    if particles_reader:
-                        coordinates3d_set = particles_reader.scipion_to_cets(tomo_id)
-                    tomo = Tomogram(
-                        tomo_id=tomo_id,
-                        path=str(tomo_fn),
-                        even_path=even_fn,
-                        odd_path=odd_fn,
-                        width=img_info.size_x,
-                        height=img_info.size_y,
-                        depth=img_info.size_z,
-                        coordinate_systems=None,  # TODO: what about this in tomograms?
-                        coordinate_transformations=None,
-                        ctf_corrected=get_row_value(
-                            row, tomo_set_class_dict, CTF_CORRECTED
-                        ),
-                        particle_set=coordinates3d_set,
-                    )
-                    tomo_list.append(tomo)
-                if out_directory:
-                    write_tomo_set_yaml(tomo_list, Path(out_directory))
-                return tomo_list
-        return None
+    @staticmethod
+    def _select_by_n_particles(
+        particles_reader: BaseParticlesConverter | None,
+        tomo_ids: Optional[Iterable[str]] = None,
+        filters: Optional[ConversionFilter] = None,
+    ) -> Optional[List[str]]:
+        """Restricts the tomograms to the ones with at least min_particles
+        particles, if the filters set it. The particles are counted in a single
+        aggregated query on the particles set, which only lists the tomograms
+        with particles, so a min_particles lower than 1 selects all of them."""
+        if tomo_ids is not None:
+            tomo_ids = list(tomo_ids)
+        if filters is None or filters.min_particles is None:
+            return tomo_ids
+        if filters.min_particles <= 0:
+            return tomo_ids
+        if particles_reader is None:
+            raise ValueError(
+                "A set of particles is required to filter by number of particles"
+            )
+        selected = {
+            tomo_id
+            for tomo_id, (
+                n_particles,
+                _,
+            ) in particles_reader.get_tomo_signatures().items()
+            if n_particles >= filters.min_particles
+        }
+        if tomo_ids is None:
+            return sorted(selected)
+        return [tomo_id for tomo_id in tomo_ids if tomo_id in selected]
+
+    @staticmethod
+    def _get_particles_reader(
+        particles_db_path: Optional[os.PathLike | str] = None,
+    ) -> BaseParticlesConverter | None:
+        if not particles_db_path:
+            return None
+        are_coordinates = True if "coord" in basename(str(particles_db_path)) else False
+        return (
+            ScipionSetOfCoordinates3D(particles_db_path)
+            if are_coordinates
+            else ScipionSetOfSubtomogras(particles_db_path)
+        )
+
+    def _read_tomo_rows(
+        self,
+        conn: sqlite3.Connection,
+        sort_by_id: bool = False,
+        tomo_ids: Optional[Iterable[str]] = None,
+        filters: Optional[ConversionFilter] = None,
+    ) -> Tuple[RowExtractor, List[Tuple[Any, ...]]]:
+        # Map the table Classes and get some values from the table Objects
+        tomo_set_class_dict = map_classes_table(conn)
+
+        # Positional extractor of the data to be read from each tomogram
+        tomo_extractor = RowExtractor(tomo_set_class_dict, TOMOGRAM_FIELDS)
+
+        cursor = get_tuple_cursor(conn)
+        tomo_id_col_name = tomo_set_class_dict[TS_ID]
+        where, params = get_where_clause(
+            get_id_condition(tomo_id_col_name, tomo_ids, filters)
+        )
+        query = f'SELECT {tomo_extractor.sql_fields} FROM "{OBJECTS_TBL}"{where}'
+        if sort_by_id:
+            query += f' ORDER BY "{tomo_id_col_name}"'
+        return tomo_extractor, fetch_all(cursor, query, params)  # execute the query
+
+    def _read_tomo_headers(self, tomo_values: List[Tuple[Any, ...]]) -> List[Any]:
+        """Reads concurrently the MRC headers of the tomograms of several rows,
+        returned in the same order."""
+        return get_mrc_infos_cached(
+            self._get_tomo_path(values[1]) for values in tomo_values
+        )
+
+    def _get_tomo_path(self, tomo_file: str | None) -> Path:
+        return self.scipion_prj_path / tomo_file if tomo_file else self.scipion_prj_path
+
+    def _tomo_from_sqlite_row(
+        self,
+        tomo_values: Tuple[Any, ...],
+        coordinates3d_set: Particle3DSet | None,
+        img_info: Any = None,
+    ) -> Tomogram:
+        """Creates a tomogram from the values of TOMO_VALUES_FIELDS of a row and,
+        if already read, the information of its MRC header."""
+        with Stage(MODEL_BUILD, items=1):
+            return self._gen_tomogram(tomo_values, coordinates3d_set, img_info)
+
+    def _gen_tomogram(
+        self,
+        tomo_values: Tuple[Any, ...],
+        coordinates3d_set: Particle3DSet | None,
+        img_info: Any = None,
+    ) -> Tomogram:
+        tomo_id, tomo_file, ctf_corrected, odd_even_fn = tomo_values
+        # Read tomogram info
+        tomo_fn = self._get_tomo_path(tomo_file)
+        if img_info is None:
+            img_info = get_mrc_info_cached(tomo_fn)
+        # Get the odd / even filenames
+        even_fn, odd_fn = None, None
+        if odd_even_fn:
+            even_fn, odd_fn = sorted(odd_even_fn.split(","))
+        return Tomogram(
+            tomo_id=tomo_id,
+            path=str(tomo_fn),
+            even_path=even_fn,
+            odd_path=odd_fn,
+            width=img_info.size_x,
+            height=img_info.size_y,
+            depth=img_info.size_z,
+            coordinate_systems=None,  # TODO: what about this in tomograms?
+            coordinate_transformations=None,
+            ctf_corrected=ctf_corrected,
+            particle_set=coordinates3d_set,
+        )
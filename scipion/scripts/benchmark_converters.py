@@ -0,0 +1,394 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, NamedTuple, Sequence
+
+from scipion.constants import (
+    SET_OF_TILT_SERIES,
+    SET_OF_CTF_TOMO_SERIES,
+    SET_OF_TOMOGRAMS,
+    SET_OF_COORDINATES_3D,
+    SET_OF_SUBTOMOGRAMS,
+)
+from scipion.converters.coodinates3d import ScipionSetOfCoordinates3D
+from scipion.converters.ctf_set import ScipionSetOfCtf
+from scipion.converters.subtomograms import ScipionSetOfSubtomogras
+from scipion.converters.tilt_series_set import ScipionSetOfTiltSeries
+from scipion.converters.tomograms_set import ScipionSetOfTomograms
+from scipion.scripts.convert_project import convert_project
+from scipion.utils.utils import write_ts_set_yaml, write_particle_sets_yaml
+from scipion.utils.utils_instrumentation import REPORT, get_peak_rss_mb
+from scipion.utils.utils_synthetic import SyntheticProject, write_synthetic_project
+
+# Project sizes at which the converters are benchmarked
+BENCHMARK_SCALES: Dict[str, SyntheticProject] = {
+    "small": SyntheticProject(n_tilt_series=10, n_tilt_images=41, n_particles=100),
+    "medium": SyntheticProject(
+        n_tilt_series=100, n_tilt_images=41, n_tomograms=50, n_particles=1000
+    ),
+    "large": SyntheticProject(
+        n_tilt_series=500, n_tilt_images=61, n_tomograms=100, n_particles=2000
+    ),
+}
+DEFAULT_SCALES = ["small", "medium"]
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 10.0  # %
+
+# Sqlite file of each set of the synthetic project
+DbPaths = Dict[str, Path]
+
+
+# Benchmark cases. Each one converts (and writes, if out_directory is used) a
+# set and returns the number of items processed, used to compute the throughput
+def _ctf_to_cets(db_paths: DbPaths, out_directory: Path) -> int:
+    ctf_md = ScipionSetOfCtf(db_paths[SET_OF_CTF_TOMO_SERIES]).scipion_to_cets()
+    return sum(len(ctf_list) for ctf_list in (ctf_md or {}).values())
+
+
+def _ctf_to_ctf_series(db_paths: DbPaths, out_directory: Path) -> int:
+    ctf_reader = ScipionSetOfCtf(db_paths[SET_OF_CTF_TOMO_SERIES])
+    return sum(len(ctf_series) for _, ctf_series in ctf_reader.iter_ctf_series())
+
+
+def _ts_to_cets(db_paths: DbPaths, out_directory: Path) -> int:
+    ctf_md = ScipionSetOfCtf(db_paths[SET_OF_CTF_TOMO_SERIES]).scipion_to_cets()
+    ts_list = ScipionSetOfTiltSeries(db_paths[SET_OF_TILT_SERIES]).scipion_to_cets(
+        ctf_md=ctf_md
+    )
+    return sum(len(ts.images) for ts in ts_list or [])
+
+
+def _ts_to_cets_fused_ctf(db_paths: DbPaths, out_directory: Path) -> int:
+    ts_reader = ScipionSetOfTiltSeries(db_paths[SET_OF_TILT_SERIES])
+    return sum(
+        len(ts.images)
+        for ts in ts_reader.iter_cets(ctf_db_path=db_paths[SET_OF_CTF_TOMO_SERIES])
+    )
+
+
+def _ts_to_yaml(db_paths: DbPaths, out_directory: Path) -> int:
+    ts_reader = ScipionSetOfTiltSeries(db_paths[SET_OF_TILT_SERIES])
+    ts_iter = ts_reader.iter_cets(ctf_db_path=db_paths[SET_OF_CTF_TOMO_SERIES])
+    return len(write_ts_set_yaml(ts_iter, out_directory))
+
+
+def _tomograms_to_cets(db_paths: DbPaths, out_directory: Path) -> int:
+    tomo_list = ScipionSetOfTomograms(db_paths[SET_OF_TOMOGRAMS]).scipion_to_cets(
+        particles_db_path=db_paths[SET_OF_COORDINATES_3D]
+    )
+    return sum(len(tomo.particle_set.particles) for tomo in tomo_list or [])
+
+
+def _coordinates_to_cets(db_paths: DbPaths, out_directory: Path) -> int:
+    particle_sets = ScipionSetOfCoordinates3D(
+        db_paths[SET_OF_COORDINATES_3D]
+    ).scipion_to_cets_by_tomo()
+    return sum(len(coords.particles) for coords in (particle_sets or {}).values())
+
+
+def _subtomograms_to_cets(db_paths: DbPaths, out_directory: Path) -> int:
+    particle_sets = ScipionSetOfSubtomogras(
+        db_paths[SET_OF_SUBTOMOGRAMS]
+    ).scipion_to_cets_by_tomo()
+    return sum(len(coords.particles) for coords in (particle_sets or {}).values())
+
+
+def _coordinates_to_table(db_paths: DbPaths, out_directory: Path) -> int:
+    coords_reader = ScipionSetOfCoordinates3D(db_paths[SET_OF_COORDINATES_3D])
+    table = coords_reader.scipion_to_table()
+    return len(table) if table is not None else 0
+
+
+def _subtomograms_to_yaml(db_paths: DbPaths, out_directory: Path) -> int:
+    subtomos_reader = ScipionSetOfSubtomogras(db_paths[SET_OF_SUBTOMOGRAMS])
+    return len(write_particle_sets_yaml(subtomos_reader.iter_cets(), out_directory))
+
+
+def _project_to_yaml(db_paths: DbPaths, out_directory: Path) -> int:
+    project_path = db_paths[SET_OF_TILT_SERIES].parents[2]
+    return sum(
+        n_converted for _, n_converted in convert_project(project_path, out_directory)
+    )
+
+
+BENCHMARK_CASES: Dict[str, Callable[[DbPaths, Path], int]] = {
+    "ctf.scipion_to_cets": _ctf_to_cets,
+    "ctf.iter_ctf_series": _ctf_to_ctf_series,
+    "tilt_series.scipion_to_cets[ctf_md]": _ts_to_cets,
+    "tilt_series.iter_cets[ctf_db_path]": _ts_to_cets_fused_ctf,
+    "tilt_series.write_yaml": _ts_to_yaml,
+    "tomograms.scipion_to_cets[coordinates]": _tomograms_to_cets,
+    "coordinates.scipion_to_cets_by_tomo": _coordinates_to_cets,
+    "coordinates.scipion_to_table": _coordinates_to_table,
+    "subtomograms.scipion_to_cets_by_tomo": _subtomograms_to_cets,
+    "subtomograms.write_yaml": _subtomograms_to_yaml,
+    "project.write_yaml": _project_to_yaml,
+}
+
+
+class BenchmarkResult(NamedTuple):
+    """Result of a benchmark case at a scale, over several runs.
+
+    :param scale: name of the scale, see BENCHMARK_SCALES.
+    :param case: name of the case, see BENCHMARK_CASES.
+    :param n_items: number of items (tilt-images, particles, files...) processed.
+    :param best_time: shortest wall time of the runs, in seconds.
+    :param median_time: median wall time of the runs, in seconds.
+    :param peak_rss_mb: highest peak resident memory of the runs, in MiB. None
+    if it cannot be measured, see get_peak_rss_mb.
+    :param delta_rss_mb: increase of the peak resident memory over the memory
+    used before running the case (interpreter and imported modules), in MiB.
+    None if it cannot be measured.
+    :param stages: timings and counters of each stage of the fastest run, see
+    ConversionReport.
+    """
+
+    scale: str
+    case: str
+    n_items: int
+    best_time: float
+    median_time: float
+    peak_rss_mb: float | None
+    delta_rss_mb: float | None
+    stages: Dict[str, Any] | None = None
+
+    @property
+    def items_per_second(self) -> float:
+        return self.n_items / self.best_time if self.best_time else 0.0
+
+
+def run_benchmarks(
+    work_directory: Path,
+    scales: Sequence[str] = DEFAULT_SCALES,
+    cases: Sequence[str] | None = None,
+    repeat: int = DEFAULT_REPEAT,
+) -> List[BenchmarkResult]:
+    """Generates a synthetic project per scale and runs each benchmark case on
+    it. Every run is done in a new process, so the peak memory of a case is not
+    hidden by the previous ones and the caches (e.g. of MRC headers) are cold,
+    as in a real conversion.
+
+    :param work_directory: directory in which the projects and the output
+    files are written.
+    :param scales: names of the scales, see BENCHMARK_SCALES.
+    :param cases: names of the cases, see BENCHMARK_CASES. All if None.
+    :param repeat: number of runs of each case.
+    """
+    cases = list(BENCHMARK_CASES) if cases is None else list(cases)
+    for name in cases:
+        if name not in BENCHMARK_CASES:
+            raise ValueError(f"Unknown benchmark case: {name}")
+    spawn_context = multiprocessing.get_context("spawn")
+    results = []
+    for scale in scales:
+        print(f"Generating the {scale} project: {BENCHMARK_SCALES[scale]}")
+        db_paths = write_synthetic_project(
+            work_directory / scale / "project", BENCHMARK_SCALES[scale]
+        )
+        for name in cases:
+            runs = []
+            for _ in range(repeat):
+                out_directory = work_directory / scale / "output"
+                shutil.rmtree(out_directory, ignore_errors=True)
+                out_directory.mkdir(parents=True)
+                with ProcessPoolExecutor(1, mp_context=spawn_context) as executor:
+                    runs.append(
+                        executor.submit(
+                            _run_case, name, db_paths, out_directory
+                        ).result()
+                    )
+            times = [run.time for run in runs]
+            # Empty if the memory cannot be measured
+            peaks = [run.peak_rss_mb for run in runs if run.peak_rss_mb is not None]
+            deltas = [
+                run.peak_rss_mb - run.start_rss_mb
+                for run in runs
+                if run.peak_rss_mb is not None and run.start_rss_mb is not None
+            ]
+            result = BenchmarkResult(
+                scale=scale,
+                case=name,
+                n_items=runs[0].n_items,
+                best_time=min(times),
+                median_time=statistics.median(times),
+                peak_rss_mb=max(peaks, default=None),
+                delta_rss_mb=max(deltas, default=None),
+                stages=runs[times.index(min(times))].stages,
+            )
+            print(_format_result(result))
+            results.append(result)
+    return results
+
+
+class _CaseRun(NamedTuple):
+    n_items: int
+    time: float
+    peak_rss_mb: float | None  # at the end of the run
+    start_rss_mb: float | None  # before the run
+    stages: Dict[str, Any]
+
+
+def _run_case(name: str, db_paths: DbPaths, out_directory: Path) -> _CaseRun:
+    """Runs a case in the current (new) process."""
+    start_rss_mb = get_peak_rss_mb()
+    REPORT.reset()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        n_items = BENCHMARK_CASES[name](db_paths, out_directory)
+        run_time = time.perf_counter() - start
+    return _CaseRun(
+        n_items, run_time, get_peak_rss_mb(), start_rss_mb, REPORT.to_dict()["stages"]
+    )
+
+
+def compare_results(
+    results: Sequence[BenchmarkResult],
+    baseline: Sequence[BenchmarkResult],
+    threshold: float = DEFAULT_THRESHOLD,
+) -> List[str]:
+    """Compares the results with the ones of a baseline run, printing the
+    relative change of the time and the memory of each case. Returns the
+    regressions, i.e. the cases that are slower or use more memory than the
+    baseline by more than threshold %."""
+    baseline_dict = {(result.scale, result.case): result for result in baseline}
+    regressions = []
+    for result in results:
+        base = baseline_dict.get((result.scale, result.case), None)
+        if base is None:
+            continue
+        time_change = _get_change(result.best_time, base.best_time)
+        rss_change = (
+            _get_change(result.delta_rss_mb, base.delta_rss_mb)
+            if result.delta_rss_mb is not None and base.delta_rss_mb is not None
+            else 0.0
+        )
+        message = (
+            f"{result.scale:>8} {result.case:<40} time {time_change:+7.1f}% "
+            f"memory {rss_change:+7.1f}%"
+        )
+        if time_change > threshold or rss_change > threshold:
+            message += "  <- REGRESSION"
+            regressions.append(message)
+        print(message)
+    return regressions
+
+
+def _get_change(value: float, base_value: float) -> float:
+    return 100.0 * (value - base_value) / base_value if base_value else 0.0
+
+
+def save_results(results: Sequence[BenchmarkResult], json_file: Path) -> None:
+    content = {
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scales": {
+            scale: BENCHMARK_SCALES[scale]._asdict() for scale in BENCHMARK_SCALES
+        },
+        "results": [result._asdict() for result in results],
+    }
+    with open(json_file, "w") as f:
+        json.dump(content, f, indent=1)
+
+
+def load_results(json_file: Path) -> List[BenchmarkResult]:
+    with open(json_file) as f:
+        content = json.load(f)
+    return [BenchmarkResult(**result) for result in content["results"]]
+
+
+def _format_result(result: BenchmarkResult) -> str:
+    rss = (
+        f"peak RSS {result.peak_rss_mb:8.1f} MiB (+{result.delta_rss_mb:.1f})"
+        if result.peak_rss_mb is not None and result.delta_rss_mb is not None
+        else "peak RSS unavailable"
+    )
+    return (
+        f"{result.scale:>8} {result.case:<40} {result.n_items:>9} items "
+        f"{result.best_time:9.3f} s (median {result.median_time:9.3f} s) "
+        f"{result.items_per_second:11.1f} items/s {rss}"
+    )
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the time and the peak memory of the converters "
+        "on synthetic Scipion projects of several sizes."
+    )
+    parser.add_argument(
+        "--scales",
+        nargs="+",
+        choices=list(BENCHMARK_SCALES),
+        default=DEFAULT_SCALES,
+        help="Sizes of the projects.",
+    )
+    parser.add_argument(
+        "--cases",
+        nargs="+",
+        choices=list(BENCHMARK_CASES),
+        default=None,
+        help="Cases to be run. All by default.",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=DEFAULT_REPEAT,
+        help="Number of runs of each case. The best time is reported.",
+    )
+    parser.add_argument(
+        "--work-directory",
+        default=None,
+        help="Directory in which the projects are generated. A temporary one, "
+        "removed at the end, by default.",
+    )
+    parser.add_argument(
+        "-o", "--output", default=None, help="JSON file to save the results."
+    )
+    parser.add_argument(
+        "--compare",
+        default=None,
+        help="JSON file with the results of a previous run to compare with.",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="Increase of time or memory (in %%) over the compared results "
+        "reported as a regression.",
+    )
+    args = parser.parse_args(argv)
+    with contextlib.ExitStack() as stack:
+        if args.work_directory is None:
+            work_directory = Path(
+                stack.enter_context(tempfile.TemporaryDirectory(prefix="cets_bench_"))
+            )
+        else:
+            work_directory = Path(args.work_directory).expanduser()
+        results = run_benchmarks(
+            work_directory, scales=args.scales, cases=args.cases, repeat=args.repeat
+        )
+    if args.output:
+        save_results(results, Path(args.output))
+    if args.compare:
+        regressions = compare_results(
+            results, load_results(Path(args.compare)), args.threshold
+        )
+        if regressions:
+            print(f"{len(regressions)} regressions found.")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
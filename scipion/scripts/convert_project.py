@@ -0,0 +1,412 @@
+import argparse
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from scipion.constants import (
+    SET_OF_TILT_SERIES,
+    SET_OF_CTF_TOMO_SERIES,
+    SET_OF_TOMOGRAMS,
+    SET_OF_COORDINATES_3D,
+    SET_OF_SUBTOMOGRAMS,
+)
+from scipion.converters.coodinates3d import ScipionSetOfCoordinates3D
+from scipion.converters.subtomograms import ScipionSetOfSubtomogras
+from scipion.converters.tilt_series_set import ScipionSetOfTiltSeries
+from scipion.converters.tomograms_set import ScipionSetOfTomograms
+from scipion.converters.base_particles_converter import BaseParticlesConverter
+from scipion.utils.utils import (
+    write_ts_set_yaml,
+    get_coords_yaml_file,
+)
+from scipion.utils.utils_incremental import ConversionState
+from scipion.utils.utils_instrumentation import REPORT
+from scipion.utils.utils_mrc import DEFAULT_MRC_READERS, MRC_HEADER_CACHE
+from scipion.utils.utils_project import (
+    ScipionSetFile,
+    discover_sets,
+    find_matching_set,
+)
+
+PARTICLE_SETS = (SET_OF_COORDINATES_3D, SET_OF_SUBTOMOGRAMS)
+DEFAULT_CHUNK_SIZE = 8
+
+
+class ConversionTask(NamedTuple):
+    """Conversion of a group of tilt-series or tomograms of a Scipion set. It is
+    sent to the worker processes, so it only contains picklable data."""
+
+    set_class: str
+    db_path: Path
+    out_directory: Path
+    ids: Optional[Tuple[str, ...]]  # None to convert all the items of the set
+    ctf_db_path: Optional[Path] = None
+    particles_db_path: Optional[Path] = None
+    incremental: bool = False  # only the new or changed items are converted
+    memory_budget_mb: Optional[float] = None  # of the particles converted at once
+    compact_yaml: bool = False  # repeated blocks written once and referenced
+    mrc_readers: Optional[int] = None  # threads reading the MRC headers at once
+
+    def depends_on(self, db_path: Path) -> bool:
+        """True if the result of the task depends on the set db_path."""
+        return db_path in (self.db_path, self.ctf_db_path, self.particles_db_path)
+
+
+def convert_task(task: ConversionTask) -> int:
+    """Converts and writes the objects of a task. Returns the number of tilt-series
+    or tomograms converted."""
+    task.out_directory.mkdir(parents=True, exist_ok=True)
+    if task.mrc_readers is None:
+        return _convert_task(task)
+    # Restored afterwards, as the tasks may run in the calling process
+    max_readers = MRC_HEADER_CACHE.max_readers
+    MRC_HEADER_CACHE.max_readers = task.mrc_readers
+    try:
+        return _convert_task(task)
+    finally:
+        MRC_HEADER_CACHE.max_readers = max_readers
+
+
+def _convert_task(task: ConversionTask) -> int:
+    if task.set_class == SET_OF_TILT_SERIES:
+        # The CTF are read along with the tilt-series, one chunk at a time
+        ts_reader = ScipionSetOfTiltSeries(task.db_path)
+        if task.incremental:
+            ts_list = ts_reader.scipion_to_cets(
+                out_directory=task.out_directory,
+                ts_ids=task.ids,
+                incremental=True,
+                ctf_db_path=task.ctf_db_path,
+                compact_yaml=task.compact_yaml,
+            )
+            return len(ts_list or [])
+        return len(
+            write_ts_set_yaml(
+                ts_reader.iter_cets(ts_ids=task.ids, ctf_db_path=task.ctf_db_path),
+                task.out_directory,
+                compact=task.compact_yaml,
+            )
+        )
+    elif task.set_class == SET_OF_TOMOGRAMS:
+        tomo_list = ScipionSetOfTomograms(task.db_path).scipion_to_cets(
+            particles_db_path=task.particles_db_path,
+            out_directory=task.out_directory,
+            tomo_ids=task.ids,
+            incremental=task.incremental,
+            compact_yaml=task.compact_yaml,
+        )
+        return len(tomo_list or [])
+    elif task.set_class in PARTICLE_SETS:
+        particles_reader = (
+            ScipionSetOfCoordinates3D(task.db_path)
+            if task.set_class == SET_OF_COORDINATES_3D
+            else ScipionSetOfSubtomogras(task.db_path)
+        )
+        if task.incremental:
+            return _convert_particles_incrementally(particles_reader, task)
+        # Converted and written in chunks, so the sets of millions of particles fit
+        return len(
+            particles_reader.write_cets_yaml_chunked(
+                task.out_directory,
+                tomo_ids=task.ids,
+                memory_budget_mb=task.memory_budget_mb,
+                compact_yaml=task.compact_yaml,
+            )
+        )
+    else:
+        raise ValueError(f"Unsupported Scipion set class: {task.set_class}")
+
+
+def _convert_particles_incrementally(
+    particles_reader: BaseParticlesConverter, task: ConversionTask
+) -> int:
+    state = ConversionState.load(task.out_directory)
+    signatures = particles_reader.get_tomo_signatures()
+    if task.ids is not None:
+        signatures = {
+            tomo_id: signatures.get(tomo_id, [0, None]) for tomo_id in task.ids
+        }
+    tomo_ids = state.get_changed(str(task.db_path), signatures)
+    if not tomo_ids:
+        return 0
+    written = set(
+        particles_reader.write_cets_yaml_chunked(
+            task.out_directory,
+            tomo_ids=tomo_ids,
+            memory_budget_mb=task.memory_budget_mb,
+            compact_yaml=task.compact_yaml,
+        )
+    )
+    converted = [
+        tomo_id
+        for tomo_id in tomo_ids
+        if get_coords_yaml_file(tomo_id, task.out_directory) in written
+    ]
+    state.update(str(task.db_path), signatures, obj_ids=converted)
+    state.save()
+    return len(converted)
+
+
+def plan_set_conversion(
+    set_file: ScipionSetFile,
+    set_files: List[ScipionSetFile],
+    out_directory: Path,
+    incremental: bool = False,
+    memory_budget_mb: float | None = None,
+    compact_yaml: bool = False,
+    mrc_readers: int | None = None,
+) -> ConversionTask | None:
+    """Returns the task converting all the items of a set, or None if the set is
+    not converted on its own (e.g. a set of CTF, converted with the tilt-series).
+    The set is written in its own directory, named as the Scipion run that
+    generated it. The tilt-series are converted with the CTF of the matching set
+    of CTF, if any, and the particle sets are converted within the matching set
+    of tomograms, if any.
+
+    :param set_file: set to be converted.
+    :param set_files: all the sets of the project, in which the matching sets
+    of CTF and tomograms are searched.
+    :param out_directory: base output directory.
+    :param incremental: if True, the task will only convert the items that are
+    new or have changed since the last incremental conversion.
+    :param memory_budget_mb: approximate max memory used by the particles
+    converted at once, for the particle sets converted on their own.
+    :param compact_yaml: if True, the .yaml files are written in compact YAML.
+    :param mrc_readers: number of threads reading the MRC headers at once. By
+    default, those of MRC_HEADER_CACHE.
+    """
+    ctf_db_path, particles_db_path = None, None
+    set_class, db_path = set_file.set_class, set_file.db_path
+    if set_class == SET_OF_TILT_SERIES:
+        ctf_sets = [sf for sf in set_files if sf.set_class == SET_OF_CTF_TOMO_SERIES]
+        ctf_set = find_matching_set(set_file, ctf_sets)
+        ctf_db_path = ctf_set.db_path if ctf_set else None
+    elif set_class in PARTICLE_SETS:
+        tomo_sets = [sf for sf in set_files if sf.set_class == SET_OF_TOMOGRAMS]
+        tomo_set = find_matching_set(set_file, tomo_sets)
+        if tomo_set:
+            set_class, db_path = tomo_set.set_class, tomo_set.db_path
+            particles_db_path = set_file.db_path
+    elif set_class != SET_OF_TOMOGRAMS:
+        return None
+    return ConversionTask(
+        set_class=set_class,
+        db_path=db_path,
+        out_directory=out_directory / set_file.run_name,
+        ids=None,
+        ctf_db_path=ctf_db_path,
+        particles_db_path=particles_db_path,
+        incremental=incremental,
+        memory_budget_mb=memory_budget_mb,
+        compact_yaml=compact_yaml,
+        mrc_readers=mrc_readers,
+    )
+
+
+def plan_project_conversion(
+    set_files: List[ScipionSetFile],
+    out_directory: Path,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    memory_budget_mb: float | None = None,
+    compact_yaml: bool = False,
+    mrc_readers: int | None = None,
+) -> List[ConversionTask]:
+    """Splits the conversion of the sets of a project into independent tasks of
+    at most chunk_size tilt-series or tomograms. See plan_set_conversion.
+    """
+    tasks = []
+    for set_file in set_files:
+        set_task = plan_set_conversion(
+            set_file,
+            set_files,
+            out_directory,
+            memory_budget_mb=memory_budget_mb,
+            compact_yaml=compact_yaml,
+            mrc_readers=mrc_readers,
+        )
+        if set_task is None:
+            continue
+        for ids_chunk in _split(set_file.ids, chunk_size):
+            tasks.append(set_task._replace(ids=tuple(ids_chunk)))
+    return tasks
+
+
+def convert_project(
+    project_path: os.PathLike | str,
+    out_directory: os.PathLike | str,
+    n_jobs: int | None = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    memory_budget_mb: float | None = None,
+    compact_yaml: bool = False,
+    mrc_readers: int | None = None,
+) -> List[Tuple[ConversionTask, int]]:
+    """Converts all the supported sets of a Scipion project into CETS metadata,
+    running the independent tasks in a pool of processes.
+
+    :param project_path: path of the Scipion project directory.
+    :param out_directory: directory in which the .yaml files will be written.
+    :param n_jobs: number of worker processes. Defaults to the number of CPUs.
+    If 1, the tasks are run in the current process.
+    :param chunk_size: maximum number of tilt-series or tomograms per task.
+    :param memory_budget_mb: approximate max memory used by the particles
+    converted at once by each worker, for the particle sets converted on their
+    own. By default, FETCH_CHUNK_SIZE particles are converted at once.
+    :param compact_yaml: if True, the .yaml files are written in compact YAML,
+    with the repeated blocks written once and referenced with YAML aliases.
+    :param mrc_readers: number of threads of each worker reading the MRC headers
+    at once. Defaults to DEFAULT_MRC_READERS.
+    :return: the tasks and the number of objects converted by each one, in the
+    same (deterministic) order in which they were planned.
+
+    The timings and counters of the worker processes are merged into REPORT.
+    """
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    elif n_jobs < 1:
+        raise ValueError(f"The number of jobs must be greater than 0: {n_jobs}")
+    if mrc_readers is not None and mrc_readers < 1:
+        raise ValueError(f"The number of readers must be greater than 0: {mrc_readers}")
+    set_files = discover_sets(project_path)
+    tasks = plan_project_conversion(
+        set_files,
+        Path(out_directory),
+        chunk_size,
+        memory_budget_mb=memory_budget_mb,
+        compact_yaml=compact_yaml,
+        mrc_readers=mrc_readers,
+    )
+    if n_jobs == 1 or len(tasks) <= 1:
+        results = [convert_task(task) for task in tasks]
+    else:
+        results = []
+        with ProcessPoolExecutor(
+            max_workers=min(n_jobs, len(tasks)),
+            initializer=_init_worker_logging,
+            initargs=(logging.getLogger().getEffectiveLevel(),),
+        ) as executor:
+            # map keeps the order of the tasks, whatever the order they finish
+            for n_converted, report in executor.map(_convert_task_reporting, tasks):
+                REPORT.merge(report)
+                results.append(n_converted)
+    return list(zip(tasks, results))
+
+
+def _init_worker_logging(level: int) -> None:
+    """Shows the messages of a worker process as in the main process, if its
+    logging is not inherited (e.g. spawned processes)."""
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=level, format="%(message)s")
+
+
+def _convert_task_reporting(task: ConversionTask) -> Tuple[int, Dict[str, Any]]:
+    """Runs a task in a worker process, returning its report too."""
+    REPORT.reset()
+    return convert_task(task), REPORT.to_dict()
+
+
+def _split(ids: Sequence[str], chunk_size: int) -> List[Sequence[str]]:
+    if chunk_size < 1:
+        raise ValueError(f"The chunk size must be greater than 0: {chunk_size}")
+    return [ids[i : i + chunk_size] for i in range(0, len(ids), chunk_size)]
+
+
+def _positive_int(value: str) -> int:
+    """argparse type of the options that must be an integer greater than 0."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be greater than 0: {value}")
+    return number
+
+
+def configure_logging(verbose: bool = False) -> None:
+    """Shows the messages of the converters in the terminal, as the CLI output.
+
+    :param verbose: if True, the debug messages are shown too.
+    """
+    logging.basicConfig(
+        level=logging.DEBUG if verbose else logging.INFO, format="%(message)s"
+    )
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Converts the sets of a Scipion project into CETS metadata."
+    )
+    parser.add_argument("project", help="Scipion project directory.")
+    parser.add_argument(
+        "-o",
+        "--out-directory",
+        required=True,
+        help="Directory in which the .yaml files will be written, one "
+        "subdirectory per Scipion run.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=_positive_int,
+        default=None,
+        help="Number of worker processes. Defaults to the number of CPUs.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=_positive_int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="Maximum number of tilt-series or tomograms converted per task.",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=None,
+        help="Approximate max memory, in MiB, used by the particles converted at "
+        "once by each worker. The particles are converted and written in chunks.",
+    )
+    parser.add_argument(
+        "--compact-yaml",
+        action="store_true",
+        help="Write the repeated blocks (coordinate systems, transformation "
+        "names...) once and reference them with YAML aliases and merge keys, and "
+        "the vectors and matrix rows in flow style. Smaller files, which any YAML "
+        "loader expands back.",
+    )
+    parser.add_argument(
+        "--mrc-readers",
+        type=_positive_int,
+        default=None,
+        help="Number of threads of each worker reading the headers of the MRC "
+        f"files at once. Defaults to {DEFAULT_MRC_READERS}.",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Also show the progress of each tilt-series and CTF series read.",
+    )
+    parser.add_argument(
+        "--report",
+        default=None,
+        help="JSON file to save the timings and counters of each stage of the "
+        "conversion (sqlite reads, MRC headers, YAML writing...).",
+    )
+    args = parser.parse_args(argv)
+    configure_logging(args.verbose)
+    REPORT.reset()
+    results = convert_project(
+        args.project,
+        args.out_directory,
+        n_jobs=args.jobs,
+        chunk_size=args.chunk_size,
+        memory_budget_mb=args.memory_budget,
+        compact_yaml=args.compact_yaml,
+        mrc_readers=args.mrc_readers,
+    )
+    for task, n_converted in results:
+        print(f"{task.out_directory}: {n_converted} {task.set_class} items converted")
+    print(REPORT.format())
+    if args.report:
+        REPORT.write_json(args.report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,16 @@
+import asyncio
 from pathlib import Path
+from typing import List
 
-from scipion.converters.ctf_set import ScipionSetOfCtf
+from scipion.converters.lazy_sets import LazySetOfTiltSeries
 from scipion.converters.tilt_series_set import ScipionSetOfTiltSeries
 from scipion.converters.tomograms_set import ScipionSetOfTomograms
+from scipion.utils.utils import get_ts_yaml_file
+from scipion.utils.utils_async import (
+    AsyncConversionPool,
+    AsyncRequest,
+    awrite_objs_yaml,
+)
 
 ### SCIPION TO CETS #################################################################
 # Files
@@ -16,13 +24,9 @@ coords_db_path = (
 )
 subtomo_db_paht = f_path / "Runs/001008_DynamoSubTomoMRA/subtomograms.sqlite"
 
-# CTF metadata
-sci_ctf_set = ScipionSetOfCtf(ctf_db_path)
-ctf_md_dict = sci_ctf_set.scipion_to_cets()
-
-# TS Metadata
+# TS Metadata, with the CTF metadata read along with them
 sci_ts_set = ScipionSetOfTiltSeries(ts_db_path)
-sci_ts_set.scipion_to_cets(ctf_md=ctf_md_dict, out_directory=scratch_dir)
+sci_ts_set.scipion_to_cets(ctf_db_path=ctf_db_path, out_directory=scratch_dir)
 
 # Tomogram metadata with coordinates
 sci_tomo_set = ScipionSetOfTomograms(tomo_db_path)
@@ -35,3 +39,26 @@ sci_tomo_set = ScipionSetOfTomograms(tomo_db_path)
 tomo_md_list = sci_tomo_set.scipion_to_cets(
     particles_db_path=subtomo_db_paht, out_directory=scratch_dir
 )
+
+# Lazy access: the tilt-series are listed reading only the table Objects, and
+# each one is converted (with its CTF) when its images are accessed
+ts_set = LazySetOfTiltSeries(ts_db_path, ctf_db_path=ctf_db_path)
+first_ts_images = ts_set[0].images
+
+
+# Async API, e.g. for a service: the blocking work runs in a bounded pool of
+# threads shared by all the requests, each one with its own concurrency limit
+async def write_ts_async(request: AsyncRequest) -> List[Path]:
+    return await awrite_objs_yaml(
+        (
+            (ts, get_ts_yaml_file(ts.ts_id, Path(scratch_dir)))
+            async for ts in sci_ts_set.aiter_cets(
+                ctf_db_path=ctf_db_path, request=request
+            )
+        ),
+        request,
+    )
+
+
+with AsyncConversionPool() as pool:
+    asyncio.run(write_ts_async(pool.request(max_concurrency=2)))
@@ -0,0 +1,57 @@
+import argparse
+from typing import Sequence
+
+from scipion.utils.utils_synthetic import SyntheticProject, write_synthetic_project
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    defaults = SyntheticProject()
+    parser = argparse.ArgumentParser(
+        description="Writes a synthetic Scipion project, with sets of tilt-series, "
+        "CTF, tomograms, coordinates and subtomograms, and header-only MRC files."
+    )
+    parser.add_argument("project", help="Directory of the project to be written.")
+    parser.add_argument(
+        "--tilt-series",
+        type=int,
+        default=defaults.n_tilt_series,
+        help="Number of tilt-series.",
+    )
+    parser.add_argument(
+        "--tilt-images",
+        type=int,
+        default=defaults.n_tilt_images,
+        help="Number of tilt-images per tilt-series.",
+    )
+    parser.add_argument(
+        "--tomograms",
+        type=int,
+        default=None,
+        help="Number of tomograms. One per tilt-series by default.",
+    )
+    parser.add_argument(
+        "--particles",
+        type=int,
+        default=defaults.n_particles,
+        help="Number of coordinates and subtomograms per tomogram.",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=defaults.seed, help="Seed of the random values."
+    )
+    args = parser.parse_args(argv)
+    db_paths = write_synthetic_project(
+        args.project,
+        SyntheticProject(
+            n_tilt_series=args.tilt_series,
+            n_tilt_images=args.tilt_images,
+            n_tomograms=args.tomograms,
+            n_particles=args.particles,
+            seed=args.seed,
+        ),
+    )
+    for set_class, db_path in db_paths.items():
+        print(f"{set_class} written -> {db_path}")
+
+
+if __name__ == "__main__":
+    main()
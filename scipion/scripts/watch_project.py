@@ -0,0 +1,311 @@
+import argparse
+import logging
+import os
+import queue
+import signal
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from scipion.constants import RUNS_DIR
+from scipion.scripts.convert_project import (
+    ConversionTask,
+    _positive_int,
+    configure_logging,
+    convert_task,
+    plan_set_conversion,
+)
+from scipion.utils.utils_instrumentation import REPORT
+from scipion.utils.utils_project import ScipionSetFile, read_set_file
+from scipion.utils.utils_sqlite import CONNECTION_POOL
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 2.0  # seconds
+DEFAULT_DEBOUNCE = 1.0  # seconds
+DEFAULT_MAX_LATENCY = 30.0  # seconds
+DEFAULT_MAX_PENDING = 64
+
+# Files written by sqlite next to the database while it is being modified
+SQLITE_SIDE_FILES = ("-wal", "-journal")
+
+
+class FileStamp(NamedTuple):
+    """Modification time and size of a set sqlite file and its side files."""
+
+    mtime_ns: int
+    size: int
+
+
+def get_set_stamp(db_path: Path) -> Optional[FileStamp]:
+    """Returns the stamp of a set, combining the sqlite file and its write-ahead
+    log or journal, so the rows appended by Scipion are detected even before
+    they are checkpointed into the database. None if the file does not exist."""
+    mtime_ns, size, found = 0, 0, False
+    for path in (db_path, *(Path(f"{db_path}{ext}") for ext in SQLITE_SIDE_FILES)):
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            continue
+        mtime_ns, size, found = max(mtime_ns, st.st_mtime_ns), size + st.st_size, True
+    return FileStamp(mtime_ns, size) if found else None
+
+
+class ProjectWatcher:
+    """Follows the runs of a Scipion project while it is being processed in
+    streaming, converting into CETS metadata the tilt-series, tomograms and
+    particles as they are added to the sets.
+
+    The set sqlite files (and their -wal / -journal files) are polled. A set is
+    considered changed when its stamp changes, and it is converted once the stamp
+    has been stable for debounce seconds, so a burst of rows written by Scipion
+    causes a single conversion. If a set keeps changing, it is converted anyway
+    after max_latency seconds. The conversions are incremental (see
+    ConversionState), so only the new or changed items are read and written.
+    The sets of the project are discovered once, when the watcher starts, and
+    then only the changed and new sqlite files are read again.
+
+    The conversions run in a worker thread, fed through a bounded queue of
+    changed sets. A set is never queued twice: the changes detected while it is
+    waiting are coalesced, and the sets that do not fit in the queue are kept as
+    changed and queued in a later poll, so a slow conversion does not make the
+    pending work grow without bound.
+
+    :param project_path: path of the Scipion project directory.
+    :param out_directory: directory in which the .yaml files will be written,
+    one subdirectory per Scipion run.
+    :param poll_interval: seconds between two polls of the sqlite files.
+    :param debounce: seconds a set must remain unchanged to be converted.
+    :param max_latency: max seconds a changed set may wait to be converted.
+    :param max_pending: max number of sets queued for conversion.
+    """
+
+    def __init__(
+        self,
+        project_path: os.PathLike | str,
+        out_directory: os.PathLike | str,
+        poll_interval: float = DEFAULT_POLL_INTERVAL,
+        debounce: float = DEFAULT_DEBOUNCE,
+        max_latency: float = DEFAULT_MAX_LATENCY,
+        max_pending: int = DEFAULT_MAX_PENDING,
+    ):
+        self.project_path = Path(project_path).expanduser()
+        self.runs_dir = self.project_path / RUNS_DIR
+        if not self.runs_dir.is_dir():
+            raise FileNotFoundError(
+                f"{project_path} is not a Scipion project: {self.runs_dir} not found."
+            )
+        if max_pending < 1:
+            # A queue of size 0 would be unbounded
+            raise ValueError(
+                f"The number of pending sets must be greater than 0: {max_pending}"
+            )
+        self.out_directory = Path(out_directory).expanduser()
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.max_latency = max_latency
+        self._stamps: Dict[Path, Optional[FileStamp]] = {}
+        # Changed sets: time of the first and of the last change detected
+        self._changed: Dict[Path, List[float]] = {}
+        self._queued: Set[Path] = set()
+        self._queue: queue.Queue[Optional[Path]] = queue.Queue(maxsize=max_pending)
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        # Each sqlite file found in the runs: its stamp when it was read and the
+        # set it contains, or None if it is not a supported set. Only used by
+        # the worker thread once it has started
+        self._set_files: Dict[Path, Tuple[FileStamp, Optional[ScipionSetFile]]] = {}
+        self.n_converted = 0
+
+    def run(self) -> None:
+        """Polls the project until stop is called (e.g. on SIGINT or SIGTERM).
+        Then the sets already changed are converted before returning."""
+        self._read_set_files(
+            [db_path.resolve() for db_path in self.runs_dir.glob("*/*.sqlite")]
+        )
+        worker = threading.Thread(target=self._work, name="cets-watch-worker")
+        worker.start()
+        try:
+            while not self._stop_event.is_set():
+                self.poll()
+                self._stop_event.wait(self.poll_interval)
+        finally:
+            # Flush: queue every changed set, whatever its debounce, and wait
+            self.poll(flush=True)
+            self._queue.put(None)
+            worker.join()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def poll(self, flush: bool = False) -> None:
+        """Detects the changed sets and queues the ones ready to be converted.
+
+        :param flush: if True, all the changed sets are queued, blocking until
+        there is room in the queue.
+        """
+        now = time.monotonic()
+        for db_path in sorted(self.runs_dir.glob("*/*.sqlite")):
+            db_path = db_path.resolve()
+            stamp = get_set_stamp(db_path)
+            if stamp is not None and stamp != self._stamps.get(db_path, None):
+                self._stamps[db_path] = stamp
+                self._changed.setdefault(db_path, [now, now])[1] = now
+        for db_path, (first_change, last_change) in list(self._changed.items()):
+            ready = (
+                now - last_change >= self.debounce
+                or now - first_change >= self.max_latency
+            )
+            if not (ready or flush):
+                continue
+            with self._lock:
+                if db_path in self._queued:
+                    continue  # Coalesced with the conversion already queued
+                self._queued.add(db_path)
+            try:
+                self._queue.put(db_path, block=flush)
+            except queue.Full:
+                with self._lock:
+                    self._queued.discard(db_path)
+                break  # Backpressure: retried in the next poll
+            del self._changed[db_path]
+
+    def _work(self) -> None:
+        while True:
+            db_path = self._queue.get()
+            if db_path is None:
+                CONNECTION_POOL.close_all()
+                return
+            # Take all the sets queued, so they are converted in one pass
+            db_paths = [db_path]
+            while True:
+                try:
+                    db_path = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if db_path is None:
+                    self._queue.put(None)  # Keep the end mark for later
+                    break
+                db_paths.append(db_path)
+            with self._lock:
+                self._queued.difference_update(db_paths)
+            for db_path in db_paths:
+                # Reopened, in case Scipion has closed or replaced the set
+                CONNECTION_POOL.discard(db_path)
+            try:
+                self._read_set_files(db_paths)
+                for task in self._get_tasks(db_paths):
+                    n_converted = convert_task(task)
+                    self.n_converted += n_converted
+                    if n_converted:
+                        logger.info(
+                            "%s: %d %s items converted",
+                            task.out_directory,
+                            n_converted,
+                            task.set_class,
+                        )
+            except Exception as e:
+                logger.exception(
+                    "Unable to convert the changes of %s -> %s", db_paths, e
+                )
+
+    def _read_set_files(self, db_paths: List[Path]) -> None:
+        """Reads the sets of the sqlite files introduced that are new or have
+        changed since they were last read, and forgets the removed ones."""
+        for db_path in db_paths:
+            stamp = get_set_stamp(db_path)
+            if stamp is None:
+                self._set_files.pop(db_path, None)
+            elif db_path not in self._set_files or self._set_files[db_path][0] != stamp:
+                self._set_files[db_path] = (stamp, read_set_file(db_path))
+
+    def _get_tasks(self, db_paths: List[Path]) -> List[ConversionTask]:
+        """Tasks whose result depends on any of the changed sets, e.g. the
+        tilt-series of a changed set of CTF."""
+        # Sorted by path, as the result of discover_sets
+        set_files = [
+            set_file
+            for _, (_, set_file) in sorted(self._set_files.items())
+            if set_file is not None
+        ]
+        tasks = []
+        for set_file in set_files:
+            task = plan_set_conversion(
+                set_file, set_files, self.out_directory, incremental=True
+            )
+            if task is not None and any(task.depends_on(p) for p in db_paths):
+                tasks.append(task)
+        return tasks
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Follows a Scipion project, converting into CETS metadata the "
+        "items added to its sets. Stop it with Ctrl+C."
+    )
+    parser.add_argument("project", help="Scipion project directory.")
+    parser.add_argument(
+        "-o",
+        "--out-directory",
+        required=True,
+        help="Directory in which the .yaml files will be written, one "
+        "subdirectory per Scipion run.",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+        help="Seconds between two checks of the sqlite files.",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=DEFAULT_DEBOUNCE,
+        help="Seconds a set must remain unchanged before it is converted.",
+    )
+    parser.add_argument(
+        "--max-latency",
+        type=float,
+        default=DEFAULT_MAX_LATENCY,
+        help="Max seconds a changed set may wait before it is converted.",
+    )
+    parser.add_argument(
+        "--max-pending",
+        type=_positive_int,
+        default=DEFAULT_MAX_PENDING,
+        help="Max number of changed sets waiting to be converted. The sets changed "
+        "meanwhile are queued once there is room.",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Also show the progress of each tilt-series and CTF series read.",
+    )
+    parser.add_argument(
+        "--report",
+        default=None,
+        help="JSON file to save, on exit, the timings and counters of each stage "
+        "of the conversions.",
+    )
+    args = parser.parse_args(argv)
+    configure_logging(args.verbose)
+    watcher = ProjectWatcher(
+        args.project,
+        args.out_directory,
+        poll_interval=args.poll_interval,
+        debounce=args.debounce,
+        max_latency=args.max_latency,
+        max_pending=args.max_pending,
+    )
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: watcher.stop())
+    watcher.run()
+    print(f"{watcher.n_converted} items converted.")
+    if args.report:
+        REPORT.write_json(args.report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+from typing import Any, Dict, List, Sequence, Tuple
+
+import pytest
+
+from scipion.constants import CLASSES_TBL, OBJECTS_TBL
+from scipion.utils.utils_sqlite import map_classes_table
+from scipion.utils.utils_synthetic import SyntheticProject, write_synthetic_project
+
+# Small project: 4 tilt-series of 11 tilt-images, 3 tomograms of 7 particles
+SMALL_PROJECT = SyntheticProject(
+    n_tilt_series=4,
+    n_tilt_images=11,
+    n_tomograms=3,
+    n_particles=7,
+    ts_size=(512, 512),
+    tomo_size=(128, 128, 64),
+)
+
+
+@pytest.fixture(scope="session")
+def db_paths(tmp_path_factory: pytest.TempPathFactory) -> Dict[str, Path]:
+    """Sqlite file of each set of a small synthetic project shared by the tests
+    that only read it."""
+    return write_synthetic_project(tmp_path_factory.mktemp("project"), SMALL_PROJECT)
+
+
+@pytest.fixture
+def new_db_paths(tmp_path: Path) -> Dict[str, Path]:
+    """Sqlite file of each set of a new small synthetic project, for the tests
+    that modify it."""
+    return write_synthetic_project(tmp_path / "project", SMALL_PROJECT)
+
+
+def delete_rows(
+    db_path: Path, label: str, value: Any, table: str = OBJECTS_TBL, keep: int = 0
+) -> None:
+    """Deletes the rows of a table of a Scipion set (e.g. id1_Objects) whose
+    field label is value, except the first keep of them."""
+    classes_table = table.replace(OBJECTS_TBL, CLASSES_TBL)
+    with closing(sqlite3.connect(db_path)) as conn:
+        with conn:
+            column = map_classes_table(conn, classes_table)[label]
+            conn.execute(
+                f'DELETE FROM "{table}" WHERE "{column}" = ? AND id NOT IN '
+                f'(SELECT id FROM "{table}" WHERE "{column}" = ? ORDER BY id LIMIT ?)',
+                (value, value, keep),
+            )
+
+
+def set_null(db_path: Path, label: str, value: Any, table: str = OBJECTS_TBL) -> None:
+    """Empties (sets to NULL) the field label of the rows of a table of a Scipion
+    set whose field label is value."""
+    classes_table = table.replace(OBJECTS_TBL, CLASSES_TBL)
+    with closing(sqlite3.connect(db_path)) as conn:
+        with conn:
+            column = map_classes_table(conn, classes_table)[label]
+            conn.execute(
+                f'UPDATE "{table}" SET "{column}" = NULL WHERE "{column}" = ?',
+                (value,),
+            )
+
+
+def read_rows(
+    db_path: Path, labels: Sequence[str], table: str = OBJECTS_TBL
+) -> List[Tuple[Any, ...]]:
+    """Reads the fields labels of all the rows of a table of a Scipion set,
+    sorted by id."""
+    classes_table = table.replace(OBJECTS_TBL, CLASSES_TBL)
+    with closing(sqlite3.connect(db_path)) as conn:
+        class_dict = map_classes_table(conn, classes_table)
+        columns = ", ".join(f'"{class_dict[label]}"' for label in labels)
+        return conn.execute(f'SELECT {columns} FROM "{table}" ORDER BY id').fetchall()
@@ -0,0 +1,292 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from contextlib import aclosing
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List
+
+import pytest
+
+from scipion.constants import SET_OF_TILT_SERIES
+from scipion.converters.tilt_series_set import ScipionSetOfTiltSeries
+from scipion.utils import utils_async
+from scipion.utils.utils_async import (
+    AsyncConversionPool,
+    AsyncRequest,
+    awrite_objs_yaml,
+)
+from scipion.utils.utils_sqlite import connect_db
+
+TIMEOUT = 10  # seconds
+
+
+class Items:
+    """Blocking generator of n items, recording how many have been produced and
+    whether it has been closed."""
+
+    def __init__(self, n: int, fail_at: int | None = None) -> None:
+        self.n = n
+        self.fail_at = fail_at
+        self.produced = 0
+        self.closed = threading.Event()
+
+    def __iter__(self) -> Iterator[int]:
+        try:
+            for i in range(self.n):
+                if i == self.fail_at:
+                    raise KeyError(i)
+                self.produced += 1
+                yield i
+        finally:
+            self.closed.set()
+
+
+def wait_for(condition: Callable[[], bool]) -> None:
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        assert time.monotonic() < deadline, "Timeout"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def pool() -> Iterator[AsyncConversionPool]:
+    with AsyncConversionPool(max_workers=4) as pool:
+        yield pool
+
+
+def test_map_within_request_limit(pool: AsyncConversionPool) -> None:
+    running, max_running = 0, 0
+    lock = threading.Lock()
+
+    def square(x: int) -> int:
+        nonlocal running, max_running
+        with lock:
+            running += 1
+            max_running = max(max_running, running)
+        time.sleep(0.02)
+        with lock:
+            running -= 1
+        return x * x
+
+    request = pool.request(max_concurrency=2)
+    assert asyncio.run(request.map(square, range(8))) == [x * x for x in range(8)]
+    assert max_running == 2
+    with pytest.raises(ValueError):
+        pool.request(max_concurrency=0)
+    with pytest.raises(ValueError):
+        AsyncConversionPool(max_workers=0)
+
+
+def test_slot_released_after_cancelled_call(pool: AsyncConversionPool) -> None:
+    started, release = threading.Event(), threading.Event()
+
+    def blocking() -> str:
+        started.set()
+        release.wait(TIMEOUT)
+        return "done"
+
+    async def main() -> str:
+        request = pool.request(max_concurrency=1)
+        task = asyncio.create_task(request.run(blocking))
+        await asyncio.to_thread(started.wait, TIMEOUT)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # The call keeps its slot until it finishes in the background
+        assert request._semaphore.locked()
+        release.set()
+        return await asyncio.wait_for(request.run(str, "next"), TIMEOUT)
+
+    assert asyncio.run(main()) == "next"
+
+
+def test_iterate_prefetch(pool: AsyncConversionPool) -> None:
+    items = Items(10)
+
+    async def main() -> List[int]:
+        request = pool.request()
+        async with aclosing(request.iterate(items, prefetch=2)) as async_items:
+            consumed = [await anext(async_items)]
+            # One consumed, two ready in the queue and one waiting for room
+            await asyncio.sleep(0.2)
+            assert items.produced == 4
+            consumed.extend([item async for item in async_items])
+            return consumed
+
+    assert asyncio.run(main()) == list(range(10))
+    assert items.closed.wait(TIMEOUT)
+
+    async def no_prefetch() -> int:
+        return await anext(pool.request().iterate(items, prefetch=0))
+
+    with pytest.raises(ValueError):
+        asyncio.run(no_prefetch())
+
+
+def test_iterate_closed(pool: AsyncConversionPool) -> None:
+    items = Items(10)
+
+    async def main() -> None:
+        async with aclosing(pool.request().iterate(items)) as async_items:
+            async for item in async_items:
+                if item == 1:
+                    break
+
+    asyncio.run(main())
+    # Closed once the object in progress is done, without reading the rest
+    assert items.closed.wait(TIMEOUT)
+    assert items.produced < 10
+
+
+def test_iterate_error(pool: AsyncConversionPool) -> None:
+    items = Items(10, fail_at=3)
+
+    async def main() -> List[int]:
+        return [item async for item in pool.request().iterate(items)]
+
+    with pytest.raises(KeyError):
+        asyncio.run(main())
+    assert items.closed.wait(TIMEOUT)
+
+
+def test_iterate_pool_shut_down(pool: AsyncConversionPool) -> None:
+    items = Items(10)
+
+    async def main() -> None:
+        async with aclosing(pool.request().iterate(items)) as async_items:
+            async for _ in async_items:
+                pool.shutdown()
+                raise ZeroDivisionError
+
+    # The error of the consumer is not replaced by the one of the pool
+    with pytest.raises(ZeroDivisionError):
+        asyncio.run(main())
+    assert items.closed.wait(TIMEOUT)
+
+
+def test_iterate_connection_scope(
+    db_paths: Dict[str, Path], pool: AsyncConversionPool
+) -> None:
+    db_path = db_paths[SET_OF_TILT_SERIES]
+    pooled: List[Any] = []
+
+    def get_pooled() -> Any:
+        pooled.append(connect_db(db_path))
+
+    def steps() -> Iterator[Any]:
+        for _ in range(6):
+            # Give other threads of the pool a chance to run the next step
+            time.sleep(0.01)
+            yield connect_db(db_path)
+
+    async def main() -> List[Any]:
+        request = pool.request()
+        async with aclosing(request.iterate(steps(), prefetch=1)) as conns:
+            result = []
+            async for conn in conns:
+                result.append(conn)
+                await request.map(lambda _: get_pooled(), range(4))
+            return result
+
+    conns = asyncio.run(main())
+    # The same connection in every step, whatever the thread that runs it, and
+    # not the one of the threads of the pool
+    assert len({id(conn) for conn in conns}) == 1
+    assert all(conn is not conns[0] for conn in pooled)
+    wait_for(lambda: not _is_open(conns[0]))
+    assert all(_is_open(conn) for conn in pooled)
+
+
+def _is_open(conn: sqlite3.Connection) -> bool:
+    try:
+        conn.execute("SELECT 1")
+        return True
+    except sqlite3.ProgrammingError:
+        return False
+
+
+@pytest.fixture
+def ts_streams(monkeypatch: pytest.MonkeyPatch) -> List[Any]:
+    """Generators returned by ScipionSetOfTiltSeries.iter_cets."""
+    iter_cets = ScipionSetOfTiltSeries.iter_cets
+    streams = []
+
+    def kept_iter_cets(self, *args, **kwargs):
+        streams.append(iter_cets(self, *args, **kwargs))
+        return streams[-1]
+
+    monkeypatch.setattr(ScipionSetOfTiltSeries, "iter_cets", kept_iter_cets)
+    return streams
+
+
+def test_aiter_cets(
+    db_paths: Dict[str, Path], pool: AsyncConversionPool, ts_streams: List[Any]
+) -> None:
+    ts_reader = ScipionSetOfTiltSeries(db_paths[SET_OF_TILT_SERIES])
+    expected = list(ts_reader.iter_cets())
+
+    async def read_all(request: AsyncRequest) -> List[Any]:
+        return [ts async for ts in ts_reader.aiter_cets(request=request)]
+
+    async def read_first(request: AsyncRequest) -> Any:
+        async with aclosing(ts_reader.aiter_cets(request=request)) as ts_set:
+            async for ts in ts_set:
+                return ts
+
+    async def cancel_reading(request: AsyncRequest) -> None:
+        first_read = asyncio.Event()
+
+        async def consume() -> None:
+            async for _ in ts_reader.aiter_cets(request=request):
+                first_read.set()
+                await asyncio.sleep(TIMEOUT)
+
+        consumer = asyncio.create_task(consume())
+        await asyncio.wait_for(first_read.wait(), TIMEOUT)
+        consumer.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await consumer
+
+    assert asyncio.run(read_all(pool.request())) == expected
+    assert asyncio.run(read_first(pool.request())) == expected[0]
+    asyncio.run(cancel_reading(pool.request()))
+    assert len(ts_streams) == 4
+    # The conversions stopped early are closed too
+    wait_for(lambda: all(stream.gi_frame is None for stream in ts_streams))
+
+
+def test_awrite_objs_yaml_order(
+    db_paths: Dict[str, Path],
+    tmp_path: Path,
+    pool: AsyncConversionPool,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    ts_list = list(ScipionSetOfTiltSeries(db_paths[SET_OF_TILT_SERIES]).iter_cets())
+    yaml_files = [tmp_path / f"{ts.ts_id}.yaml" for ts in ts_list]
+    write_obj_yaml = utils_async.write_obj_yaml
+
+    def slow_write_obj_yaml(cets_obj: Any, yaml_file: Path, compact: bool) -> bool:
+        # The first files are the last ones written, and the third one fails
+        i = yaml_files.index(Path(yaml_file))
+        time.sleep(0.02 * (len(ts_list) - i))
+        if i == 2:
+            return False
+        return write_obj_yaml(cets_obj, yaml_file, compact)
+
+    monkeypatch.setattr(utils_async, "write_obj_yaml", slow_write_obj_yaml)
+
+    async def objs_and_files():
+        for ts, yaml_file in zip(ts_list, yaml_files):
+            yield ts, yaml_file
+
+    written = asyncio.run(
+        awrite_objs_yaml(objs_and_files(), pool.request(max_concurrency=4))
+    )
+    assert written == [f for i, f in enumerate(yaml_files) if i != 2]
+    assert all(f.is_file() for f in written) and not yaml_files[2].exists()
+    # Also from a regular iterable
+    written = asyncio.run(
+        awrite_objs_yaml(zip(ts_list, yaml_files), pool.request(max_concurrency=1))
+    )
+    assert written == [f for i, f in enumerate(yaml_files) if i != 2]
@@ -0,0 +1,114 @@
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List
+
+import pytest
+
+from scipion.constants import SET_OF_CTF_TOMO_SERIES, SET_OF_TILT_SERIES
+from scipion.converters.tilt_series_set import ScipionSetOfTiltSeries
+from scipion.utils.utils_cache import ConversionCache
+from scipion.utils.utils_instrumentation import (
+    CONVERSION_CACHE_HITS,
+    CONVERSION_CACHE_MISSES,
+    REPORT,
+)
+from scipion.utils.utils_mrc import MRC_HEADER_CACHE
+from scipion.utils.utils_synthetic import write_mrc_header
+
+
+def _touch(file_path: Path) -> None:
+    """Changes the modification time of a file, keeping its content."""
+    mtime_ns = file_path.stat().st_mtime_ns + 10**9
+    os.utime(file_path, ns=(mtime_ns, mtime_ns))
+
+
+def _count_conversions() -> Dict[str, int]:
+    return {
+        counter: REPORT.counters.get(counter, 0)
+        for counter in (CONVERSION_CACHE_HITS, CONVERSION_CACHE_MISSES)
+    }
+
+
+def test_cached_conversion(new_db_paths: Dict[str, Path], tmp_path: Path) -> None:
+    ts_db_path = new_db_paths[SET_OF_TILT_SERIES]
+    ctf_db_path = new_db_paths[SET_OF_CTF_TOMO_SERIES]
+    cache = ConversionCache(tmp_path / "cache")
+    ts_reader = ScipionSetOfTiltSeries(ts_db_path)
+
+    def convert():
+        return ts_reader.scipion_to_cets(ctf_db_path=ctf_db_path, cache=cache)
+
+    REPORT.reset()
+    expected = convert()
+    assert convert() == expected
+    assert _count_conversions() == {
+        CONVERSION_CACHE_HITS: 1,
+        CONVERSION_CACHE_MISSES: 1,
+    }
+    # A tilt-series file changed, or one of the sets, is converted again
+    (ts_file,) = ts_db_path.parents[2].glob("Runs/*/extra/TS_002.mrcs")
+    for changed_file in (ts_file, ctf_db_path, ts_db_path):
+        _touch(changed_file)
+        REPORT.reset()
+        assert convert() == expected
+        assert convert() == expected
+        assert _count_conversions() == {
+            CONVERSION_CACHE_HITS: 1,
+            CONVERSION_CACHE_MISSES: 1,
+        }
+
+
+def test_cache_records_own_files(tmp_path: Path) -> None:
+    mrc_files = [tmp_path / f"tomo_{i}.mrc" for i in range(2)]
+    for mrc_file in mrc_files:
+        write_mrc_header(mrc_file, (64, 64, 32), 1.0)
+    cache = ConversionCache(tmp_path / "cache")
+    barrier = threading.Barrier(2)
+    results: List[object] = [None, None]
+
+    def run(i: int) -> None:
+        def convert() -> int:
+            # Both conversions are recording while each reads its own file
+            barrier.wait()
+            MRC_HEADER_CACHE.get(mrc_files[i])
+            barrier.wait()
+            return i
+
+        results[i] = cache.get_or_convert(f"key_{i}", convert)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [0, 1]
+    _touch(mrc_files[1])
+    assert cache.get("key_0") == (True, 0)
+    assert cache.get("key_1") == (False, None)
+
+
+def test_cache_lru_eviction(tmp_path: Path) -> None:
+    # Room for two entries
+    cache = ConversionCache(tmp_path / "cache", max_size_mb=10_000 / 2**20)
+    result = b"x" * 4000
+    cache.put("a", result)
+    cache.put("b", result)
+    # Deterministic order of use, whatever the resolution of the timestamps
+    for i, key in enumerate(["a", "b"]):
+        os.utime(cache._get_entry_file(key), ns=(i * 10**9, i * 10**9))
+    assert cache.get("a") == (True, result)  # Now the most recently used
+    cache.put("c", result)  # Evicts "b"
+    assert sorted(f.stem for f in cache._get_entry_files()) == ["a", "c"]
+    cache.clear()
+    assert not cache._get_entry_files()
+    with pytest.raises(ValueError):
+        ConversionCache(tmp_path, max_size_mb=0)
+
+
+def test_cache_invalid_entry(tmp_path: Path) -> None:
+    cache = ConversionCache(tmp_path)
+    cache.put("a", [1, 2])
+    cache._get_entry_file("a").write_bytes(b"not a pickle")
+    assert cache.get("a") == (False, None)
+    assert not cache._get_entry_file("a").exists()
@@ -0,0 +1,61 @@
+import filecmp
+from pathlib import Path
+from typing import Dict, List
+
+import pytest
+
+from scipion.constants import SET_OF_TILT_SERIES
+from scipion.scripts.convert_project import convert_project, main
+from scipion.utils.utils_mrc import MRC_HEADER_CACHE
+
+
+def _project_path(db_paths: Dict[str, Path]) -> Path:
+    # ProjectName/Runs/ProtocolDir/set.sqlite
+    return db_paths[SET_OF_TILT_SERIES].parents[2]
+
+
+def _list_files(directory: Path) -> List[Path]:
+    return sorted(
+        path.relative_to(directory) for path in directory.rglob("*") if path.is_file()
+    )
+
+
+def test_convert_project_jobs(db_paths: Dict[str, Path], tmp_path: Path) -> None:
+    project_path = _project_path(db_paths)
+    max_readers = MRC_HEADER_CACHE.max_readers
+    results = {}
+    for n_jobs in (1, 2):
+        out_directory = tmp_path / f"out_{n_jobs}"
+        results[n_jobs] = convert_project(
+            project_path, out_directory, n_jobs=n_jobs, chunk_size=2, mrc_readers=3
+        )
+        # The number of readers of a task does not leak into the calling process
+        assert MRC_HEADER_CACHE.max_readers == max_readers
+    assert [n for _, n in results[1]] == [n for _, n in results[2]]
+    assert [task.ids for task, _ in results[1]] == [task.ids for task, _ in results[2]]
+    files = _list_files(tmp_path / "out_1")
+    assert files and files == _list_files(tmp_path / "out_2")
+    _, mismatch, errors = filecmp.cmpfiles(
+        tmp_path / "out_1", tmp_path / "out_2", [str(f) for f in files], shallow=False
+    )
+    assert not mismatch and not errors
+
+
+@pytest.mark.parametrize(
+    "kwargs", [{"n_jobs": 0}, {"chunk_size": 0}, {"mrc_readers": 0}]
+)
+def test_convert_project_invalid(
+    db_paths: Dict[str, Path], tmp_path: Path, kwargs: dict
+) -> None:
+    with pytest.raises(ValueError, match="must be greater than 0"):
+        convert_project(_project_path(db_paths), tmp_path, **kwargs)
+
+
+@pytest.mark.parametrize("option", ["--jobs", "--chunk-size", "--mrc-readers"])
+@pytest.mark.parametrize("value", ["0", "-1", "a"])
+def test_cli_invalid_numbers(
+    db_paths: Dict[str, Path], tmp_path: Path, option: str, value: str
+) -> None:
+    with pytest.raises(SystemExit):
+        main([str(_project_path(db_paths)), "-o", str(tmp_path), option, value])
+    assert not any(tmp_path.iterdir())
@@ -0,0 +1,67 @@
+from pathlib import Path
+from typing import Dict
+
+import pytest
+
+from cets_data_model.models.models import CTFMetadata
+from scipion.constants import (
+    ACQUISITION_ORDER,
+    SET_OF_CTF_TOMO_SERIES,
+    SET_OF_TILT_SERIES,
+)
+from scipion.converters.ctf_set import ScipionSetOfCtf
+from scipion.converters.ctf_table import CTFSeries
+from scipion.converters.tilt_series_set import ScipionSetOfTiltSeries
+from scipion.tests.conftest import SMALL_PROJECT, delete_rows
+
+# Acquisition order of the CTF removed from the first CTFTomoSeries
+MISSING_ORDER = 3
+
+
+@pytest.fixture
+def ctf_db_paths(new_db_paths: Dict[str, Path]) -> Dict[str, Path]:
+    """Project whose first CTFTomoSeries (of TS_001) has no CTF for one of the
+    tilt-images, so its CTF are no longer aligned with them by position."""
+    delete_rows(
+        new_db_paths[SET_OF_CTF_TOMO_SERIES],
+        ACQUISITION_ORDER,
+        MISSING_ORDER,
+        table="id1_Objects",
+    )
+    return new_db_paths
+
+
+@pytest.mark.parametrize("use_ctf_db_path", [False, True])
+def test_ctf_matched_by_acquisition_order(
+    ctf_db_paths: Dict[str, Path], use_ctf_db_path: bool
+) -> None:
+    ctf_db_path = ctf_db_paths[SET_OF_CTF_TOMO_SERIES]
+    ctf_md = ScipionSetOfCtf(ctf_db_path).scipion_to_cets()
+    assert ctf_md is not None
+    assert len(ctf_md["TS_001"]) == SMALL_PROJECT.n_tilt_images - 1
+    ts_reader = ScipionSetOfTiltSeries(ctf_db_paths[SET_OF_TILT_SERIES])
+    ts_list = list(
+        ts_reader.iter_cets(ctf_db_path=ctf_db_path)
+        if use_ctf_db_path
+        else ts_reader.iter_cets(ctf_md=ctf_md)
+    )
+    assert [ts.ts_id for ts in ts_list] == list(ctf_md)
+    for ts in ts_list:
+        ctf_by_order = {ctf.acquisition_order: ctf for ctf in ctf_md[ts.ts_id]}
+        for ti in ts.images:
+            if ts.ts_id == "TS_001" and ti.acquisition_order == MISSING_ORDER:
+                assert ti.ctf_metadata is None
+            else:
+                assert ti.ctf_metadata == ctf_by_order[ti.acquisition_order]
+
+
+def test_ctf_series_match() -> None:
+    ctf_list = [
+        CTFMetadata(acquisition_order=2, defocus_u=2.0),
+        CTFMetadata(acquisition_order=0, defocus_u=0.0),
+        CTFMetadata(acquisition_order=2, defocus_u=3.0),
+        CTFMetadata(acquisition_order=None, defocus_u=4.0),
+    ]
+    matched = CTFSeries.from_ctf_list(ctf_list).match([0, 1, 2, None])
+    # The first CTF of each acquisition order, None if there is none
+    assert matched == [ctf_list[1], None, ctf_list[0], None]
@@ -0,0 +1,123 @@
+from pathlib import Path
+from typing import Dict
+
+import numpy as np
+import pytest
+
+from scipion.constants import (
+    SET_OF_COORDINATES_3D,
+    SET_OF_TILT_SERIES,
+    SET_OF_TOMOGRAMS,
+    TOMO_ID,
+)
+from scipion.converters.coodinates3d import ScipionSetOfCoordinates3D
+from scipion.converters.tilt_series_set import ScipionSetOfTiltSeries
+from scipion.converters.tomograms_set import ScipionSetOfTomograms
+from scipion.tests.conftest import SMALL_PROJECT, delete_rows
+from scipion.utils.utils_filters import ConversionFilter
+
+
+def _tilt_angles() -> np.ndarray:
+    n_images = SMALL_PROJECT.n_tilt_images
+    return (np.arange(n_images) - (n_images - 1) / 2) * SMALL_PROJECT.tilt_step
+
+
+def _convert_ts(
+    db_paths: Dict[str, Path], filters: ConversionFilter
+) -> Dict[str, list]:
+    ts_reader = ScipionSetOfTiltSeries(db_paths[SET_OF_TILT_SERIES])
+    return {ts.ts_id: ts.images for ts in ts_reader.iter_cets(filters=filters)}
+
+
+def _count_particles(
+    db_paths: Dict[str, Path], filters: ConversionFilter
+) -> Dict[str, int]:
+    tomo_reader = ScipionSetOfTomograms(db_paths[SET_OF_TOMOGRAMS])
+    return {
+        tomo.tomo_id: len(tomo.particle_set.particles)
+        for tomo in tomo_reader.iter_cets(
+            particles_db_path=db_paths[SET_OF_COORDINATES_3D], filters=filters
+        )
+    }
+
+
+@pytest.mark.parametrize(
+    "filters, expected",
+    [
+        (ConversionFilter(), ["TS_001", "TS_002", "TS_003", "TS_004"]),
+        (ConversionFilter(ids=["TS_004", "TS_002"]), ["TS_002", "TS_004"]),
+        (ConversionFilter(patterns=["TS_00[13]"]), ["TS_001", "TS_003"]),
+        (ConversionFilter(patterns=["*4", "TS_001"]), ["TS_001", "TS_004"]),
+        (ConversionFilter(ids=["TS_001", "TS_002"], patterns=["*2"]), ["TS_002"]),
+        (ConversionFilter(ids=["NOT_IN_SET"]), []),
+    ],
+)
+def test_select_tilt_series(
+    db_paths: Dict[str, Path], filters: ConversionFilter, expected: list
+) -> None:
+    assert list(_convert_ts(db_paths, filters)) == expected
+
+
+def test_select_tomograms(db_paths: Dict[str, Path]) -> None:
+    filters = ConversionFilter(ids=["TS_003", "TS_001", "TS_004"], patterns=["*3"])
+    assert list(_count_particles(db_paths, filters)) == ["TS_003"]
+
+
+def test_tilt_angle_range(db_paths: Dict[str, Path]) -> None:
+    filters = ConversionFilter(min_tilt_angle=-6.0, max_tilt_angle=9.0)
+    tilt_angles = _tilt_angles()
+    n_expected = np.count_nonzero((tilt_angles >= -6.0) & (tilt_angles <= 9.0))
+    for images in _convert_ts(db_paths, filters).values():
+        assert len(images) == n_expected
+        assert all(-6.0 <= ti.nominal_tilt_angle <= 9.0 for ti in images)
+
+
+def test_max_dose(db_paths: Dict[str, Path]) -> None:
+    max_dose = 4 * SMALL_PROJECT.dose_per_tilt
+    for images in _convert_ts(db_paths, ConversionFilter(max_dose=max_dose)).values():
+        # Dose-symmetric: the tilt-images of acquisition order 0 to 4
+        assert sorted(ti.acquisition_order for ti in images) == [0, 1, 2, 3, 4]
+        assert all(ti.accumulated_dose <= max_dose for ti in images)
+
+
+def test_max_particles(db_paths: Dict[str, Path]) -> None:
+    filters = ConversionFilter(max_particles=3)
+    assert _count_particles(db_paths, filters) == {
+        "TS_001": 3,
+        "TS_002": 3,
+        "TS_003": 3,
+    }
+    coords_reader = ScipionSetOfCoordinates3D(db_paths[SET_OF_COORDINATES_3D])
+    particle_sets = coords_reader.scipion_to_cets_by_tomo(filters=filters)
+    assert particle_sets is not None
+    assert {k: len(v.particles) for k, v in particle_sets.items()} == {
+        "TS_001": 3,
+        "TS_002": 3,
+        "TS_003": 3,
+    }
+
+
+@pytest.mark.parametrize(
+    "min_particles, expected",
+    [
+        (None, {"TS_001": 7, "TS_002": 2, "TS_003": 0}),
+        (0, {"TS_001": 7, "TS_002": 2, "TS_003": 0}),
+        (1, {"TS_001": 7, "TS_002": 2}),
+        (3, {"TS_001": 7}),
+        (8, {}),
+    ],
+)
+def test_min_particles(
+    new_db_paths: Dict[str, Path], min_particles: int | None, expected: dict
+) -> None:
+    coords_db_path = new_db_paths[SET_OF_COORDINATES_3D]
+    delete_rows(coords_db_path, TOMO_ID, "TS_002", keep=2)
+    delete_rows(coords_db_path, TOMO_ID, "TS_003")
+    filters = ConversionFilter(min_particles=min_particles)
+    assert _count_particles(new_db_paths, filters) == expected
+
+
+def test_min_particles_requires_particles(db_paths: Dict[str, Path]) -> None:
+    tomo_reader = ScipionSetOfTomograms(db_paths[SET_OF_TOMOGRAMS])
+    with pytest.raises(ValueError):
+        list(tomo_reader.iter_cets(filters=ConversionFilter(min_particles=1)))
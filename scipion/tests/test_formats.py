@@ -0,0 +1,132 @@
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+import pytest
+
+from cets_data_model.models.models import CTFMetadata, TiltSeries
+from scipion.constants import (
+    SET_OF_COORDINATES_3D,
+    SET_OF_CTF_TOMO_SERIES,
+    SET_OF_SUBTOMOGRAMS,
+    SET_OF_TILT_SERIES,
+)
+from scipion.converters.coodinates3d import ScipionSetOfCoordinates3D
+from scipion.converters.ctf_set import ScipionSetOfCtf
+from scipion.converters.particle_table import ParticleTable, ParticleTableBuilder
+from scipion.converters.subtomograms import ScipionSetOfSubtomogras
+from scipion.converters.tilt_series_set import ScipionSetOfTiltSeries
+from scipion.utils.utils_formats import (
+    CTF_KIND,
+    JSONL_FORMAT,
+    NPZ_FORMAT,
+    PARQUET_FORMAT,
+    PARTICLES_KIND,
+    TILT_SERIES_KIND,
+    get_reader,
+    get_writer,
+)
+
+PARTICLE_SETS = {
+    SET_OF_COORDINATES_3D: ScipionSetOfCoordinates3D,
+    SET_OF_SUBTOMOGRAMS: ScipionSetOfSubtomogras,
+}
+
+
+def _round_trip(kind: str, out_format: str, obj: Any, out_file: Path) -> Any:
+    get_writer(kind, out_format)(obj, out_file)
+    assert out_file.exists()
+    assert not list(out_file.parent.glob(".*.tmp"))
+    return get_reader(kind, out_format)(out_file)
+
+
+def _assert_tables_equal(table: ParticleTable, expected: ParticleTable) -> None:
+    np.testing.assert_array_equal(table.data, expected.data)
+    assert table.tomo_ids == expected.tomo_ids
+    assert table.file_names == expected.file_names
+    np.testing.assert_array_equal(table.file_sizes, expected.file_sizes)
+    assert table.is_subtomogram == expected.is_subtomogram
+    assert table.to_particle3d_set() == expected.to_particle3d_set()
+
+
+def _null_tomo_table() -> ParticleTable:
+    """Particle table with particles without tomogram identifier."""
+    builder = ParticleTableBuilder()
+    builder.append(
+        ["TS_001", None, "None"],  # type: ignore[list-item]
+        np.arange(9, dtype=np.float64).reshape(3, 3),
+        np.tile(np.eye(4), (3, 1, 1)),
+    )
+    return builder.build()
+
+
+def test_ts_jsonl(db_paths: Dict[str, Path], tmp_path: Path) -> None:
+    ts_reader = ScipionSetOfTiltSeries(db_paths[SET_OF_TILT_SERIES])
+    for ts in ts_reader.iter_cets(ctf_db_path=db_paths[SET_OF_CTF_TOMO_SERIES]):
+        jsonl_file = tmp_path / f"{ts.ts_id}.jsonl"
+        read_ts = _round_trip(TILT_SERIES_KIND, JSONL_FORMAT, ts, jsonl_file)
+        assert isinstance(read_ts, TiltSeries)
+        assert read_ts == ts
+        # One line for the tilt-series and one per tilt-image
+        assert len(jsonl_file.read_text().splitlines()) == len(ts.images) + 1
+
+
+@pytest.mark.parametrize("out_format", [NPZ_FORMAT, PARQUET_FORMAT])
+@pytest.mark.parametrize("set_class", list(PARTICLE_SETS))
+def test_particles_table(
+    db_paths: Dict[str, Path], tmp_path: Path, out_format: str, set_class: str
+) -> None:
+    if out_format == PARQUET_FORMAT:
+        pytest.importorskip("pyarrow")
+    table = PARTICLE_SETS[set_class](db_paths[set_class]).scipion_to_table()
+    assert table is not None
+    out_file = tmp_path / f"particles.{out_format}"
+    _assert_tables_equal(
+        _round_trip(PARTICLES_KIND, out_format, table, out_file), table
+    )
+
+
+@pytest.mark.parametrize("out_format", [NPZ_FORMAT, PARQUET_FORMAT])
+def test_particles_table_null_tomo(tmp_path: Path, out_format: str) -> None:
+    if out_format == PARQUET_FORMAT:
+        pytest.importorskip("pyarrow")
+    table = _null_tomo_table()
+    out_file = tmp_path / f"particles.{out_format}"
+    read_table = _round_trip(PARTICLES_KIND, out_format, table, out_file)
+    assert read_table.tomo_ids == ["TS_001", None, "None"]
+    _assert_tables_equal(read_table, table)
+    if out_format == PARQUET_FORMAT:
+        import pyarrow.parquet as pq
+
+        # Null for any Arrow-based tool
+        tomo_id_col = pq.read_table(out_file).column("tomo_id")
+        assert tomo_id_col.to_pylist() == ["TS_001", None, "None"]
+
+
+def test_ctf_npz(db_paths: Dict[str, Path], tmp_path: Path) -> None:
+    ctf_reader = ScipionSetOfCtf(db_paths[SET_OF_CTF_TOMO_SERIES])
+    ctf_md = ctf_reader.scipion_to_cets()
+    assert ctf_md is not None
+    read_ctf = _round_trip(CTF_KIND, NPZ_FORMAT, ctf_md, tmp_path / "ctf.npz")
+    assert read_ctf == ctf_md
+    # Same file written from the CTF series, without creating the CTFMetadata
+    ctf_series = ctf_reader.scipion_to_ctf_series()
+    assert ctf_series is not None
+    read_series = _round_trip(CTF_KIND, NPZ_FORMAT, ctf_series, tmp_path / "s.npz")
+    assert read_series == ctf_md
+
+
+def test_ctf_npz_empty_values(tmp_path: Path) -> None:
+    ctf_md: Dict[Any, List[CTFMetadata]] = {
+        "TS_001": [CTFMetadata(defocus_u=1.0, acquisition_order=0), CTFMetadata()],
+        None: [CTFMetadata(defocus_v=2.0)],
+        "TS_002": [],
+    }
+    assert _round_trip(CTF_KIND, NPZ_FORMAT, ctf_md, tmp_path / "ctf.npz") == ctf_md
+
+
+def test_unknown_format() -> None:
+    with pytest.raises(ValueError, match="No writer"):
+        get_writer(CTF_KIND, PARQUET_FORMAT)
+    with pytest.raises(ValueError, match="No reader"):
+        get_reader(TILT_SERIES_KIND, NPZ_FORMAT)
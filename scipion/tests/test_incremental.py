@@ -0,0 +1,110 @@
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+from typing import Dict
+
+import pytest
+
+from scipion.constants import (
+    SET_OF_COORDINATES_3D,
+    SET_OF_CTF_TOMO_SERIES,
+    SET_OF_TILT_SERIES,
+    SET_OF_TOMOGRAMS,
+    TOMO_ID,
+)
+from scipion.converters.tilt_series_set import ScipionSetOfTiltSeries
+from scipion.converters.tomograms_set import ScipionSetOfTomograms
+from scipion.tests.conftest import delete_rows
+from scipion.utils.utils import get_ts_yaml_file
+from scipion.utils.utils_filters import ConversionFilter
+from scipion.utils.utils_incremental import STATE_FILE_NAME, ConversionState
+
+
+def _add_last_row(db_path: Path, table: str) -> None:
+    """Adds a copy of the last row of a table, as Scipion does when streaming."""
+    with closing(sqlite3.connect(db_path)) as conn:
+        with conn:
+            row = conn.execute(
+                f'SELECT * FROM "{table}" ORDER BY id DESC LIMIT 1'
+            ).fetchone()
+            placeholders = ", ".join("?" * len(row))
+            conn.execute(
+                f'INSERT INTO "{table}" VALUES ({placeholders})', (None, *row[1:])
+            )
+
+
+def test_incremental_tilt_series(new_db_paths: Dict[str, Path], tmp_path: Path) -> None:
+    out_directory = tmp_path / "out"
+    out_directory.mkdir()
+    ts_reader = ScipionSetOfTiltSeries(new_db_paths[SET_OF_TILT_SERIES])
+
+    def convert(filters: ConversionFilter | None = None) -> list:
+        ts_list = ts_reader.scipion_to_cets(
+            out_directory=out_directory,
+            incremental=True,
+            filters=filters,
+            ctf_db_path=new_db_paths[SET_OF_CTF_TOMO_SERIES],
+        )
+        assert ts_list is not None
+        return [ts.ts_id for ts in ts_list]
+
+    assert convert() == ["TS_001", "TS_002", "TS_003", "TS_004"]
+    assert (out_directory / STATE_FILE_NAME).exists()
+    assert all(
+        get_ts_yaml_file(ts_id, out_directory).exists()
+        for ts_id in ("TS_001", "TS_002", "TS_003", "TS_004")
+    )
+    assert convert() == []
+    _add_last_row(new_db_paths[SET_OF_TILT_SERIES], "TS_002_Objects")
+    assert convert() == ["TS_002"]
+    assert convert() == []
+    # The filters are part of the signatures
+    assert convert(ConversionFilter(max_dose=9.0)) == [
+        "TS_001",
+        "TS_002",
+        "TS_003",
+        "TS_004",
+    ]
+
+
+def test_incremental_tomograms(new_db_paths: Dict[str, Path], tmp_path: Path) -> None:
+    out_directory = tmp_path / "out"
+    out_directory.mkdir()
+    tomo_reader = ScipionSetOfTomograms(new_db_paths[SET_OF_TOMOGRAMS])
+    coords_db_path = new_db_paths[SET_OF_COORDINATES_3D]
+
+    def convert() -> list:
+        tomo_list = tomo_reader.scipion_to_cets(
+            particles_db_path=coords_db_path,
+            out_directory=out_directory,
+            incremental=True,
+        )
+        assert tomo_list is not None
+        return [tomo.tomo_id for tomo in tomo_list]
+
+    assert convert() == ["TS_001", "TS_002", "TS_003"]
+    assert convert() == []
+    delete_rows(coords_db_path, TOMO_ID, "TS_003", keep=5)
+    assert convert() == ["TS_003"]
+    assert convert() == []
+
+
+def test_incremental_requires_out_directory(db_paths: Dict[str, Path]) -> None:
+    ts_reader = ScipionSetOfTiltSeries(db_paths[SET_OF_TILT_SERIES])
+    with pytest.raises(ValueError):
+        ts_reader.scipion_to_cets(incremental=True)
+
+
+def test_conversion_state(tmp_path: Path) -> None:
+    state = ConversionState.load(tmp_path)
+    signatures = {"TS_001": [1, (10, 20)], "TS_002": [2, (11, 21)]}
+    assert state.get_changed("set", signatures) == ["TS_001", "TS_002"]
+    state.update("set", signatures, obj_ids=["TS_002"])
+    state.save()
+    state = ConversionState.load(tmp_path)
+    assert state.get_changed("set", signatures) == ["TS_001"]
+    assert state.get_changed("other_set", signatures) == ["TS_001", "TS_002"]
+    # A corrupted state file is ignored, so everything is converted again
+    (tmp_path / STATE_FILE_NAME).write_text("{")
+    state = ConversionState.load(tmp_path)
+    assert state.get_changed("set", signatures) == ["TS_001", "TS_002"]
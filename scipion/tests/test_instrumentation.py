@@ -0,0 +1,105 @@
+import json
+from pathlib import Path
+from typing import Dict
+
+import pytest
+
+from scipion.constants import SET_OF_CTF_TOMO_SERIES, SET_OF_TILT_SERIES
+from scipion.converters.tilt_series_set import ScipionSetOfTiltSeries
+from scipion.tests.conftest import SMALL_PROJECT
+from scipion.utils import utils_instrumentation
+from scipion.utils.utils import write_ts_set_yaml
+from scipion.utils.utils_instrumentation import (
+    MATRIX_PARSE,
+    MRC_CACHE_HITS,
+    MRC_CACHE_MISSES,
+    REPORT,
+    SQLITE_READ,
+    YAML_WRITE,
+    ConversionReport,
+    Stage,
+    get_peak_rss_mb,
+)
+from scipion.utils.utils_mrc import MRC_HEADER_CACHE
+
+
+def test_report() -> None:
+    report = ConversionReport()
+    report.add(SQLITE_READ, 0.5, items=10)
+    report.add(SQLITE_READ, 0.25, items=5, n_bytes=100)
+    report.count(MRC_CACHE_HITS, 3)
+    report.count(MRC_CACHE_MISSES)
+    content = report.to_dict()
+    assert content["stages"][SQLITE_READ] == {
+        "calls": 2,
+        "seconds": 0.75,
+        "items": 15,
+        "bytes": 100,
+    }
+    assert content["counters"] == {MRC_CACHE_HITS: 3, MRC_CACHE_MISSES: 1}
+    assert content["hit_rates"] == {"mrc_header_cache": 0.75}
+    assert content["peak_rss_mb"] > 0
+    # The reports of other processes are added
+    other = ConversionReport()
+    other.merge(content)
+    other.merge(content)
+    assert other.to_dict()["stages"][SQLITE_READ]["items"] == 30
+    assert other.counters[MRC_CACHE_HITS] == 6
+    report.reset()
+    assert not report.stages and not report.counters
+    assert "mrc_header_cache" not in report.format()
+
+
+def test_report_json(tmp_path: Path) -> None:
+    report = ConversionReport()
+    report.add(YAML_WRITE, 0.1, items=1, n_bytes=2**20)
+    json_file = tmp_path / "report.json"
+    report.write_json(json_file)
+    with open(json_file) as f:
+        assert json.load(f)["stages"][YAML_WRITE]["bytes"] == 2**20
+    lines = report.format().splitlines()
+    assert lines[1].split() == [YAML_WRITE, "1", "0.100", "1", "1.00"]
+    assert lines[-1].startswith("Peak memory: ")
+
+
+def test_peak_rss_unavailable(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(utils_instrumentation, "resource", None)
+    assert get_peak_rss_mb() is None
+    report = ConversionReport()
+    content = report.to_dict()
+    assert content["peak_rss_mb"] is None
+    assert report.format().splitlines()[-1] == "Peak memory: unavailable"
+    # The peak memory measured by other processes is kept
+    report.merge({**content, "peak_rss_mb": 12.5})
+    report.merge(content)
+    assert report.to_dict()["peak_rss_mb"] == 12.5
+
+
+def test_stage() -> None:
+    REPORT.reset()
+    with Stage(MATRIX_PARSE, items=4) as stage:
+        stage.n_bytes = 64
+    with pytest.raises(ZeroDivisionError):
+        with Stage(MATRIX_PARSE):
+            1 / 0
+    stats = REPORT.stages[MATRIX_PARSE]
+    # Also recorded when the block fails
+    assert (stats.calls, stats.items, stats.n_bytes) == (2, 4, 64)
+    assert stats.seconds >= 0
+
+
+def test_conversion_report(db_paths: Dict[str, Path], tmp_path: Path) -> None:
+    MRC_HEADER_CACHE.clear()
+    REPORT.reset()
+    ts_reader = ScipionSetOfTiltSeries(db_paths[SET_OF_TILT_SERIES])
+    ts_files = write_ts_set_yaml(
+        ts_reader.iter_cets(ctf_db_path=db_paths[SET_OF_CTF_TOMO_SERIES]), tmp_path
+    )
+    content = REPORT.to_dict()
+    n_tilt_images = SMALL_PROJECT.n_tilt_series * SMALL_PROJECT.n_tilt_images
+    stages = content["stages"]
+    assert stages[SQLITE_READ]["items"] >= n_tilt_images
+    assert stages[MATRIX_PARSE]["items"] == n_tilt_images
+    assert stages[YAML_WRITE]["items"] == len(ts_files)
+    assert stages[YAML_WRITE]["bytes"] == sum(f.stat().st_size for f in ts_files)
+    assert content["counters"][MRC_CACHE_MISSES] == SMALL_PROJECT.n_tilt_series
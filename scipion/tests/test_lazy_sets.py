@@ -0,0 +1,145 @@
+from pathlib import Path
+from typing import Dict, List
+
+import pytest
+
+from scipion.constants import (
+    SET_OF_COORDINATES_3D,
+    SET_OF_CTF_TOMO_SERIES,
+    SET_OF_TILT_SERIES,
+    SET_OF_TOMOGRAMS,
+)
+from scipion.converters.lazy_sets import (
+    LazySetOfTiltSeries,
+    LazySetOfTomograms,
+    LRUCache,
+)
+from scipion.converters.tilt_series_set import ScipionSetOfTiltSeries
+from scipion.converters.tomograms_set import ScipionSetOfTomograms
+from scipion.tests.conftest import SMALL_PROJECT
+from scipion.utils.utils_filters import ConversionFilter
+from scipion.utils.utils_instrumentation import (
+    LAZY_CACHE_HITS,
+    LAZY_CACHE_MISSES,
+    REPORT,
+)
+
+
+def test_lru_cache() -> None:
+    with pytest.raises(ValueError):
+        LRUCache(0)
+    cache: LRUCache[int] = LRUCache(2)
+    loaded: List[str] = []
+
+    def loader(key: str):
+        def load() -> int:
+            loaded.append(key)
+            return len(loaded)
+
+        return load
+
+    REPORT.reset()
+    assert cache.get("a", loader("a")) == 1
+    assert cache.get("b", loader("b")) == 2
+    assert cache.get("a", loader("a")) == 1  # "b" becomes the least recently used
+    assert cache.get("c", loader("c")) == 3
+    assert "b" not in cache and "a" in cache and len(cache) == 2
+    assert cache.get("b", loader("b")) == 4
+    assert loaded == ["a", "b", "c", "b"]
+    assert REPORT.counters[LAZY_CACHE_HITS] == 1
+    assert REPORT.counters[LAZY_CACHE_MISSES] == 4
+    cache.clear()
+    assert len(cache) == 0
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [None, ConversionFilter(patterns=["TS_00[23]"], min_tilt_angle=-6, max_dose=20)],
+)
+def test_lazy_tilt_series(db_paths: Dict[str, Path], filters) -> None:
+    ctf_db_path = db_paths[SET_OF_CTF_TOMO_SERIES]
+    ts_list = ScipionSetOfTiltSeries(db_paths[SET_OF_TILT_SERIES]).scipion_to_cets(
+        ctf_db_path=ctf_db_path, filters=filters
+    )
+    assert ts_list is not None
+    ts_set = LazySetOfTiltSeries(
+        db_paths[SET_OF_TILT_SERIES], ctf_db_path=ctf_db_path, filters=filters
+    )
+    assert ts_set.ids == [ts.ts_id for ts in ts_list]
+    # Nothing is converted until the tilt-images are accessed
+    assert [handle.n_tilt_images for handle in ts_set] == [
+        len(ts.images) for ts in ts_list
+    ]
+    assert not any(ts_set.is_loaded(ts_id) for ts_id in ts_set.ids)
+    for handle, ts in zip(ts_set, ts_list):
+        assert handle.tilt_series == ts
+        assert handle.ctf_metadata == [ti.ctf_metadata for ti in ts.images]
+        assert ts_set.is_loaded(handle.ts_id)
+    if filters is None:
+        assert all(ti.ctf_metadata is not None for ti in ts_list[0].images)
+        assert len(ts_set) == SMALL_PROJECT.n_tilt_series
+        assert ts_set[0].n_tilt_images == SMALL_PROJECT.n_tilt_images
+    else:
+        assert ts_set.ids == ["TS_002", "TS_003"]
+        assert 0 < ts_set[0].n_tilt_images < SMALL_PROJECT.n_tilt_images
+
+
+def test_lazy_tilt_series_cache(db_paths: Dict[str, Path]) -> None:
+    ts_set = LazySetOfTiltSeries(db_paths[SET_OF_TILT_SERIES], cache_size=2)
+    first = ts_set.get("TS_001").tilt_series
+    assert ts_set.get("TS_001").tilt_series is first  # Cached
+    ts_set.get("TS_002").images
+    ts_set.get("TS_003").images
+    # Only the last tilt-series accessed are kept
+    assert [ts_set.is_loaded(ts_id) for ts_id in ts_set.ids] == [
+        False,
+        True,
+        True,
+        False,
+    ]
+    assert ts_set.get("TS_001").tilt_series == first
+    assert ts_set.get("TS_001").tilt_series is not first
+    ts_set.clear_cache()
+    assert not ts_set.is_loaded("TS_001")
+    with pytest.raises(KeyError):
+        ts_set.get("TS_999")
+    with pytest.raises(KeyError):
+        ts_set.load("TS_999")
+    with pytest.raises(ValueError):
+        LazySetOfTiltSeries(
+            db_paths[SET_OF_TILT_SERIES],
+            ctf_md={"TS_001": []},
+            ctf_db_path=db_paths[SET_OF_CTF_TOMO_SERIES],
+        )
+
+
+@pytest.mark.parametrize(
+    "filters", [None, ConversionFilter(ids=["TS_001", "TS_003"], max_particles=3)]
+)
+def test_lazy_tomograms(db_paths: Dict[str, Path], filters) -> None:
+    coords_db_path = db_paths[SET_OF_COORDINATES_3D]
+    tomo_list = ScipionSetOfTomograms(db_paths[SET_OF_TOMOGRAMS]).scipion_to_cets(
+        particles_db_path=coords_db_path, filters=filters
+    )
+    assert tomo_list is not None
+    tomo_set = LazySetOfTomograms(
+        db_paths[SET_OF_TOMOGRAMS], particles_db_path=coords_db_path, filters=filters
+    )
+    assert tomo_set.ids == [tomo.tomo_id for tomo in tomo_list]
+    for handle, tomo in zip(tomo_set, tomo_list):
+        assert handle.path == tomo.path
+        assert tomo.particle_set is not None
+        assert handle.n_particles == len(tomo.particle_set.particles)
+    assert not any(tomo_set.is_loaded(tomo_id) for tomo_id in tomo_set.ids)
+    assert [handle.tomogram for handle in tomo_set] == tomo_list
+    assert tomo_set[-1].particle_set == tomo_list[-1].particle_set
+    if filters is not None:
+        assert tomo_set.ids == ["TS_001", "TS_003"]
+        assert {handle.n_particles for handle in tomo_set} == {3}
+
+
+def test_lazy_tomograms_without_particles(db_paths: Dict[str, Path]) -> None:
+    tomo_set = LazySetOfTomograms(db_paths[SET_OF_TOMOGRAMS])
+    assert len(tomo_set) == SMALL_PROJECT.n_tomograms
+    assert all(handle.n_particles is None for handle in tomo_set)
+    assert tomo_set.get("TS_002").particle_set is None
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from scipion.utils.utils_matrix import get_matrix_shape, parse_matrices
+
+IDENTITY = "[[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]"
+SHIFT = "[[1.0, 0.0, 2.5], [0.0, 1.0, -3.0], [0.0, 0.0, 1.0]]"
+
+
+def test_parse_matrices() -> None:
+    matrices = parse_matrices([IDENTITY, SHIFT])
+    assert matrices.shape == (2, 3, 3)
+    assert matrices.dtype == np.float64
+    np.testing.assert_array_equal(matrices[0], np.eye(3))
+    assert (matrices[1, 0, 2], matrices[1, 1, 2]) == (2.5, -3.0)
+
+
+def test_get_matrix_shape() -> None:
+    assert get_matrix_shape(IDENTITY) == (3, 3)
+    assert get_matrix_shape("[[1.0, 2.0]]") == (1, 2)
+    with pytest.raises(ValueError):
+        get_matrix_shape("[[1.0, 2.0], [3.0]]")
+
+
+def test_parse_empty_matrices() -> None:
+    assert parse_matrices([], shape=(4, 4)).shape == (0, 4, 4)
+    with pytest.raises(ValueError, match="shape is required"):
+        parse_matrices([])
+
+
+def test_parse_nan_matrices() -> None:
+    matrices = parse_matrices([IDENTITY, IDENTITY.replace("1.0", "nan")])
+    np.testing.assert_array_equal(matrices[0], np.eye(3))
+    assert np.isnan(matrices[1].diagonal()).all()
+    assert not np.isnan(matrices[1, 0, 1])
+
+
+def test_parse_null_matrices() -> None:
+    with pytest.raises(ValueError, match="_tiltAxisMatrix contains empty"):
+        parse_matrices([IDENTITY, None], column="_tiltAxisMatrix")  # type: ignore
+
+
+@pytest.mark.parametrize(
+    "matrix_strs",
+    [
+        [IDENTITY, "[[1.0, 0.0], [0.0, 1.0]]"],
+        [IDENTITY, "[[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0, 0.0]]"],
+        ["[[1.0, 0.0], [0.0, 1.0]]", IDENTITY],
+    ],
+)
+def test_parse_ragged_matrices(matrix_strs: list) -> None:
+    with pytest.raises(ValueError, match="unable to parse 2 matrices"):
+        parse_matrices(matrix_strs)
+
+
+@pytest.mark.parametrize("value", ["abc", "1.0.0", "None", ""])
+def test_parse_non_numeric_matrices(value: str) -> None:
+    with pytest.raises(ValueError, match="non-numeric"):
+        parse_matrices([IDENTITY, SHIFT.replace("2.5", value)])
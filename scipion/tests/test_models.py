@@ -0,0 +1,72 @@
+from typing import Any, Dict, List
+
+import numpy as np
+import pytest
+
+from cets_data_model.models.models import Affine, Translation
+from scipion.utils.utils_models import (
+    build_models,
+    check_batch,
+    is_strict_validation,
+    set_strict_validation,
+)
+
+TRANSLATIONS = [[1.0, 2.0, 3.0], [-4.5, 0.0, 6.25], [0.0, 0.0, 0.0]]
+AFFINES = np.stack([np.eye(3), 2 * np.eye(3), np.arange(9.0).reshape(3, 3)]).tolist()
+
+
+@pytest.fixture
+def strict(request: pytest.FixtureRequest):
+    previous = is_strict_validation()
+    set_strict_validation(request.param)
+    yield request.param
+    set_strict_validation(previous)
+
+
+@pytest.mark.parametrize("strict", [False, True], indirect=True)
+@pytest.mark.parametrize(
+    "model_class, field, values, common",
+    [
+        (Translation, "translation", TRANSLATIONS, {"name": "Shifts"}),
+        (
+            Affine,
+            "affine",
+            AFFINES,
+            {"name": "Rotation", "input": "Tilt-image", "output": "Tilt-image"},
+        ),
+    ],
+)
+def test_build_models(
+    strict: bool,
+    model_class: Any,
+    field: str,
+    values: List[Any],
+    common: Dict[str, Any],
+) -> None:
+    models = build_models(model_class, field, values, **common)
+    expected = [model_class(**common, **{field: value}) for value in values]
+    assert models == expected
+    assert [model.model_fields_set for model in models] == [
+        model.model_fields_set for model in expected
+    ]
+    assert [model.model_dump() for model in models] == [
+        model.model_dump() for model in expected
+    ]
+    # Each model has its own state
+    setattr(models[0], field, values[-1])
+    assert getattr(models[1], field) == values[1]
+    assert build_models(model_class, field, [], **common) == []
+
+
+def test_build_models_validates_prototype() -> None:
+    with pytest.raises(ValueError):
+        build_models(Translation, "translation", TRANSLATIONS, name=["not a name"])
+
+
+def test_check_batch() -> None:
+    batch = check_batch(np.ones((4, 3, 3), dtype=np.float32), (3, 3), "matrices")
+    assert batch.dtype == np.float64 and batch.shape == (4, 3, 3)
+    with pytest.raises(ValueError, match="Invalid matrices shape"):
+        check_batch(np.ones((4, 3, 4)), (3, 3), "matrices")
+    with pytest.raises(ValueError, match="Invalid matrices shape"):
+        check_batch(np.ones((3, 3)), (3, 3), "matrices")
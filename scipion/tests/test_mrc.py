@@ -0,0 +1,181 @@
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, List
+
+import mrcfile
+import numpy as np
+import pytest
+
+from scipion.constants import SET_OF_SUBTOMOGRAMS, SET_OF_TILT_SERIES
+from scipion.converters.subtomograms import ScipionSetOfSubtomogras
+from scipion.converters.tilt_series_set import ScipionSetOfTiltSeries
+from scipion.tests.conftest import SMALL_PROJECT
+from scipion.utils.utils_mrc import MRC_HEADER_CACHE, MrcHeaderCache, read_mrc_header
+from scipion.utils.utils_synthetic import write_mrc_header
+
+
+class CountingLoader:
+    """MRC header loader recording the files read."""
+
+    def __init__(self) -> None:
+        self.calls: List[Path] = []
+
+    def __call__(self, filename: Path) -> Any:
+        self.calls.append(filename)
+        return read_mrc_header(filename)
+
+
+@pytest.fixture
+def mrc_files(tmp_path: Path) -> List[Path]:
+    files = []
+    for i in range(3):
+        mrc_file = tmp_path / f"tomo_{i}.mrc"
+        write_mrc_header(mrc_file, (64 + i, 32, 16), 1.35)
+        files.append(mrc_file)
+    return files
+
+
+def test_read_mrc_header(db_paths: Dict[str, Path], tmp_path: Path) -> None:
+    # The files of the synthetic project and files written by mrcfile, with data
+    # and an extended header, in both byte orders
+    mrc_files = sorted(
+        db_paths[SET_OF_TILT_SERIES].parents[2].glob("Runs/*/extra/*.mrc*")
+    )
+    for byte_order in "<>":
+        mrc_file = tmp_path / f"data_{byte_order == '<'}.mrc"
+        with mrcfile.new(mrc_file) as mrc:
+            mrc.set_data(np.zeros((3, 4, 5), dtype=f"{byte_order}i2"))
+            mrc.set_extended_header(np.zeros(16, dtype="V8"))
+        mrc_files.append(mrc_file)
+    assert len(mrc_files) > SMALL_PROJECT.n_tilt_series + 2
+    for mrc_file in mrc_files:
+        with mrcfile.open(mrc_file, header_only=True) as mrc:
+            header = mrc.header
+            expected = tuple(int(header[f]) for f in ("nx", "ny", "nz", "mode"))
+        assert tuple(read_mrc_header(mrc_file)) == expected
+
+
+def test_read_invalid_mrc_header(mrc_files: List[Path], tmp_path: Path) -> None:
+    not_mrc = tmp_path / "not_mrc.mrc"
+    not_mrc.write_bytes(mrc_files[0].read_bytes().replace(b"MAP ", b"\0" * 4))
+    with pytest.raises(ValueError, match="signature"):
+        read_mrc_header(not_mrc)
+    not_mrc.write_bytes(mrc_files[0].read_bytes()[:512])
+    with pytest.raises(ValueError, match="smaller than the header"):
+        read_mrc_header(not_mrc)
+
+
+def test_cache_hits(mrc_files: List[Path], monkeypatch: pytest.MonkeyPatch) -> None:
+    loader = CountingLoader()
+    cache = MrcHeaderCache(loader=loader)
+    first = cache.get(mrc_files[0])
+    assert (first.size_x, first.size_y, first.size_z) == (64, 32, 16)
+    # Also through a relative path
+    monkeypatch.chdir(mrc_files[0].parent)
+    assert cache.get(mrc_files[0].name) is first
+    assert len(loader.calls) == 1
+    assert (cache.hits, cache.misses, cache.hit_rate) == (1, 1, 0.5)
+
+
+def test_cache_rewritten_file(mrc_files: List[Path]) -> None:
+    loader = CountingLoader()
+    cache = MrcHeaderCache(loader=loader)
+    assert cache.get(mrc_files[0]).size_x == 64
+    write_mrc_header(mrc_files[0], (128, 32, 16), 1.35)
+    os.utime(mrc_files[0], ns=(0, 0))
+    assert cache.get(mrc_files[0]).size_x == 128
+    assert len(loader.calls) == 2
+
+
+def test_cache_lru_eviction(mrc_files: List[Path]) -> None:
+    loader = CountingLoader()
+    cache = MrcHeaderCache(max_size=2, loader=loader)
+    cache.get(mrc_files[0])
+    cache.get(mrc_files[1])
+    cache.get(mrc_files[0])  # Now the most recently used
+    cache.get(mrc_files[2])  # Evicts mrc_files[1]
+    assert len(cache) == 2
+    cache.get(mrc_files[0])
+    cache.get(mrc_files[1])
+    assert [path.name for path in loader.calls] == [
+        "tomo_0.mrc",
+        "tomo_1.mrc",
+        "tomo_2.mrc",
+        "tomo_1.mrc",
+    ]
+
+
+def test_cache_record(mrc_files: List[Path]) -> None:
+    cache = MrcHeaderCache()
+    cache.get(mrc_files[0])
+    with cache.record() as recorded:
+        cache.get(mrc_files[0])
+        cache.get(mrc_files[1])
+    cache.get(mrc_files[2])
+    assert {key[0] for key in recorded} == {
+        str(mrc_files[0].resolve()),
+        str(mrc_files[1].resolve()),
+    }
+    assert all(MrcHeaderCache.is_current(key) for key in recorded)
+    mrc_files[1].unlink()
+    assert not all(MrcHeaderCache.is_current(key) for key in recorded)
+
+
+def test_cache_readers(tmp_path: Path) -> None:
+    mrc_files = []
+    for i in range(12):
+        mrc_file = tmp_path / f"tomo_{i}.mrc"
+        write_mrc_header(mrc_file, (i + 1, 32, 16), 1.35)
+        mrc_files.append(mrc_file)
+    cache = MrcHeaderCache(max_readers=3)
+    img_infos = cache.get_many(mrc_files[:6] + mrc_files[:2])
+    assert [img_info.size_x for img_info in img_infos] == [1, 2, 3, 4, 5, 6, 1, 2]
+    executor = cache._executor
+    assert executor is not None and executor._max_workers == 3
+    # The threads are reused by the next calls
+    cache.get_many(mrc_files[6:9])
+    assert cache._executor is executor
+    # And replaced if the number of readers changes
+    cache.max_readers = 2
+    assert [img_info.size_x for img_info in cache.get_many(mrc_files)] == list(
+        range(1, 13)
+    )
+    assert cache._executor is not executor and cache._executor._max_workers == 2
+    with pytest.raises(ValueError):
+        cache.max_readers = 0
+
+
+def test_cache_invalid_size() -> None:
+    with pytest.raises(ValueError):
+        MrcHeaderCache(max_size=0)
+
+
+def test_converters_share_cache(db_paths: Dict[str, Path]) -> None:
+    MRC_HEADER_CACHE.clear()
+    ts_reader = ScipionSetOfTiltSeries(db_paths[SET_OF_TILT_SERIES])
+    subtomos_reader = ScipionSetOfSubtomogras(db_paths[SET_OF_SUBTOMOGRAMS])
+    for _ in range(2):
+        ts_reader.scipion_to_cets()
+        subtomos_reader.scipion_to_cets_by_tomo()
+    # The header of each tilt-series and subtomogram file is read only once
+    n_files = (
+        SMALL_PROJECT.n_tilt_series
+        + len(SMALL_PROJECT.tomo_ids) * SMALL_PROJECT.n_particles
+    )
+    assert MRC_HEADER_CACHE.misses == n_files
+    assert MRC_HEADER_CACHE.hits >= n_files
+
+
+def test_cache_record_per_thread(mrc_files: List[Path]) -> None:
+    cache = MrcHeaderCache(max_readers=2)
+    with cache.record() as recorded:
+        # Files requested by other threads are not recorded
+        thread = threading.Thread(target=cache.get, args=(mrc_files[0],))
+        thread.start()
+        thread.join()
+        # Unless they are read on behalf of this one
+        cache.get_many(mrc_files[1:])
+    assert {key[0] for key in recorded} == {
+        str(mrc_file.resolve()) for mrc_file in mrc_files[1:]
+    }
@@ -0,0 +1,114 @@
+from pathlib import Path
+from typing import Dict
+
+import numpy as np
+import pytest
+
+from scipion.constants import SET_OF_COORDINATES_3D, SET_OF_SUBTOMOGRAMS
+from scipion.converters.coodinates3d import ScipionSetOfCoordinates3D
+from scipion.converters.particle_table import (
+    PARTICLE_DTYPE,
+    ParticleTable,
+    ParticleTableBuilder,
+)
+from scipion.converters.subtomograms import ScipionSetOfSubtomogras
+from scipion.tests.conftest import SMALL_PROJECT
+from scipion.utils.utils_filters import ConversionFilter
+
+PARTICLE_SETS = {
+    SET_OF_COORDINATES_3D: ScipionSetOfCoordinates3D,
+    SET_OF_SUBTOMOGRAMS: ScipionSetOfSubtomogras,
+}
+
+
+@pytest.mark.parametrize("set_class", list(PARTICLE_SETS))
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"tomo_ids": ["TS_003", "TS_001"]},
+        {"filters": ConversionFilter(max_particles=5, patterns=["TS_00[12]"])},
+    ],
+)
+def test_table_matches_particle_sets(
+    db_paths: Dict[str, Path], set_class: str, kwargs: dict
+) -> None:
+    reader = PARTICLE_SETS[set_class](db_paths[set_class])
+    particle_sets = reader.scipion_to_cets_by_tomo(**kwargs)
+    table = reader.scipion_to_table(**kwargs)
+    assert particle_sets is not None and table is not None
+    assert table.is_subtomogram == (set_class == SET_OF_SUBTOMOGRAMS)
+    assert len(table) == sum(
+        len(particle_set.particles) for particle_set in particle_sets.values()
+    )
+    groups = table.group_by_tomo()
+    assert sorted(groups) == sorted(particle_sets)
+    for tomo_id, particle_set in particle_sets.items():
+        assert groups[tomo_id].to_particle3d_set() == particle_set
+        assert table.select(tomo_id).to_particle3d_set() == particle_set
+
+
+def test_table_columns(db_paths: Dict[str, Path]) -> None:
+    reader = ScipionSetOfSubtomogras(db_paths[SET_OF_SUBTOMOGRAMS])
+    table = reader.scipion_to_table()
+    assert table is not None
+    n_particles = len(SMALL_PROJECT.tomo_ids) * SMALL_PROJECT.n_particles
+    assert len(table) == n_particles
+    assert table.positions.shape == (n_particles, 3)
+    assert table.rotations.shape == table.coord_rotations.shape == (n_particles, 3, 3)
+    # Each subtomogram has its own file, whose size is stored once
+    assert len(table.file_names) == n_particles
+    assert table.file_sizes.shape == (n_particles, 3)
+    assert sorted(table.file_indices.tolist()) == list(range(n_particles))
+    tomo_id_array = table.get_tomo_id_array()
+    assert sorted(set(tomo_id_array)) == SMALL_PROJECT.tomo_ids
+    # Subsets share the tomogram and file tables
+    subset = table.take([3, 0])
+    assert subset.file_names is table.file_names
+    assert subset.tomo_ids is table.tomo_ids
+    np.testing.assert_array_equal(subset.positions, table.positions[[3, 0]])
+    assert table.to_particle3d_set([3, 0]) == subset.to_particle3d_set()
+    assert len(table.select("NOT_A_TOMOGRAM")) == 0
+    assert not table.take([]).group_by_tomo()
+
+
+def test_table_builder() -> None:
+    builder = ParticleTableBuilder(is_subtomogram=True)
+    builder.add_file("a.mrc", (10, 20, 30))
+    builder.add_file("a.mrc", (0, 0, 0))  # Already registered
+    builder.add_file("b.mrc", (40, 50, 60))
+    assert builder.has_file("b.mrc") and not builder.has_file("c.mrc")
+    matrices = np.tile(np.eye(4), (3, 1, 1))
+    matrices[:, :3, 3] = [[1, 2, 3], [4, 5, 6], [7, 8, 9]]
+    for tomo_ids, file_names in (
+        (["t2", "t1"], ["b.mrc", "a.mrc"]),
+        (["t2"], ["a.mrc"]),
+    ):
+        n_rows = len(tomo_ids)
+        builder.append(
+            tomo_ids,
+            np.arange(3 * n_rows, dtype=np.float64).reshape(-1, 3),
+            matrices[:n_rows],
+            subtomo_matrices=matrices[:n_rows],
+            file_names=file_names,
+        )
+    table = builder.build()
+    assert table.tomo_ids == ["t2", "t1"]
+    assert table.tomo_indices.tolist() == [0, 1, 0]
+    assert table.file_indices.tolist() == [1, 0, 0]
+    assert table.file_sizes.tolist() == [[10, 20, 30], [40, 50, 60]]
+    assert table.shifts.tolist() == [[1, 2, 3], [4, 5, 6], [1, 2, 3]]
+    assert list(table.group_by_tomo()) == ["t2", "t1"]
+    particles = table.to_particle3d_set().particles
+    assert [p.path for p in particles] == ["b.mrc", "a.mrc", "a.mrc"]
+    assert [p.width for p in particles] == [40, 10, 10]
+
+
+def test_empty_table() -> None:
+    table = ParticleTableBuilder().build()
+    assert len(table) == 0
+    assert table.file_sizes.shape == (0, 3)
+    assert table.group_by_tomo() == {}
+    assert table.to_particle3d_set().particles == []
+    with pytest.raises(ValueError):
+        ParticleTable(np.zeros(1, dtype=PARTICLE_DTYPE.descr[:2]), [])
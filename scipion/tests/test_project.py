@@ -0,0 +1,66 @@
+import logging
+from pathlib import Path
+from typing import Dict
+
+import pytest
+
+from scipion.constants import RUNS_DIR, SET_OF_SUBTOMOGRAMS, SET_OF_TILT_SERIES
+from scipion.converters.subtomograms import ScipionSetOfSubtomogras
+from scipion.converters.tilt_series_set import ScipionSetOfTiltSeries
+from scipion.utils.utils_project import get_project_path
+
+
+@pytest.mark.parametrize(
+    "project_name, db_subpath",
+    [
+        ("Project", f"{RUNS_DIR}/000002_ProtImportTs/tiltseries.sqlite"),
+        ("Project", f"{RUNS_DIR}/000002_ProtImportTs/extra/tiltseries.sqlite"),
+        # The project directory may also be named Runs
+        (RUNS_DIR, f"{RUNS_DIR}/000002_ProtImportTs/tiltseries.sqlite"),
+    ],
+)
+def test_project_path(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    caplog: pytest.LogCaptureFixture,
+    project_name: str,
+    db_subpath: str,
+) -> None:
+    project_path = tmp_path / project_name
+    db_path = project_path / db_subpath
+    db_path.parent.mkdir(parents=True)
+    with caplog.at_level(logging.WARNING):
+        assert get_project_path(db_path) == project_path
+        # Resolved whatever the working directory
+        monkeypatch.chdir(db_path.parent)
+        assert get_project_path(db_path.name) == project_path
+        assert get_project_path(str(db_path)) == project_path
+    assert not caplog.records
+
+
+def test_project_path_fallback(
+    tmp_path: Path, caplog: pytest.LogCaptureFixture
+) -> None:
+    db_path = tmp_path / "a" / "b" / "sets" / "tiltseries.sqlite"
+    with caplog.at_level(logging.WARNING):
+        assert get_project_path(db_path) == tmp_path / "a"
+    assert "is not inside a Scipion Runs/ProtocolDir directory" in caplog.text
+    assert str(tmp_path / "a") in caplog.text
+
+
+def test_converters_project_path(db_paths: Dict[str, Path]) -> None:
+    project_path = db_paths[SET_OF_TILT_SERIES].parents[2]
+    for set_class, converter in (
+        (SET_OF_TILT_SERIES, ScipionSetOfTiltSeries),
+        (SET_OF_SUBTOMOGRAMS, ScipionSetOfSubtomogras),
+    ):
+        assert converter(db_paths[set_class]).scipion_prj_path == project_path
+    # The particle files are relative to the project directory
+    particle_sets = ScipionSetOfSubtomogras(
+        db_paths[SET_OF_SUBTOMOGRAMS]
+    ).scipion_to_cets_by_tomo()
+    assert particle_sets is not None
+    for particle_set in particle_sets.values():
+        for particle in particle_set.particles:
+            assert Path(particle.path).is_relative_to(project_path)
+            assert Path(particle.path).is_file()
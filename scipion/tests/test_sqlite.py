@@ -0,0 +1,173 @@
+import os
+import sqlite3
+import threading
+from contextlib import closing
+from pathlib import Path
+from typing import Dict, List
+
+import pytest
+
+from scipion.constants import (
+    COORD_X,
+    COORD_Y,
+    COORD_Z,
+    OBJECTS_TBL,
+    SET_OF_COORDINATES_3D,
+    SET_OF_TILT_SERIES,
+    TOMO_ID,
+)
+from scipion.tests.conftest import read_rows
+from scipion.utils.utils_sqlite import (
+    ConnectionPool,
+    ConnectionScope,
+    RowExtractor,
+    SharedConnection,
+    connect_db,
+    execute_query,
+    fetch_in_chunks,
+    get_tuple_cursor,
+    map_classes_table,
+)
+
+
+def _is_open(conn: sqlite3.Connection) -> bool:
+    try:
+        conn.execute("SELECT 1")
+    except sqlite3.ProgrammingError:  # Closed
+        return False
+    return True
+
+
+def _count_rows(conn: sqlite3.Connection) -> int:
+    return conn.execute(f'SELECT COUNT(*) FROM "{OBJECTS_TBL}"').fetchone()[0]
+
+
+@pytest.fixture
+def set_paths(new_db_paths: Dict[str, Path]) -> List[Path]:
+    return sorted(new_db_paths.values())
+
+
+def test_pool_reuse(set_paths: List[Path]) -> None:
+    pool = ConnectionPool()
+    conn = pool.get(set_paths[0])
+    assert isinstance(conn, SharedConnection)
+    assert pool.get(set_paths[0]) is conn
+    # Each thread has its own connections
+    thread_conns = []
+    thread = threading.Thread(
+        target=lambda: thread_conns.append(pool.get(set_paths[0]))
+    )
+    thread.start()
+    thread.join()
+    assert thread_conns[0] is not conn
+    pool.discard(set_paths[0])
+    assert not _is_open(conn)
+    assert pool.get(set_paths[0]) is not conn
+    pool.close_all()
+
+
+def test_pool_lru_eviction(set_paths: List[Path]) -> None:
+    pool = ConnectionPool(max_connections=2)
+    conns = [pool.get(set_paths[0]), pool.get(set_paths[1])]
+    pool.get(set_paths[0])  # Now the most recently used
+    conns.append(pool.get(set_paths[2]))  # Evicts and closes set_paths[1]
+    assert [_is_open(conn) for conn in conns] == [True, False, True]
+    assert pool.get(set_paths[0]) is conns[0]
+    pool.close_all()
+    assert not any(_is_open(conn) for conn in conns)
+    with pytest.raises(ValueError):
+        ConnectionPool(max_connections=0)
+
+
+@pytest.mark.parametrize("change", ["mtime", "size"])
+def test_pool_stale_immutable(new_db_paths: Dict[str, Path], change: str) -> None:
+    # The synthetic sets are closed, so they are opened as immutable
+    db_path = new_db_paths[SET_OF_TILT_SERIES]
+    pool = ConnectionPool()
+    conn = pool.get(db_path)
+    n_rows = _count_rows(conn)
+    assert pool.get(db_path) is conn
+    st = os.stat(db_path)
+    with closing(sqlite3.connect(db_path)) as writer:
+        with writer:
+            if change == "size":
+                # Enough rows to grow the file
+                n_added = 1000
+                writer.executemany(
+                    f'INSERT INTO "{OBJECTS_TBL}" (id) VALUES (?)',
+                    [(None,)] * n_added,
+                )
+            else:
+                # The pages freed are kept, so the size does not change
+                n_added = -1
+                writer.execute(f'DELETE FROM "{OBJECTS_TBL}" WHERE id = 1')
+    new_st = os.stat(db_path)
+    if change == "size":
+        assert new_st.st_size != st.st_size
+        os.utime(db_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    else:
+        assert new_st.st_size == st.st_size
+        os.utime(db_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    # The immutable connection, which would not see the changes, is reopened
+    new_conn = pool.get(db_path)
+    assert new_conn is not conn and not _is_open(conn)
+    assert _count_rows(new_conn) == n_rows + n_added
+    pool.close_all()
+
+
+def test_shared_connection_close(set_paths: List[Path]) -> None:
+    conn = connect_db(set_paths[0])
+    assert conn is not None
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.close()
+    assert connect_db(set_paths[0]) is conn and _is_open(conn)
+    # The connections not pooled are closed by the caller
+    own_conn = connect_db(set_paths[0], pooled=False)
+    assert own_conn is not None and not isinstance(own_conn, SharedConnection)
+    own_conn.close()
+
+
+def test_connection_scope(set_paths: List[Path]) -> None:
+    scope = ConnectionScope()
+    pooled_conn = connect_db(set_paths[0])
+    with scope.activate():
+        conn = connect_db(set_paths[0])
+        assert conn is not pooled_conn and connect_db(set_paths[0]) is conn
+        assert isinstance(conn, SharedConnection)
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.close()
+    assert connect_db(set_paths[0]) is pooled_conn
+    scope.close()
+    assert not _is_open(conn)
+
+
+def test_row_extractor(db_paths: Dict[str, Path]) -> None:
+    db_path = db_paths[SET_OF_COORDINATES_3D]
+    fields = [TOMO_ID, "_notInTheSet", COORD_X, COORD_Y, COORD_Z]
+    expected_rows = read_rows(db_path, [TOMO_ID, COORD_X, COORD_Y, COORD_Z])
+    conn = connect_db(db_path)
+    assert conn is not None
+    extractor = RowExtractor(map_classes_table(conn), fields)
+    # The missing fields are read as NULL
+    assert extractor.columns[1] is None
+    assert extractor.sql_fields.split(", ")[1] == "NULL"
+    # Plain tuples, whatever the row_factory of the connection
+    assert conn.row_factory is sqlite3.Row
+    cursor = get_tuple_cursor(conn)
+    execute_query(
+        cursor, f'SELECT {extractor.sql_fields} FROM "{OBJECTS_TBL}" ORDER BY id'
+    )
+    chunks = list(fetch_in_chunks(cursor, chunk_size=4))
+    assert [len(rows) for rows in chunks][:-1] == [4] * (len(chunks) - 1)
+    rows = [row for rows in chunks for row in rows]
+    assert all(type(row) is tuple for row in rows)
+    assert extractor.index(COORD_X) == 2
+    assert extractor.column(rows, TOMO_ID) == [row[0] for row in expected_rows]
+    assert extractor.column(rows, "_notInTheSet") == [None] * len(rows)
+    get_tomo_id, get_position = (
+        extractor.getter(TOMO_ID),
+        extractor.getter(COORD_X, COORD_Y, COORD_Z),
+    )
+    assert [(get_tomo_id(row), *get_position(row)) for row in rows] == expected_rows
+    with pytest.raises(KeyError):
+        extractor.getter("_notAField")
@@ -0,0 +1,133 @@
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, Generator, List, cast
+
+import pytest
+
+from scipion.constants import (
+    COORD_X,
+    COORD_Y,
+    COORD_Z,
+    SET_OF_COORDINATES_3D,
+    SET_OF_SUBTOMOGRAMS,
+    SET_OF_TOMOGRAMS,
+    TOMO_ID,
+)
+from scipion.converters.base_particles_converter import BaseParticlesConverter
+from scipion.converters.coodinates3d import ScipionSetOfCoordinates3D
+from scipion.converters.subtomograms import ScipionSetOfSubtomogras
+from scipion.converters.tomograms_set import ScipionSetOfTomograms
+from scipion.tests.conftest import read_rows, set_null
+
+
+def _positions_by_tomo(db_path: Path) -> Dict[str, List[List[float]]]:
+    positions = defaultdict(list)
+    for tomo_id, *position in read_rows(db_path, [TOMO_ID, COORD_X, COORD_Y, COORD_Z]):
+        positions[tomo_id].append(position)
+    return dict(positions)
+
+
+def test_particles_grouped_in_one_pass(
+    db_paths: Dict[str, Path], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    coords_db_path = db_paths[SET_OF_COORDINATES_3D]
+    n_reads = 0
+    read_particles = BaseParticlesConverter._read_particles
+
+    def counted_read_particles(self, *args, **kwargs):
+        nonlocal n_reads
+        n_reads += 1
+        return read_particles(self, *args, **kwargs)
+
+    monkeypatch.setattr(
+        BaseParticlesConverter, "_read_particles", counted_read_particles
+    )
+    tomo_list = ScipionSetOfTomograms(db_paths[SET_OF_TOMOGRAMS]).scipion_to_cets(
+        particles_db_path=coords_db_path
+    )
+    assert n_reads == 1
+    assert tomo_list is not None
+    assert {
+        tomo.tomo_id: [particle.position for particle in tomo.particle_set.particles]
+        for tomo in tomo_list
+        if tomo.particle_set is not None
+    } == _positions_by_tomo(coords_db_path)
+
+
+def test_particles_by_tomo_match_per_tomo(db_paths: Dict[str, Path]) -> None:
+    coords_reader = ScipionSetOfCoordinates3D(db_paths[SET_OF_COORDINATES_3D])
+    particle_sets = coords_reader.scipion_to_cets_by_tomo()
+    assert particle_sets is not None
+    assert list(particle_sets) == ["TS_001", "TS_002", "TS_003"]
+    for tomo_id, particle_set in particle_sets.items():
+        assert coords_reader.scipion_to_cets(tomo_id) == particle_set
+    # The dictionary has exactly the tomograms requested, in the same order
+    particle_sets = coords_reader.scipion_to_cets_by_tomo(["TS_003", "TS_001"])
+    assert particle_sets is not None
+    assert list(particle_sets) == ["TS_003", "TS_001"]
+
+
+@pytest.mark.parametrize(
+    "set_class", [ScipionSetOfCoordinates3D, ScipionSetOfSubtomogras]
+)
+def test_particles_streamed_by_tomo(db_paths: Dict[str, Path], set_class) -> None:
+    db_path = db_paths[
+        SET_OF_COORDINATES_3D
+        if set_class is ScipionSetOfCoordinates3D
+        else SET_OF_SUBTOMOGRAMS
+    ]
+    reader = set_class(db_path)
+    particle_sets = reader.scipion_to_cets_by_tomo()
+    assert particle_sets is not None
+    assert dict(reader.iter_cets()) == particle_sets
+    tomo_ids = ["TS_001", "TS_003"]
+    assert list(reader.iter_cets_by_tomo(tomo_ids)) == [
+        (tomo_id, particle_sets[tomo_id]) for tomo_id in tomo_ids
+    ]
+
+
+def test_particles_streamed_by_unsorted_tomo(db_paths: Dict[str, Path]) -> None:
+    coords_reader = ScipionSetOfCoordinates3D(db_paths[SET_OF_COORDINATES_3D])
+    particle_sets = coords_reader.iter_cets_by_tomo(["TS_003", "TS_001"])
+    assert next(particle_sets)[0] == "TS_003"
+    with pytest.raises(ValueError, match="sorted in ascending order"):
+        next(particle_sets)
+
+
+def test_particles_streamed_with_null_tomo(new_db_paths: Dict[str, Path]) -> None:
+    coords_db_path = new_db_paths[SET_OF_COORDINATES_3D]
+    coords_reader = ScipionSetOfCoordinates3D(coords_db_path)
+    particle_sets = coords_reader.scipion_to_cets_by_tomo()
+    assert particle_sets is not None
+    # The particles without tomogram do not belong to any of them
+    set_null(coords_db_path, TOMO_ID, "TS_002")
+    tomo_ids: List[Any] = [None, "TS_001", "TS_002"]
+    streamed: Dict[Any, Any] = dict(coords_reader.iter_cets_by_tomo(tomo_ids))
+    assert list(streamed) == tomo_ids
+    assert not streamed[None].particles and not streamed["TS_002"].particles
+    assert streamed["TS_001"] == particle_sets["TS_001"]
+
+
+def test_particles_stream_closed(
+    db_paths: Dict[str, Path], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    coords_reader = ScipionSetOfCoordinates3D(db_paths[SET_OF_COORDINATES_3D])
+    iter_cets = ScipionSetOfCoordinates3D.iter_cets
+    streams = []
+
+    def kept_iter_cets(self, *args, **kwargs):
+        streams.append(iter_cets(self, *args, **kwargs))
+        return streams[-1]
+
+    monkeypatch.setattr(ScipionSetOfCoordinates3D, "iter_cets", kept_iter_cets)
+    # Closed when the consumer stops early
+    particle_sets = cast(
+        Generator, coords_reader.iter_cets_by_tomo(["TS_001", "TS_002"])
+    )
+    next(particle_sets)
+    particle_sets.close()
+    # Also closed on errors
+    with pytest.raises(ValueError):
+        list(coords_reader.iter_cets_by_tomo(["TS_002", "TS_001"]))
+    assert len(streams) == 2
+    assert all(stream.gi_frame is None for stream in streams)
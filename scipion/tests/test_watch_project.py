@@ -0,0 +1,187 @@
+import os
+import queue
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+from typing import Dict, List
+
+import pytest
+
+from scipion.constants import (
+    OBJECTS_TBL,
+    SET_OF_COORDINATES_3D,
+    SET_OF_TILT_SERIES,
+)
+from scipion.scripts import watch_project
+from scipion.scripts.watch_project import ProjectWatcher, main
+from scipion.utils.utils import get_coords_yaml_file, get_ts_yaml_file
+from scipion.utils.utils_project import read_set_file
+
+
+class FakeClock:
+    """time.monotonic replacement advanced by the tests."""
+
+    def __init__(self) -> None:
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> FakeClock:
+    fake_clock = FakeClock()
+    monkeypatch.setattr(watch_project.time, "monotonic", fake_clock)
+    return fake_clock
+
+
+def _project_path(db_paths: Dict[str, Path]) -> Path:
+    return db_paths[SET_OF_TILT_SERIES].parents[2]
+
+
+def _append_row(db_path: Path) -> None:
+    """Appends a copy of the last row of a set, as Scipion does in streaming."""
+    with closing(sqlite3.connect(db_path)) as conn:
+        with conn:
+            row = conn.execute(
+                f'SELECT * FROM "{OBJECTS_TBL}" ORDER BY id DESC LIMIT 1'
+            ).fetchone()
+            placeholders = ", ".join("?" * len(row))
+            conn.execute(
+                f'INSERT INTO "{OBJECTS_TBL}" VALUES ({placeholders})',
+                (None, *row[1:]),
+            )
+    # Changed even if the row fits in a page and the clock is coarse
+    st = os.stat(db_path)
+    os.utime(db_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+def _take_queued(watcher: ProjectWatcher) -> List[Path]:
+    """Takes the sets queued for conversion, as the worker thread does."""
+    db_paths = []
+    while True:
+        try:
+            db_path = watcher._queue.get_nowait()
+        except queue.Empty:
+            break
+        assert db_path is not None
+        db_paths.append(db_path)
+    watcher._queued.difference_update(db_paths)
+    return db_paths
+
+
+def test_poll_debounce(
+    new_db_paths: Dict[str, Path], tmp_path: Path, clock: FakeClock
+) -> None:
+    ts_db_path = new_db_paths[SET_OF_TILT_SERIES].resolve()
+    watcher = ProjectWatcher(
+        _project_path(new_db_paths), tmp_path / "out", debounce=1.0, max_latency=10.0
+    )
+    # All the sets are new, so changed, but not stable for long enough yet
+    watcher.poll()
+    clock.now += 0.5
+    watcher.poll()
+    assert not _take_queued(watcher)
+    clock.now += 0.5
+    watcher.poll()
+    assert sorted(_take_queued(watcher)) == sorted(
+        p.resolve() for p in new_db_paths.values()
+    )
+    # A burst of rows is converted once, debounce seconds after the last one
+    for _ in range(3):
+        clock.now += 0.6
+        _append_row(ts_db_path)
+        watcher.poll()
+        assert not _take_queued(watcher)
+    clock.now += 0.9
+    watcher.poll()
+    assert not _take_queued(watcher)
+    clock.now += 0.1
+    watcher.poll()
+    assert _take_queued(watcher) == [ts_db_path]
+    clock.now += 5
+    watcher.poll()
+    assert not _take_queued(watcher)
+
+
+def test_poll_max_latency(
+    new_db_paths: Dict[str, Path], tmp_path: Path, clock: FakeClock
+) -> None:
+    ts_db_path = new_db_paths[SET_OF_TILT_SERIES].resolve()
+    watcher = ProjectWatcher(
+        _project_path(new_db_paths), tmp_path / "out", debounce=1.0, max_latency=3.0
+    )
+    watcher.poll(flush=True)
+    _take_queued(watcher)
+    # A set that never stops changing is converted after max_latency seconds
+    queued_at = []
+    for i in range(12):
+        _append_row(ts_db_path)
+        watcher.poll()
+        if _take_queued(watcher):
+            queued_at.append(i)
+        clock.now += 0.5
+    assert queued_at == [6]
+
+
+def test_poll_max_pending(
+    new_db_paths: Dict[str, Path], tmp_path: Path, clock: FakeClock
+) -> None:
+    watcher = ProjectWatcher(
+        _project_path(new_db_paths), tmp_path / "out", debounce=0.0, max_pending=2
+    )
+    # The sets that do not fit in the queue are queued in the next polls
+    n_sets = len(new_db_paths)
+    taken: List[Path] = []
+    watcher.poll()
+    while len(taken) < n_sets:
+        queued = _take_queued(watcher)
+        assert 0 < len(queued) <= 2
+        taken.extend(queued)
+        watcher.poll()
+    assert sorted(taken) == sorted(p.resolve() for p in new_db_paths.values())
+    # A set changed while queued is not queued twice
+    ts_db_path = new_db_paths[SET_OF_TILT_SERIES].resolve()
+    _append_row(ts_db_path)
+    watcher.poll()
+    _append_row(ts_db_path)
+    watcher.poll()
+    assert _take_queued(watcher) == [ts_db_path]
+    with pytest.raises(ValueError):
+        ProjectWatcher(_project_path(new_db_paths), tmp_path, max_pending=0)
+
+
+def test_run_flush_on_stop(new_db_paths: Dict[str, Path], tmp_path: Path) -> None:
+    out_directory = tmp_path / "out"
+    # Long debounce, so the sets are only converted by the flush on stop
+    watcher = ProjectWatcher(
+        _project_path(new_db_paths), out_directory, debounce=3600, max_latency=3600
+    )
+    watcher.stop()
+    watcher.run()
+    ts_set = read_set_file(new_db_paths[SET_OF_TILT_SERIES])
+    coords_set = read_set_file(new_db_paths[SET_OF_COORDINATES_3D])
+    assert ts_set is not None and coords_set is not None
+    assert watcher.n_converted > 0
+    for ts_id in ts_set.ids:
+        assert get_ts_yaml_file(ts_id, out_directory / ts_set.run_name).exists()
+    # The coordinates are converted within the tomograms
+    assert not get_coords_yaml_file(
+        coords_set.ids[0], out_directory / coords_set.run_name
+    ).exists()
+
+
+@pytest.mark.parametrize("value", ["0", "-2", "x"])
+def test_cli_invalid_max_pending(
+    new_db_paths: Dict[str, Path], tmp_path: Path, value: str
+) -> None:
+    with pytest.raises(SystemExit):
+        main(
+            [
+                str(_project_path(new_db_paths)),
+                "-o",
+                str(tmp_path),
+                "--max-pending",
+                value,
+            ]
+        )
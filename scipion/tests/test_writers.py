@@ -0,0 +1,109 @@
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import pytest
+import yaml
+
+from cets_data_model.models.models import TiltSeries
+from scipion.constants import SET_OF_CTF_TOMO_SERIES, SET_OF_TILT_SERIES
+from scipion.converters.tilt_series_set import ScipionSetOfTiltSeries
+from scipion.utils import utils
+from scipion.utils.utils import (
+    get_ts_yaml_file,
+    read_obj_yaml,
+    write_obj_yaml,
+    write_objs_yaml,
+    write_ts_set_yaml,
+)
+
+
+@pytest.fixture(scope="module")
+def ts_list(db_paths: Dict[str, Path]) -> List[TiltSeries]:
+    ts_reader = ScipionSetOfTiltSeries(db_paths[SET_OF_TILT_SERIES])
+    return list(ts_reader.iter_cets(ctf_db_path=db_paths[SET_OF_CTF_TOMO_SERIES]))
+
+
+def _tmp_files(directory: Path) -> List[Path]:
+    return list(directory.glob(".*.tmp"))
+
+
+@pytest.mark.parametrize("max_workers", [1, 3])
+def test_write_objs_yaml(
+    ts_list: List[TiltSeries], tmp_path: Path, max_workers: int
+) -> None:
+    yaml_files = write_ts_set_yaml(iter(ts_list), tmp_path, max_workers=max_workers)
+    # In the same order as introduced, whatever the order they were written
+    assert yaml_files == [get_ts_yaml_file(ts.ts_id, tmp_path) for ts in ts_list]
+    for ts, yaml_file in zip(ts_list, yaml_files):
+        assert read_obj_yaml(yaml_file, TiltSeries) == ts
+    assert not _tmp_files(tmp_path)
+
+
+@pytest.mark.parametrize("max_workers", [1, 3])
+def test_write_objs_yaml_failures(
+    ts_list: List[TiltSeries], tmp_path: Path, max_workers: int
+) -> None:
+    yaml_files = [tmp_path / f"{i}.yaml" for i in range(len(ts_list))]
+    # Not writable, as its directory does not exist
+    yaml_files[1] = tmp_path / "missing" / "1.yaml"
+    written = write_objs_yaml(zip(ts_list, yaml_files), max_workers=max_workers)
+    assert written == [f for i, f in enumerate(yaml_files) if i != 1]
+    assert not _tmp_files(tmp_path)
+
+
+def test_write_objs_yaml_lazily(
+    ts_list: List[TiltSeries], tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    max_workers, n_objs = 2, 20
+    lock = threading.Lock()
+    n_consumed, n_written, max_in_flight = 0, 0, 0
+
+    def slow_write(*args, **kwargs):
+        nonlocal n_written
+        time.sleep(0.005)
+        with lock:
+            n_written += 1
+        return True
+
+    def objs_and_files():
+        nonlocal n_consumed, max_in_flight
+        for i in range(n_objs):
+            with lock:
+                n_consumed += 1
+                max_in_flight = max(max_in_flight, n_consumed - n_written)
+            yield ts_list[0], tmp_path / f"{i}.yaml"
+
+    monkeypatch.setattr(utils, "write_obj_yaml", slow_write)
+    assert len(write_objs_yaml(objs_and_files(), max_workers=max_workers)) == n_objs
+    # The objects are consumed as they are written, at most two per worker
+    assert max_in_flight <= 2 * max_workers + 1
+
+
+def test_write_obj_yaml_atomic(
+    ts_list: List[TiltSeries], tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    yaml_file = tmp_path / "ts.yaml"
+    assert write_obj_yaml(ts_list[0], yaml_file)
+    content = yaml_file.read_bytes()
+
+    def failing_dump(*args, **kwargs):
+        raise yaml.YAMLError("Unable to dump")
+
+    monkeypatch.setattr(utils.yaml, "dump", failing_dump)
+    # A failed write keeps the previous file and removes the temporary one
+    assert not write_obj_yaml(ts_list[1], yaml_file)
+    assert yaml_file.read_bytes() == content
+    assert not _tmp_files(tmp_path)
+    assert not write_obj_yaml(ts_list[1], None)
+
+
+def test_read_obj_yaml(ts_list: List[TiltSeries], tmp_path: Path) -> None:
+    yaml_file = tmp_path / "ts.yaml"
+    assert write_obj_yaml(ts_list[0], yaml_file)
+    with open(yaml_file) as f:
+        assert f.readline().strip() == "---"
+    assert read_obj_yaml(yaml_file, TiltSeries) == ts_list[0]
+    with pytest.raises(FileNotFoundError):
+        read_obj_yaml(tmp_path / "missing.yaml", TiltSeries)
@@ -0,0 +1,161 @@
+import tracemalloc
+from pathlib import Path
+from typing import Dict
+
+import pytest
+import yaml
+
+from cets_data_model.models.models import Particle3DSet, TiltSeries, Tomogram
+from scipion.constants import (
+    SET_OF_COORDINATES_3D,
+    SET_OF_CTF_TOMO_SERIES,
+    SET_OF_SUBTOMOGRAMS,
+    SET_OF_TILT_SERIES,
+    SET_OF_TOMOGRAMS,
+)
+from scipion.converters.base_particles_converter import (
+    PARTICLE_MEMORY_BYTES,
+    BaseParticlesConverter,
+)
+from scipion.converters.coodinates3d import ScipionSetOfCoordinates3D
+from scipion.converters.subtomograms import ScipionSetOfSubtomogras
+from scipion.converters.tilt_series_set import ScipionSetOfTiltSeries
+from scipion.converters.tomograms_set import ScipionSetOfTomograms
+from scipion.utils.utils import read_obj_yaml, write_obj_yaml, write_particle_sets_yaml
+from scipion.utils.utils_filters import ConversionFilter
+from scipion.utils.utils_synthetic import SyntheticProject, write_synthetic_project
+from scipion.utils.utils_yaml import dump_compact_yaml
+
+PARTICLE_SETS = {
+    SET_OF_COORDINATES_3D: ScipionSetOfCoordinates3D,
+    SET_OF_SUBTOMOGRAMS: ScipionSetOfSubtomogras,
+}
+
+
+@pytest.mark.parametrize("set_class", list(PARTICLE_SETS))
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {"chunk_rows": 1},
+        {"chunk_rows": 4},
+        {"memory_budget_mb": 0.1},
+        {"filters": ConversionFilter(max_particles=5, patterns=["TS_00[13]"])},
+        {"tomo_ids": ["TS_001", "TS_003"], "chunk_rows": 3},
+    ],
+)
+def test_chunked_yaml_identical(
+    db_paths: Dict[str, Path], tmp_path: Path, set_class: str, kwargs: dict
+) -> None:
+    reader = PARTICLE_SETS[set_class](db_paths[set_class])
+    one_shot_dir, chunked_dir = tmp_path / "one_shot", tmp_path / "chunked"
+    one_shot_dir.mkdir()
+    particle_sets = reader.scipion_to_cets_by_tomo(
+        kwargs.get("tomo_ids"), filters=kwargs.get("filters")
+    )
+    assert particle_sets is not None
+    one_shot_files = write_particle_sets_yaml(particle_sets.items(), one_shot_dir)
+    # The output directory is created by the chunked conversion
+    chunked_files = reader.write_cets_yaml_chunked(chunked_dir, **kwargs)
+    assert [f.name for f in chunked_files] == sorted(f.name for f in one_shot_files)
+    for one_shot_file in one_shot_files:
+        chunked_file = chunked_dir / one_shot_file.name
+        assert chunked_file.read_bytes() == one_shot_file.read_bytes()
+
+
+@pytest.mark.parametrize("set_class", list(PARTICLE_SETS))
+def test_particle_memory(tmp_path: Path, set_class: str) -> None:
+    n_particles, small_chunk = 400, 20
+    db_path = write_synthetic_project(
+        tmp_path / "project",
+        SyntheticProject(
+            n_tilt_series=1,
+            n_tilt_images=3,
+            n_tomograms=1,
+            n_particles=n_particles,
+            ts_size=(64, 64),
+            tomo_size=(64, 64, 32),
+        ),
+    )[set_class]
+    reader = PARTICLE_SETS[set_class](db_path)
+    reader.write_cets_yaml_chunked(tmp_path / "warm_up")  # Fill the caches
+    peaks = []
+    for chunk_rows in (small_chunk, n_particles):
+        tracemalloc.start()
+        try:
+            reader.write_cets_yaml_chunked(
+                tmp_path / str(chunk_rows), chunk_rows=chunk_rows
+            )
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+    # Memory held per particle added to the chunk
+    particle_bytes = (peaks[1] - peaks[0]) / (n_particles - small_chunk)
+    assert PARTICLE_MEMORY_BYTES / 4 < particle_bytes < PARTICLE_MEMORY_BYTES
+
+
+def test_chunk_rows_from_memory_budget() -> None:
+    get_chunk_rows = BaseParticlesConverter._get_chunk_rows
+    assert get_chunk_rows(100, None) == 100
+    assert get_chunk_rows(10**6, 1) == 2**20 // PARTICLE_MEMORY_BYTES
+    assert get_chunk_rows(10, 1) == 10
+    assert get_chunk_rows(100, 0.001) == 1
+    with pytest.raises(ValueError):
+        get_chunk_rows(0, 1)
+
+
+@pytest.mark.parametrize("set_class", list(PARTICLE_SETS))
+def test_chunked_compact_yaml(
+    db_paths: Dict[str, Path], tmp_path: Path, set_class: str
+) -> None:
+    reader = PARTICLE_SETS[set_class](db_paths[set_class])
+    particle_sets = reader.scipion_to_cets_by_tomo()
+    assert particle_sets is not None
+    compact_files = reader.write_cets_yaml_chunked(
+        tmp_path, chunk_rows=3, compact_yaml=True
+    )
+    assert len(compact_files) == len(particle_sets)
+    for (tomo_id, particle_set), compact_file in zip(
+        particle_sets.items(), compact_files
+    ):
+        assert tomo_id in compact_file.name
+        assert read_obj_yaml(compact_file, Particle3DSet) == particle_set
+
+
+def _convert_all(db_paths: Dict[str, Path]) -> list:
+    ts_reader = ScipionSetOfTiltSeries(db_paths[SET_OF_TILT_SERIES])
+    tomo_reader = ScipionSetOfTomograms(db_paths[SET_OF_TOMOGRAMS])
+    return [
+        *ts_reader.iter_cets(ctf_db_path=db_paths[SET_OF_CTF_TOMO_SERIES]),
+        *tomo_reader.iter_cets(particles_db_path=db_paths[SET_OF_SUBTOMOGRAMS]),
+    ]
+
+
+def test_compact_yaml_round_trip(db_paths: Dict[str, Path], tmp_path: Path) -> None:
+    for i, cets_obj in enumerate(_convert_all(db_paths)):
+        plain_file, compact_file = tmp_path / f"{i}.yaml", tmp_path / f"{i}_c.yaml"
+        assert write_obj_yaml(cets_obj, plain_file)
+        assert write_obj_yaml(cets_obj, compact_file, compact=True)
+        assert compact_file.stat().st_size < plain_file.stat().st_size
+        model_class = TiltSeries if isinstance(cets_obj, TiltSeries) else Tomogram
+        assert read_obj_yaml(compact_file, model_class) == cets_obj
+        with open(plain_file) as plain, open(compact_file) as compact:
+            assert yaml.safe_load(compact) == yaml.safe_load(plain)
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        {"a": [0.0, -0.0, 1, 1.0, True], "b": [0.0, -0.0, 1, 1.0, True]},
+        [{"x": [1, 2]}, {"x": [1, 2]}, {"x": [1, 2], "y": None}, [[1], [1]]],
+        {"nested": {"k": {"v": 1}}, "other": {"k": {"v": 1}}, "empty": [{}, {}]},
+    ],
+)
+def test_compact_yaml_data_round_trip(tmp_path: Path, data: object) -> None:
+    yaml_file = tmp_path / "data.yaml"
+    with open(yaml_file, "w") as f:
+        dump_compact_yaml(data, f)
+    with open(yaml_file) as f:
+        loaded = yaml.safe_load(f)
+    assert loaded == data
+    assert repr(loaded) == repr(data)
@@ -1,15 +1,55 @@
+import itertools
+import logging
 import os
-import traceback
+import uuid
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from os import PathLike
 from pathlib import Path
-from typing import List
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+    TypeAlias,
+    TypeVar,
+    Union,
+)
 
 import yaml
+from pydantic import BaseModel
 
-from cets_data_model.models.models import TiltSeries, Tomogram, Particle3DSet
+from cets_data_model.models.models import (
+    TiltSeries,
+    Tomogram,
+    Particle3DSet,
+    Particle3D,
+)
+from scipion.utils.utils_instrumentation import Stage, MODEL_DUMP, YAML_WRITE
+from scipion.utils.utils_yaml import dump_compact_yaml
 
+logger = logging.getLogger(__name__)
 
-def validate_file(filename: PathLike, expected_ext: str) -> Path:
+CetsObject: TypeAlias = Union[TiltSeries, Tomogram, Particle3DSet]
+
+# libyaml-based dumper if PyYAML was built with it. Same output as yaml.Dumper
+YamlDumper = getattr(yaml, "CDumper", yaml.Dumper)
+# libyaml-based safe loader if PyYAML was built with it. Same result as yaml.SafeLoader
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Field of Particle3DSet streamed by ParticleSetYamlWriter
+PARTICLES_KEY = "particles"
+
+# Number of threads used to write the files of a set
+DEFAULT_YAML_WRITERS = min(8, os.cpu_count() or 1)
+
+M = TypeVar("M", bound=BaseModel)
+
+
+def validate_file(filename: PathLike | str, expected_ext: str) -> Path:
     if filename is None:
         raise ValueError("The introduced file cannot be None")
     p = Path(filename).expanduser()
@@ -37,40 +77,267 @@ def validate_new_file(in_file: Path | str) -> Path:
     return in_file
 
 
-def write_ts_set_yaml(ts_list: List[TiltSeries], output_directory: Path) -> None:
-    for ts in ts_list:
-        output_file = output_directory / f"tilt_series_{ts.ts_id}_scipion_to_cets.yaml"
-        write_obj_yaml(ts, output_file)
+def get_ts_yaml_file(ts_id: str, output_directory: Path) -> Path:
+    return output_directory / f"tilt_series_{ts_id}_scipion_to_cets.yaml"
+
+
+def get_tomo_yaml_file(tomo_id: str, output_directory: Path) -> Path:
+    return output_directory / f"tomogram_{tomo_id}_scipion_to_cets.yaml"
+
 
+def get_coords_yaml_file(tomo_id: str, output_directory: Path) -> Path:
+    return output_directory / f"coordinates_{tomo_id}_scipion_to_cets.yaml"
 
-def write_tomo_set_yaml(tomo_list: List[Tomogram], output_directory: Path) -> None:
-    for tomo in tomo_list:
-        output_file = output_directory / f"tomogram_{tomo.tomo_id}_scipion_to_cets.yaml"
-        write_obj_yaml(tomo, output_file)
+
+def write_ts_set_yaml(
+    ts_list: Iterable[TiltSeries],
+    output_directory: Path,
+    max_workers: int = DEFAULT_YAML_WRITERS,
+    compact: bool = False,
+) -> List[Path]:
+    return write_objs_yaml(
+        ((ts, get_ts_yaml_file(ts.ts_id, output_directory)) for ts in ts_list),
+        max_workers=max_workers,
+        compact=compact,
+    )
+
+
+def write_tomo_set_yaml(
+    tomo_list: Iterable[Tomogram],
+    output_directory: Path,
+    max_workers: int = DEFAULT_YAML_WRITERS,
+    compact: bool = False,
+) -> List[Path]:
+    return write_objs_yaml(
+        (
+            (tomo, get_tomo_yaml_file(tomo.tomo_id, output_directory))
+            for tomo in tomo_list
+        ),
+        max_workers=max_workers,
+        compact=compact,
+    )
 
 
 def write_coords_set_yaml(
-    coordinates: Particle3DSet, tomo_id: str, output_directory: Path
+    coordinates: Particle3DSet,
+    tomo_id: str,
+    output_directory: Path,
+    compact: bool = False,
 ) -> None:
-    output_file = output_directory / f"coordinates_{tomo_id}_scipion_to_cets.yaml"
-    write_obj_yaml(coordinates, output_file)
+    write_obj_yaml(
+        coordinates, get_coords_yaml_file(tomo_id, output_directory), compact=compact
+    )
+
+
+def write_particle_sets_yaml(
+    particle_sets: Iterable[Tuple[str, Particle3DSet]],
+    output_directory: Path,
+    max_workers: int = DEFAULT_YAML_WRITERS,
+    compact: bool = False,
+) -> List[Path]:
+    """Writes one file per tomogram from pairs of tomogram identifier and
+    Particle3DSet, e.g. as yielded by the iter_cets method of the particle
+    converters."""
+    return write_objs_yaml(
+        (
+            (coordinates, get_coords_yaml_file(tomo_id, output_directory))
+            for tomo_id, coordinates in particle_sets
+        ),
+        max_workers=max_workers,
+        compact=compact,
+    )
+
+
+def write_objs_yaml(
+    objs_and_files: Iterable[Tuple[CetsObject, Path | str]],
+    max_workers: int = DEFAULT_YAML_WRITERS,
+    compact: bool = False,
+) -> List[Path]:
+    """Writes several CETS objects, each one to its own file, using a pool of
+    threads. The objects are consumed lazily, keeping at most two per worker in
+    flight, so a stream (e.g. the iter_cets method of the converters) is never
+    fully loaded in memory.
+
+    :param objs_and_files: pairs of CETS object and .yaml file to be written.
+    :param max_workers: number of threads. If 1, the files are written serially.
+    :param compact: if True, the files are written in compact YAML. See
+    write_obj_yaml.
+    :return: the files successfully written, in the same order as introduced.
+    """
+    if max_workers <= 1:
+        return [
+            Path(yaml_file)
+            for cets_obj, yaml_file in objs_and_files
+            if write_obj_yaml(cets_obj, yaml_file, compact=compact)
+        ]
+    submitted: List[Tuple[Future, Path]] = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending: Set[Future] = set()
+        for cets_obj, yaml_file in objs_and_files:
+            if len(pending) >= 2 * max_workers:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+            future = executor.submit(write_obj_yaml, cets_obj, yaml_file, compact)
+            pending.add(future)
+            submitted.append((future, Path(yaml_file)))
+    return [yaml_file for future, yaml_file in submitted if future.result()]
 
 
 def write_obj_yaml(
-    cets_ts_md: TiltSeries | Tomogram | Particle3DSet, yaml_file: Path | str | None
-) -> None:
+    cets_ts_md: CetsObject, yaml_file: Path | str | None, compact: bool = False
+) -> bool:
+    """Writes a CETS object to a .yaml file. The file is first written to a
+    temporary file in the same directory, which then replaces the target, so
+    readers never see a partially written file. Returns True if the file was
+    written.
+
+    If compact is True, the repeated blocks (e.g. the coordinate systems of the
+    tilt-images or the names, input and output of the transformations of the
+    particles) are written once and then referenced with YAML aliases and merge
+    keys, and the vectors and matrix rows in flow style. See compact_yaml_data.
+    Any YAML loader expands them, e.g. read_obj_yaml."""
     if yaml_file is None:
-        print("write_yaml -> yaml_file is None. Skipping...")
-        return
+        logger.warning("write_yaml -> yaml_file is None. Skipping...")
+        return False
+    tmp_file: Path | None = None
     try:
-        yaml_file = validate_new_file(yaml_file)
-        metadata_dict = cets_ts_md.model_dump(mode="json")
-        with open(yaml_file, "a") as f:
-            yaml.dump(metadata_dict, f, sort_keys=False, explicit_start=True)
-        print(f"yaml file successfully written! -> {yaml_file}")
+        yaml_file = Path(yaml_file).expanduser()
+        with Stage(MODEL_DUMP, items=1):
+            metadata_dict = cets_ts_md.model_dump(mode="json")
+        tmp_file = yaml_file.with_name(f".{yaml_file.name}.{uuid.uuid4().hex}.tmp")
+        with Stage(YAML_WRITE, items=1) as stage:
+            with open(tmp_file, "x") as f:
+                if compact:
+                    dump_compact_yaml(metadata_dict, f, explicit_start=True)
+                else:
+                    yaml.dump(
+                        metadata_dict,
+                        f,
+                        Dumper=YamlDumper,
+                        sort_keys=False,
+                        explicit_start=True,
+                    )
+                stage.n_bytes = f.tell()
+            os.replace(tmp_file, yaml_file)
+        logger.info("yaml file successfully written! -> %s", yaml_file)
+        return True
     except Exception as e:
-        print(
-            f"Unable to write the output yaml file {yaml_file} with "
-            f"the exception -> {e}"
+        if tmp_file is not None and tmp_file.exists():
+            tmp_file.unlink()
+        logger.exception(
+            "Unable to write the output yaml file %s with the exception -> %s",
+            yaml_file,
+            e,
+        )
+        return False
+
+
+def read_obj_yaml(yaml_file: Path | str, model_class: Type[M]) -> M:
+    """Reads a CETS object from a .yaml file written by write_obj_yaml or
+    ParticleSetYamlWriter, compact or not.
+
+    :param yaml_file: .yaml file to be read.
+    :param model_class: class of the CETS object, e.g. TiltSeries.
+    """
+    with open(Path(yaml_file).expanduser()) as f:
+        return model_class.model_validate(yaml.load(f, Loader=YamlLoader))
+
+
+class ParticleSetYamlWriter:
+    """Writes a Particle3DSet to a .yaml file a chunk of particles at a time, so
+    the particles of a tomogram are never all in memory. The file is identical to
+    the one written by write_obj_yaml for the whole set: the fields of the set
+    are dumped as in the complete document and the particles are appended to its
+    sequence as they arrive. As in write_obj_yaml, the particles are written to a
+    temporary file, which replaces the target when the writer is closed without
+    errors. If compact is True, each chunk is written in compact YAML (see
+    write_obj_yaml), the repeated blocks being shared within the chunk.
+
+    Example:
+        with ParticleSetYamlWriter(yaml_file, Particle3DSet(...)) as writer:
+            for particles in particle_chunks:
+                writer.write(particles)
+    """
+
+    def __init__(
+        self,
+        yaml_file: Path | str,
+        particle_set: Particle3DSet,
+        compact: bool = False,
+    ):
+        """
+        :param yaml_file: .yaml file to be written.
+        :param particle_set: fields of the set, e.g. the coordinate systems. Its
+        particles, if any, are written first.
+        :param compact: if True, the file is written in compact YAML.
+        """
+        self.yaml_file = Path(yaml_file).expanduser()
+        self.compact = compact
+        self.n_particles = 0
+        # The anchors must be unique in the whole document
+        self._anchor_ids = itertools.count(1)
+        set_dict = particle_set.model_dump(mode="json", exclude={PARTICLES_KEY})
+        keys = list(type(particle_set).model_fields)
+        i = keys.index(PARTICLES_KEY)
+        self._head = {key: set_dict[key] for key in keys[:i] if key in set_dict}
+        self._tail = {key: set_dict[key] for key in keys[i + 1 :] if key in set_dict}
+        self._tmp_file = self.yaml_file.with_name(
+            f".{self.yaml_file.name}.{uuid.uuid4().hex}.tmp"
         )
-        print(traceback.format_exc())
+        self._file = open(self._tmp_file, "x")
+        try:
+            self._file.write("---\n")
+            self._dump(self._head)
+            self.write(particle_set.particles)
+        except Exception:
+            self.discard()
+            raise
+
+    def __enter__(self) -> "ParticleSetYamlWriter":
+        return self
+
+    def __exit__(self, exc_type: Any, *exc_info: Any) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def write(self, particles: Sequence[Particle3D]) -> None:
+        """Appends a chunk of particles to the set."""
+        if not particles:
+            return
+        with Stage(MODEL_DUMP, items=len(particles)):
+            particle_dicts = [
+                particle.model_dump(mode="json") for particle in particles
+            ]
+        if not self.n_particles:
+            self._file.write(f"{PARTICLES_KEY}:\n")
+        # At the top level, a sequence is dumped as in a mapping value
+        self._dump(particle_dicts)
+        self.n_particles += len(particles)
+
+    def close(self) -> None:
+        """Writes the remaining fields of the set and moves the file onto its
+        target."""
+        if not self.n_particles:
+            self._dump({PARTICLES_KEY: []})
+        self._dump(self._tail)
+        with Stage(YAML_WRITE, items=1) as stage:
+            stage.n_bytes = self._file.tell()
+            self._file.close()
+            os.replace(self._tmp_file, self.yaml_file)
+        logger.info("yaml file successfully written! -> %s", self.yaml_file)
+
+    def discard(self) -> None:
+        """Closes and removes the temporary file, leaving the target untouched."""
+        self._file.close()
+        if self._tmp_file.exists():
+            self._tmp_file.unlink()
+
+    def _dump(self, data: Dict[str, Any] | List[Any]) -> None:
+        if not data:
+            return
+        with Stage(YAML_WRITE):
+            if self.compact:
+                dump_compact_yaml(data, self._file, anchor_ids=self._anchor_ids)
+            else:
+                yaml.dump(data, self._file, Dumper=YamlDumper, sort_keys=False)
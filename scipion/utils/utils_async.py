@@ -0,0 +1,292 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterable,
+    Callable,
+    Iterable,
+    List,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+from scipion.utils.utils import CetsObject, write_obj_yaml
+from scipion.utils.utils_mrc import MRC_HEADER_CACHE
+from scipion.utils.utils_sqlite import ConnectionScope
+
+# Threads of the process-wide pool, shared by all the requests
+DEFAULT_ASYNC_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+# Max blocking calls of a request running at once
+DEFAULT_REQUEST_CONCURRENCY = 4
+# Objects converted ahead of the consumer by the async iterators
+DEFAULT_PREFETCH = 2
+
+T = TypeVar("T")
+
+# Returned by the steps of an iterator when exhausted
+_DONE = object()
+
+
+class AsyncConversionPool:
+    """Bounded pool of threads in which the async API of the converters runs the
+    blocking work: sqlite reads, MRC header reads and YAML writes. A service
+    should share one pool among all its requests, creating an AsyncRequest per
+    request with its own concurrency limit, so the threads never exceed
+    max_workers and a huge project cannot take all of them.
+
+    Example:
+        pool = AsyncConversionPool()
+        request = pool.request(max_concurrency=2)
+        async for ts in ts_converter.aiter_cets(request=request):
+            ...
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_ASYNC_WORKERS):
+        """
+        :param max_workers: number of threads.
+        :type max_workers: int, optional. Defaults to DEFAULT_ASYNC_WORKERS.
+        """
+        if max_workers < 1:
+            raise ValueError(
+                f"The number of threads must be greater than 0: {max_workers}"
+            )
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="cets-scipion"
+        )
+
+    def __enter__(self) -> "AsyncConversionPool":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.shutdown()
+
+    def request(
+        self, max_concurrency: int = DEFAULT_REQUEST_CONCURRENCY
+    ) -> "AsyncRequest":
+        """Returns a new request running in the pool at most max_concurrency
+        blocking calls at once."""
+        return AsyncRequest(self, max_concurrency)
+
+    def submit(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> Future:
+        return self._executor.submit(func, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stops the threads once the calls submitted finish. The calls not
+        started yet are cancelled."""
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+
+_default_pool: AsyncConversionPool | None = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool() -> AsyncConversionPool:
+    """Process-wide pool, created on first use, used when no request is
+    introduced to the async methods of the converters."""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = AsyncConversionPool()
+        return _default_pool
+
+
+class AsyncRequest:
+    """Conversions of one request (e.g. a project) on an AsyncConversionPool. At
+    most max_concurrency of its blocking calls run at once, whatever the number
+    of conversions of the request running concurrently.
+
+    Cancellation: a blocking call cannot be interrupted once running in its
+    thread, so a cancelled call finishes in the background (its result is
+    discarded) and keeps its slot of the request until then. The async
+    iterators are blocking one object at a time, so they stop after the object
+    being converted.
+    """
+
+    def __init__(
+        self,
+        pool: AsyncConversionPool,
+        max_concurrency: int = DEFAULT_REQUEST_CONCURRENCY,
+    ):
+        if max_concurrency < 1:
+            raise ValueError(
+                f"The max concurrency must be greater than 0: {max_concurrency}"
+            )
+        self.pool = pool
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Runs a blocking call in a thread of the pool, once the request has a
+        free slot."""
+        await self._semaphore.acquire()
+        try:
+            future = self.pool.submit(func, *args, **kwargs)
+        except BaseException:
+            self._semaphore.release()
+            raise
+        loop = asyncio.get_running_loop()
+
+        def release(_: Future) -> None:
+            try:
+                loop.call_soon_threadsafe(self._semaphore.release)
+            except RuntimeError:  # The loop is closed
+                pass
+
+        # Released when the call finishes, even if the caller was cancelled
+        future.add_done_callback(release)
+        return await asyncio.wrap_future(future)
+
+    async def map(self, func: Callable[..., T], items: Iterable[Any]) -> List[T]:
+        """Runs func on each item concurrently, within the limit of the request.
+        Returns the results in the same order as the items."""
+        return list(await asyncio.gather(*(self.run(func, item) for item in items)))
+
+    async def iterate(
+        self, iterable: Iterable[T], prefetch: int = DEFAULT_PREFETCH
+    ) -> AsyncGenerator[T, None]:
+        """Async iterator over a blocking iterable, e.g. a generator reading
+        sqlite files. Each object is produced by a call run in the pool, and up
+        to prefetch objects are kept ready ahead of the consumer, so the
+        production of the next objects overlaps with the processing of the
+        current one. When the iteration ends, is cancelled or the iterator is
+        closed, the iterable is closed too (in a thread, once the object in
+        progress, if any, is done), even if the pool has been shut down.
+
+        :param iterable: blocking iterable. It is advanced one step at a time,
+        but not always from the same thread, so the sqlite connections it opens
+        with connect_db are its own instead of the ones of the threads in the
+        pool (see ConnectionScope). They are closed with the iterable.
+        :param prefetch: max number of objects kept ready for the consumer.
+        """
+        if prefetch < 1:
+            raise ValueError(f"The prefetch must be greater than 0: {prefetch}")
+        iterator = _SteppedIterator(iterable)
+        queue: asyncio.Queue[Tuple[Any, BaseException | None]] = asyncio.Queue(
+            maxsize=prefetch
+        )
+
+        async def produce() -> None:
+            try:
+                while True:
+                    item = await self.run(iterator.next)
+                    await queue.put((item, None))
+                    if item is _DONE:
+                        return
+            except Exception as e:
+                await queue.put((_DONE, e))
+
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                item, error = await queue.get()
+                if error is not None:
+                    raise error
+                if item is _DONE:
+                    return
+                yield item
+        finally:
+            producer.cancel()
+            try:
+                self.pool.submit(iterator.close)
+            except RuntimeError:
+                # The pool is shut down: closed in a thread of its own, so the
+                # exception being raised, if any, is not replaced
+                threading.Thread(
+                    target=iterator.close, name="cets-scipion-close"
+                ).start()
+
+
+class _SteppedIterator:
+    """Iterator advanced from the threads of a pool, one step at a time, with
+    its own sqlite connections."""
+
+    def __init__(self, iterable: Iterable[Any]):
+        self._connections = ConnectionScope()
+        with self._connections.activate():
+            self._iterator = iter(iterable)
+        self._lock = threading.Lock()
+
+    def next(self) -> Any:
+        with self._lock, self._connections.activate():
+            return next(self._iterator, _DONE)
+
+    def close(self) -> None:
+        with self._lock:
+            try:
+                close = getattr(self._iterator, "close", None)
+                if close is not None:
+                    with self._connections.activate():
+                        close()
+            finally:
+                self._connections.close()
+
+
+def get_request(request: AsyncRequest | None) -> AsyncRequest:
+    """The introduced request or, if None, a new one on the default pool."""
+    return get_default_pool().request() if request is None else request
+
+
+async def aprefetch_mrc_headers(
+    filenames: Iterable[os.PathLike | str], request: AsyncRequest | None = None
+) -> None:
+    """Reads the headers of several MRC files concurrently into the process-wide
+    MRC header cache, so the conversions that reference them do not wait for
+    their reads one at a time. The files are read at most once, within the
+    concurrency limit of request."""
+    await get_request(request).map(MRC_HEADER_CACHE.get, dict.fromkeys(filenames))
+
+
+async def awrite_objs_yaml(
+    objs_and_files: AsyncIterable[Tuple[CetsObject, Path | str]]
+    | Iterable[Tuple[CetsObject, Path | str]],
+    request: AsyncRequest | None = None,
+    compact: bool = False,
+) -> List[Path]:
+    """Async counterpart of write_objs_yaml: the files are written in the pool,
+    concurrently within the limit of request, while the objects arrive, e.g.
+    from the aiter_cets method of the converters.
+
+    :param objs_and_files: pairs of CETS object and .yaml file to be written.
+    :param request: request in which the files are written. If None, a new
+    one on the default pool.
+    :param compact: if True, the files are written in compact YAML. See
+    write_obj_yaml.
+    :return: the files successfully written, in the same order as introduced.
+    """
+    request = get_request(request)
+    submitted: List[Tuple[asyncio.Task, Path]] = []
+    pending: Set[asyncio.Task] = set()
+
+    async def submit(cets_obj: CetsObject, yaml_file: Path | str) -> None:
+        nonlocal pending
+        # At most two objects per slot of the request in memory, as in
+        # write_objs_yaml
+        if len(pending) >= 2 * request.max_concurrency:
+            _, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+        task = asyncio.create_task(
+            request.run(write_obj_yaml, cets_obj, yaml_file, compact)
+        )
+        pending.add(task)
+        submitted.append((task, Path(yaml_file)))
+
+    try:
+        if isinstance(objs_and_files, AsyncIterable):
+            async for cets_obj, yaml_file in objs_and_files:
+                await submit(cets_obj, yaml_file)
+        else:
+            for cets_obj, yaml_file in objs_and_files:
+                await submit(cets_obj, yaml_file)
+        await asyncio.gather(*pending)
+    except BaseException:
+        for task in pending:
+            task.cancel()
+        raise
+    return [yaml_file for task, yaml_file in submitted if task.result()]
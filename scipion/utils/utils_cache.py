@@ -0,0 +1,225 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import threading
+import uuid
+from importlib import metadata
+from pathlib import Path
+from typing import Any, Callable, Iterable, List, Tuple, TypeVar
+
+import numpy as np
+from pydantic import BaseModel
+
+from scipion.converters.ctf_table import CTFSeries
+from scipion.utils.utils_instrumentation import (
+    REPORT,
+    CONVERSION_CACHE_HITS,
+    CONVERSION_CACHE_MISSES,
+)
+from scipion.utils.utils_mrc import MRC_HEADER_CACHE, MrcHeaderCache, HeaderKey
+from scipion.utils.utils_sqlite import connect_db, map_properties_table
+
+logger = logging.getLogger(__name__)
+
+# Version of the cache entries. To be increased whenever the result of the
+# converters changes, so the entries written by previous versions are not used
+CACHE_VERSION = 1
+CACHE_FILE_EXT = ".pkl"
+DEFAULT_CACHE_SIZE_MB = 1024
+
+T = TypeVar("T")
+
+
+def get_default_cache_dir() -> Path:
+    """$XDG_CACHE_HOME/cets-scipion, or ~/.cache/cets-scipion."""
+    cache_home = os.environ.get("XDG_CACHE_HOME", None)
+    return (Path(cache_home) if cache_home else Path.home() / ".cache") / "cets-scipion"
+
+
+def get_sqlite_fingerprint(db_path: os.PathLike | str) -> List[Any]:
+    """Fingerprint of a Scipion set sqlite file: its path, the size and
+    modification time of the file and of its write-ahead log, if any, and the
+    content of the table Properties (e.g. the stream state)."""
+    db_path = Path(db_path).expanduser().resolve()
+    fingerprint: List[Any] = [str(db_path)]
+    for file_path in (db_path, db_path.with_name(f"{db_path.name}-wal")):
+        try:
+            st = file_path.stat()
+            fingerprint.extend([st.st_size, st.st_mtime_ns])
+        except FileNotFoundError:
+            fingerprint.extend([None, None])
+    conn = connect_db(db_path)
+    properties = map_properties_table(conn) if conn is not None else {}
+    fingerprint.append(sorted(properties.items()))
+    return fingerprint
+
+
+class ConversionCache:
+    """On-disk cache of the results of the conversions, so converting again the
+    same (finished) Scipion sets with the same parameters returns the pickled
+    result instead of converting them.
+
+    The entries are content-addressed: the key of an entry is a hash of the
+    converter, its parameters and the fingerprint of the sqlite files read (see
+    get_sqlite_fingerprint). The MRC files whose headers are read by the
+    conversion are recorded along with the result, and the entry is only used if
+    none of them has changed (same size and modification time). When the total
+    size of the entries exceeds max_size_mb, the least recently used entries are
+    removed.
+
+    The entries are pickle files, so the cache directory must only be writable
+    by trusted users.
+    """
+
+    def __init__(
+        self,
+        cache_dir: os.PathLike | str | None = None,
+        max_size_mb: float = DEFAULT_CACHE_SIZE_MB,
+    ):
+        """
+        :param cache_dir: directory in which the entries are stored.
+        :type cache_dir: os.PathLike or str, optional. Defaults to the result of
+        get_default_cache_dir.
+
+        :param max_size_mb: max total size of the entries, in MiB.
+        :type max_size_mb: float, optional. Defaults to DEFAULT_CACHE_SIZE_MB.
+        """
+        if max_size_mb <= 0:
+            raise ValueError(f"The cache size must be greater than 0: {max_size_mb}")
+        self.cache_dir = Path(cache_dir or get_default_cache_dir()).expanduser()
+        self.max_size_mb = max_size_mb
+        self._lock = threading.Lock()
+
+    def get_key(
+        self,
+        converter: str,
+        db_paths: Iterable[os.PathLike | str | None],
+        **params: Any,
+    ) -> str:
+        """Key of the result of a conversion.
+
+        :param converter: name of the conversion, e.g. the converter class and
+        method.
+        :param db_paths: sqlite files read by the conversion. None values are
+        allowed, for the optional ones.
+        :param params: parameters of the conversion. They must be JSON-serializable,
+        pydantic models, NumPy arrays or CTFSeries.
+        """
+        content = [
+            CACHE_VERSION,
+            _get_package_version("cets-data-model"),
+            converter,
+            [
+                get_sqlite_fingerprint(db_path) if db_path else None
+                for db_path in db_paths
+            ],
+            params,
+        ]
+        serialized = json.dumps(content, default=_to_jsonable, sort_keys=True)
+        return hashlib.sha256(serialized.encode()).hexdigest()
+
+    def get_or_convert(self, key: str, convert: Callable[[], T]) -> T:
+        """Returns the result of key if cached and still valid. If not, it calls
+        convert and stores its result, along with the MRC files referenced."""
+        found, result = self.get(key)
+        if found:
+            REPORT.count(CONVERSION_CACHE_HITS)
+            return result
+        REPORT.count(CONVERSION_CACHE_MISSES)
+        with MRC_HEADER_CACHE.record() as mrc_keys:
+            result = convert()
+        self.put(key, result, mrc_keys)
+        return result
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        """Returns whether key is cached and valid and, if so, its result. The
+        invalid and unreadable entries are removed."""
+        entry_file = self._get_entry_file(key)
+        try:
+            with open(entry_file, "rb") as f:
+                version, mrc_keys = pickle.load(f)
+                if version == CACHE_VERSION and all(
+                    MrcHeaderCache.is_current(mrc_key) for mrc_key in mrc_keys
+                ):
+                    result = pickle.load(f)
+                    # The modification time is the last use, for the LRU eviction
+                    os.utime(entry_file)
+                    return True, result
+        except FileNotFoundError:
+            return False, None
+        except Exception as e:
+            logger.warning("Unable to read the cache entry %s -> %s", entry_file, e)
+        entry_file.unlink(missing_ok=True)
+        return False, None
+
+    def put(self, key: str, result: Any, mrc_keys: Iterable[HeaderKey] = ()) -> None:
+        """Stores the result of key, along with the keys of the MRC files it
+        references, and evicts the least recently used entries if required."""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entry_file = self._get_entry_file(key)
+        tmp_file = entry_file.with_name(f".{entry_file.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_file, "xb") as f:
+                pickle.dump((CACHE_VERSION, sorted(mrc_keys)), f)
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, entry_file)
+        finally:
+            tmp_file.unlink(missing_ok=True)
+        self._evict()
+
+    def clear(self) -> None:
+        """Removes all the entries."""
+        for entry_file in self._get_entry_files():
+            entry_file.unlink(missing_ok=True)
+
+    def _get_entry_file(self, key: str) -> Path:
+        return self.cache_dir / f"{key}{CACHE_FILE_EXT}"
+
+    def _get_entry_files(self) -> List[Path]:
+        if not self.cache_dir.is_dir():
+            return []
+        return list(self.cache_dir.glob(f"*{CACHE_FILE_EXT}"))
+
+    def _evict(self) -> None:
+        with self._lock:
+            entries = []
+            for entry_file in self._get_entry_files():
+                try:
+                    st = entry_file.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, entry_file))
+            total_size = sum(size for _, size, _ in entries)
+            max_size = self.max_size_mb * 2**20
+            # Least recently used first
+            for _, size, entry_file in sorted(entries, key=lambda entry: entry[0]):
+                if total_size <= max_size:
+                    break
+                entry_file.unlink(missing_ok=True)
+                total_size -= size
+
+
+def _get_package_version(package: str) -> str | None:
+    try:
+        return metadata.version(package)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def _to_jsonable(value: Any) -> Any:
+    """Serializes the parameters of the conversions not supported by json."""
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    if isinstance(value, CTFSeries):
+        value = value.values
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        digest = hashlib.sha256(value.tobytes()).hexdigest()
+        return [str(value.dtype), list(value.shape), digest]
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    if isinstance(value, os.PathLike):
+        return str(Path(value).expanduser().resolve())
+    raise TypeError(f"Unable to use {type(value).__name__} in a cache key")
@@ -0,0 +1,100 @@
+from typing import Any, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+# SQL condition and its parameters
+SqlCondition = Tuple[str, List[Any]]
+
+
+class ConversionFilter(NamedTuple):
+    """Selection of the items of a Scipion set to be converted. The selection is
+    pushed into the SQL queries of the converters, so the rows not selected are
+    never returned by sqlite and the tables of the tilt-series not selected are
+    never read.
+
+    :param ids: tilt-series or tomogram identifiers to be converted.
+    :param patterns: glob patterns (sqlite GLOB: case sensitive, with *, ? and
+    [...]) of the tilt-series or tomogram identifiers to be converted, e.g.
+    "TS_1*". An identifier is selected if it matches any of them.
+    :param min_tilt_angle: min nominal tilt angle of the tilt-images, in degrees.
+    :param max_tilt_angle: max nominal tilt angle of the tilt-images, in degrees.
+    :param max_dose: max accumulated dose of the tilt-images.
+    :param min_particles: min number of particles of the tomograms to be converted.
+    :param max_particles: max number of particles converted per tomogram, the
+    first ones in the set.
+    """
+
+    ids: Optional[Sequence[str]] = None
+    patterns: Optional[Sequence[str]] = None
+    min_tilt_angle: Optional[float] = None
+    max_tilt_angle: Optional[float] = None
+    max_dose: Optional[float] = None
+    min_particles: Optional[int] = None
+    max_particles: Optional[int] = None
+
+    def get_signature(self) -> List[Any]:
+        """JSON-serializable representation of the filters, so the incremental
+        conversions (see ConversionState) detect when they change."""
+        return [
+            list(value) if isinstance(value, (list, tuple)) else value for value in self
+        ]
+
+
+def get_id_condition(
+    column: str,
+    ids: Iterable[str] | None = None,
+    filters: ConversionFilter | None = None,
+) -> SqlCondition:
+    """Condition selecting the rows whose identifier (in column) is in ids and
+    passes the ids and patterns of the filters. An empty condition selects all.
+    """
+    conditions = []
+    for id_list in (ids, filters.ids if filters else None):
+        if id_list is not None:
+            id_list = list(id_list)
+            placeholders = ", ".join("?" * len(id_list))
+            conditions.append((f'"{column}" IN ({placeholders})', id_list))
+    if filters is not None and filters.patterns is not None:
+        patterns = list(filters.patterns)
+        glob_sql = " OR ".join(f'"{column}" GLOB ?' for _ in patterns)
+        conditions.append((f"({glob_sql or '0'})", patterns))
+    return join_conditions(conditions)
+
+
+def get_tilt_image_condition(
+    tilt_angle_column: str | None,
+    dose_column: str | None,
+    filters: ConversionFilter | None = None,
+) -> SqlCondition:
+    """Condition selecting the tilt-images that pass the tilt angle and dose
+    limits of the filters. An empty condition selects all."""
+    conditions: List[SqlCondition] = []
+    if filters is None:
+        return join_conditions(conditions)
+    limits = [
+        (tilt_angle_column, ">=", filters.min_tilt_angle, "tilt angle"),
+        (tilt_angle_column, "<=", filters.max_tilt_angle, "tilt angle"),
+        (dose_column, "<=", filters.max_dose, "accumulated dose"),
+    ]
+    for column, operator, limit, name in limits:
+        if limit is None:
+            continue
+        if column is None:
+            raise ValueError(f"Unable to filter by {name}: not stored in the set")
+        conditions.append((f'"{column}" {operator} ?', [limit]))
+    return join_conditions(conditions)
+
+
+def join_conditions(conditions: Iterable[SqlCondition]) -> SqlCondition:
+    """Joins several conditions with AND, into the condition of a WHERE clause.
+    The empty conditions are skipped."""
+    sql_list, params = [], []
+    for sql, sql_params in conditions:
+        if sql:
+            sql_list.append(sql)
+            params.extend(sql_params)
+    return " AND ".join(sql_list), params
+
+
+def get_where_clause(condition: SqlCondition) -> SqlCondition:
+    """WHERE clause of a condition, or an empty string if it selects all."""
+    sql, params = condition
+    return (f" WHERE {sql}" if sql else ""), params
@@ -0,0 +1,397 @@
+import functools
+import json
+import os
+import uuid
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Protocol, Sequence, Tuple
+
+import numpy as np
+
+from cets_data_model.models.models import TiltSeries, TiltImage, CTFMetadata
+from scipion.converters.ctf_table import CTF_COLUMNS, CTFSeries
+from scipion.converters.particle_table import PARTICLE_DTYPE, ParticleTable
+from scipion.utils.utils import write_obj_yaml, read_obj_yaml
+from scipion.utils.utils_instrumentation import Stage, FORMAT_WRITE, get_file_size
+
+# Supported output formats
+YAML_FORMAT = "yaml"
+COMPACT_YAML_FORMAT = "compact-yaml"
+JSONL_FORMAT = "jsonl"
+NPZ_FORMAT = "npz"
+PARQUET_FORMAT = "parquet"
+
+# Kinds of objects written
+TILT_SERIES_KIND = "tilt_series"
+PARTICLES_KIND = "particles"
+CTF_KIND = "ctf"
+
+# Key of the tilt-series images, written one per line in the JSON Lines format
+_TS_IMAGES_KEY = "images"
+
+# Suffix of the NPZ arrays flagging the empty (None) values of an array of
+# identifiers, stored as empty strings
+_NULL_SUFFIX = "_null"
+
+
+class FormatWriter(Protocol):
+    """Writer of an object to a file in a format, e.g. write_obj_yaml. Its
+    result, if any, is ignored."""
+
+    def __call__(self, obj: Any, out_file: Path | str, /) -> Any: ...
+
+
+class FormatReader(Protocol):
+    """Reader of an object from a file written by the FormatWriter of its
+    format."""
+
+    def __call__(self, in_file: Path | str, /) -> Any: ...
+
+
+def _atomic_path(out_file: Path) -> Path:
+    """Temporary file in the same directory as out_file, to be moved onto it
+    with os.replace once completely written."""
+    return out_file.with_name(f".{out_file.name}.{uuid.uuid4().hex}.tmp")
+
+
+def _encode_ids(name: str, ids: Sequence[str | None]) -> Dict[str, np.ndarray]:
+    """NPZ arrays of a list of identifiers, which may be empty (None)."""
+    return {
+        name: np.array(["" if id_ is None else id_ for id_ in ids], dtype=str),
+        name + _NULL_SUFFIX: np.array([id_ is None for id_ in ids], dtype=bool),
+    }
+
+
+def _decode_ids(npz: Any, name: str) -> List[Any]:
+    """Reads a list of identifiers (str or None) written with _encode_ids."""
+    ids = npz[name].tolist()
+    if name + _NULL_SUFFIX not in npz.files:
+        return ids
+    return [
+        None if is_null else id_
+        for id_, is_null in zip(ids, npz[name + _NULL_SUFFIX].tolist())
+    ]
+
+
+def _instrumented_writer(
+    writer: Callable[[Any, Path | str], None],
+) -> Callable[[Any, Path | str], None]:
+    """Records the time and the size of the files written by a writer in the
+    FORMAT_WRITE stage."""
+
+    @functools.wraps(writer)
+    def wrapper(obj: Any, out_file: Path | str) -> None:
+        with Stage(FORMAT_WRITE, items=1) as stage:
+            writer(obj, out_file)
+            stage.n_bytes = get_file_size(out_file)
+
+    return wrapper
+
+
+# TILT-SERIES ##########################################
+@_instrumented_writer
+def write_ts_jsonl(ts: TiltSeries, jsonl_file: Path | str) -> None:
+    """Writes a tilt-series in JSON Lines format: the first line contains the
+    tilt-series fields but the images and each of the following lines one
+    tilt-image.
+
+    :param ts: tilt-series to be written.
+    :param jsonl_file: output file, usually with extension .jsonl.
+    """
+    jsonl_file = Path(jsonl_file).expanduser()
+    tmp_file = _atomic_path(jsonl_file)
+    try:
+        with open(tmp_file, "x") as f:
+            ts_dict = ts.model_dump(mode="json", exclude={_TS_IMAGES_KEY})
+            f.write(json.dumps(ts_dict) + "\n")
+            for ti in ts.images:
+                f.write(ti.model_dump_json() + "\n")
+        os.replace(tmp_file, jsonl_file)
+    finally:
+        if tmp_file.exists():
+            tmp_file.unlink()
+
+
+def read_ts_jsonl(jsonl_file: Path | str) -> TiltSeries:
+    """Reads a tilt-series written with write_ts_jsonl."""
+    with open(Path(jsonl_file).expanduser()) as f:
+        ts_dict = json.loads(f.readline())
+        images = [TiltImage.model_validate_json(line) for line in f if line.strip()]
+    return TiltSeries(**ts_dict, images=images)
+
+
+# PARTICLES ############################################
+@_instrumented_writer
+def write_particles_npz(particles: ParticleTable, npz_file: Path | str) -> None:
+    """Writes a particle table to a NumPy .npz file. The structured array is
+    stored as is, so reading it back does not require any parsing.
+
+    :param particles: particle table, e.g. as returned by the scipion_to_table
+    method of the particle converters.
+    :param npz_file: output file, with extension .npz.
+    """
+    npz_file = Path(npz_file).expanduser()
+    tmp_file = _atomic_path(npz_file)
+    try:
+        npz_arrays: Dict[str, Any] = {
+            "data": particles.data,
+            **_encode_ids("tomo_ids", particles.tomo_ids),
+            "file_names": np.array(particles.file_names, dtype=str),
+            "file_sizes": particles.file_sizes,
+            "is_subtomogram": np.array(particles.is_subtomogram),
+        }
+        with open(tmp_file, "xb") as f:
+            np.savez(f, **npz_arrays)
+        os.replace(tmp_file, npz_file)
+    finally:
+        if tmp_file.exists():
+            tmp_file.unlink()
+
+
+def read_particles_npz(npz_file: Path | str) -> ParticleTable:
+    """Reads a particle table written with write_particles_npz. Use its method
+    to_particle3d_set to get the CETS Particle3DSet."""
+    with np.load(Path(npz_file).expanduser(), allow_pickle=False) as npz:
+        return ParticleTable(
+            npz["data"].astype(PARTICLE_DTYPE, copy=False),
+            _decode_ids(npz, "tomo_ids"),
+            file_names=npz["file_names"].tolist(),
+            file_sizes=npz["file_sizes"],
+            is_subtomogram=bool(npz["is_subtomogram"]),
+        )
+
+
+@_instrumented_writer
+def write_particles_parquet(particles: ParticleTable, parquet_file: Path | str) -> None:
+    """Writes a particle table to a Parquet file, one column per scalar value,
+    so it can be loaded by any Arrow-based tool. Requires pyarrow.
+
+    :param particles: particle table, e.g. as returned by the scipion_to_table
+    method of the particle converters.
+    :param parquet_file: output file, with extension .parquet.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError(
+            "pyarrow is required to write Parquet files: pip install pyarrow"
+        ) from None
+    data = particles.data
+    tomo_ids = particles.tomo_ids
+    # Parquet does not support nulls in the dictionary, so the particles without
+    # tomogram identifier are null and the None of tomo_ids an empty string
+    null_tomo_index = next((i for i, t in enumerate(tomo_ids) if t is None), None)
+    columns: Dict[str, Any] = {
+        "tomo_id": pa.DictionaryArray.from_arrays(
+            data["tomo_index"],
+            pa.array(["" if t is None else t for t in tomo_ids], pa.string()),
+            mask=(
+                data["tomo_index"] == null_tomo_index
+                if null_tomo_index is not None
+                else None
+            ),
+        ),
+        "file_index": data["file_index"],
+    }
+    for name, values in _flatten_particle_arrays(data).items():
+        columns[name] = values
+    table = pa.table(columns)
+    table = table.replace_schema_metadata(
+        {
+            "file_names": json.dumps(particles.file_names),
+            "file_sizes": json.dumps(particles.file_sizes.tolist()),
+            "is_subtomogram": json.dumps(particles.is_subtomogram),
+            "null_tomo_index": json.dumps(null_tomo_index),
+        }
+    )
+    parquet_file = Path(parquet_file).expanduser()
+    tmp_file = _atomic_path(parquet_file)
+    try:
+        pq.write_table(table, tmp_file)
+        os.replace(tmp_file, parquet_file)
+    finally:
+        if tmp_file.exists():
+            tmp_file.unlink()
+
+
+def read_particles_parquet(parquet_file: Path | str) -> ParticleTable:
+    """Reads a particle table written with write_particles_parquet. Requires
+    pyarrow."""
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError(
+            "pyarrow is required to read Parquet files: pip install pyarrow"
+        ) from None
+    table = pq.read_table(Path(parquet_file).expanduser())
+    metadata = {k.decode(): json.loads(v) for k, v in table.schema.metadata.items()}
+    tomo_ids_col = table.column("tomo_id").combine_chunks()
+    tomo_ids = tomo_ids_col.dictionary.to_pylist()
+    tomo_indices = tomo_ids_col.indices
+    null_tomo_index = metadata.get("null_tomo_index")
+    if null_tomo_index is not None:
+        tomo_ids[null_tomo_index] = None
+        tomo_indices = tomo_indices.fill_null(null_tomo_index)
+    data = np.zeros(table.num_rows, dtype=PARTICLE_DTYPE)
+    data["tomo_index"] = tomo_indices.to_numpy(zero_copy_only=False)
+    data["file_index"] = table.column("file_index").to_numpy()
+    for name, (field, index) in _get_flat_particle_columns().items():
+        data[field][index] = table.column(name).to_numpy()
+    return ParticleTable(
+        data,
+        tomo_ids,
+        file_names=metadata["file_names"],
+        file_sizes=np.array(metadata["file_sizes"], dtype=np.int64).reshape(-1, 3),
+        is_subtomogram=metadata["is_subtomogram"],
+    )
+
+
+def _get_flat_particle_columns() -> Dict[str, Tuple[str, Tuple[Any, ...]]]:
+    """Maps the flat column names (e.g. position_0, rotation_1_2) to the field of
+    PARTICLE_DTYPE and the index of the column within the array of the field,
+    e.g. (:, 1, 2)."""
+    columns = {}
+    for field in ("position", "coord_rotation", "shift", "rotation"):
+        for index in np.ndindex(PARTICLE_DTYPE[field].shape):
+            columns["_".join([field, *map(str, index)])] = (
+                field,
+                (slice(None), *index),
+            )
+    return columns
+
+
+def _flatten_particle_arrays(data: np.ndarray) -> Dict[str, np.ndarray]:
+    return {
+        name: np.ascontiguousarray(data[field][index])
+        for name, (field, index) in _get_flat_particle_columns().items()
+    }
+
+
+# CTF ##################################################
+@_instrumented_writer
+def write_ctf_npz(
+    ctf_md: Dict[str, Sequence[CTFMetadata]], npz_file: Path | str
+) -> None:
+    """Writes the CTF of a set of tilt-series to a NumPy .npz file, one array per
+    CTF field plus the tilt-series index of each value. Empty values are stored
+    as NaN.
+
+    :param ctf_md: dictionary of type key: tilt-series id, value: list of CTF
+    Metadata, as returned by ScipionSetOfCtf.scipion_to_cets, or CTFSeries, as
+    returned by ScipionSetOfCtf.scipion_to_ctf_series (written without
+    creating the CTFMetadata).
+    :param npz_file: output file, with extension .npz.
+    """
+    ts_ids = list(ctf_md)
+    ctf_series = [
+        ctf_list for ctf_list in ctf_md.values() if isinstance(ctf_list, CTFSeries)
+    ]
+    if len(ctf_series) == len(ctf_md):
+        values = np.concatenate(
+            [ctf_list.values for ctf_list in ctf_series]
+            or [np.empty((0, len(CTF_COLUMNS)))]
+        )
+        arrays = {field: values[:, i] for i, field in enumerate(CTF_COLUMNS)}
+    else:
+        arrays = {
+            field: np.array(
+                [
+                    np.nan if getattr(ctf, field) is None else getattr(ctf, field)
+                    for ctf_list in ctf_md.values()
+                    for ctf in ctf_list
+                ],
+                dtype=np.float64,
+            )
+            for field in CTF_COLUMNS
+        }
+    ts_index = np.repeat(
+        np.arange(len(ts_ids), dtype=np.int32),
+        [len(ctf_list) for ctf_list in ctf_md.values()],
+    )
+    npz_file = Path(npz_file).expanduser()
+    tmp_file = _atomic_path(npz_file)
+    try:
+        # One array per name, none of them named as the options of savez
+        npz_arrays: Dict[str, Any] = {
+            **_encode_ids("ts_ids", ts_ids),
+            "ts_index": ts_index,
+            **arrays,
+        }
+        with open(tmp_file, "xb") as f:
+            np.savez(f, **npz_arrays)
+        os.replace(tmp_file, npz_file)
+    finally:
+        if tmp_file.exists():
+            tmp_file.unlink()
+
+
+def read_ctf_npz(npz_file: Path | str) -> Dict[str, List[CTFMetadata]]:
+    """Reads the CTF written with write_ctf_npz."""
+    with np.load(Path(npz_file).expanduser(), allow_pickle=False) as npz:
+        ts_ids = _decode_ids(npz, "ts_ids")
+        ts_index = npz["ts_index"]
+        columns = {field: npz[field].tolist() for field in CTF_COLUMNS}
+    ctf_md: Dict[Any, List[CTFMetadata]] = {ts_id: [] for ts_id in ts_ids}
+    for i, ts_i in enumerate(ts_index.tolist()):
+        values = {
+            field: None if column[i] != column[i] else column[i]  # NaN -> None
+            for field, column in columns.items()
+        }
+        if values["acquisition_order"] is not None:
+            values["acquisition_order"] = int(values["acquisition_order"])
+        ctf_md[ts_ids[ts_i]].append(CTFMetadata(**values))
+    return ctf_md
+
+
+# REGISTRY #############################################
+# Writers and readers of each kind of object, by format. New formats can be
+# added with register_format.
+WRITERS: Dict[Tuple[str, str], FormatWriter] = {
+    (TILT_SERIES_KIND, YAML_FORMAT): write_obj_yaml,
+    (TILT_SERIES_KIND, COMPACT_YAML_FORMAT): functools.partial(
+        write_obj_yaml, compact=True
+    ),
+    (TILT_SERIES_KIND, JSONL_FORMAT): write_ts_jsonl,
+    (PARTICLES_KIND, NPZ_FORMAT): write_particles_npz,
+    (PARTICLES_KIND, PARQUET_FORMAT): write_particles_parquet,
+    (CTF_KIND, NPZ_FORMAT): write_ctf_npz,
+}
+READERS: Dict[Tuple[str, str], FormatReader] = {
+    (TILT_SERIES_KIND, YAML_FORMAT): functools.partial(
+        read_obj_yaml, model_class=TiltSeries
+    ),
+    (TILT_SERIES_KIND, COMPACT_YAML_FORMAT): functools.partial(
+        read_obj_yaml, model_class=TiltSeries
+    ),
+    (TILT_SERIES_KIND, JSONL_FORMAT): read_ts_jsonl,
+    (PARTICLES_KIND, NPZ_FORMAT): read_particles_npz,
+    (PARTICLES_KIND, PARQUET_FORMAT): read_particles_parquet,
+    (CTF_KIND, NPZ_FORMAT): read_ctf_npz,
+}
+
+
+def register_format(
+    kind: str,
+    out_format: str,
+    writer: FormatWriter,
+    reader: FormatReader | None = None,
+) -> None:
+    """Registers the writer (and optionally the reader) of a kind of object in
+    a new format."""
+    WRITERS[(kind, out_format)] = writer
+    if reader is not None:
+        READERS[(kind, out_format)] = reader
+
+
+def get_writer(kind: str, out_format: str) -> FormatWriter:
+    try:
+        return WRITERS[(kind, out_format)]
+    except KeyError:
+        raise ValueError(f"No writer of {kind} in format {out_format}") from None
+
+
+def get_reader(kind: str, out_format: str) -> FormatReader:
+    try:
+        return READERS[(kind, out_format)]
+    except KeyError:
+        raise ValueError(f"No reader of {kind} in format {out_format}") from None
@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Iterable, List
+
+logger = logging.getLogger(__name__)
+
+# File in which the state of the conversions into an output directory is kept
+STATE_FILE_NAME = ".cets_scipion_state.json"
+STATE_VERSION = 1
+
+# Signature of an object: JSON-serializable values (e.g. row counts and max ids
+# of its tables) that change whenever Scipion adds or modifies its data
+Signature = List[Any]
+
+
+class ConversionState:
+    """Keeps track of the objects (tilt-series, tomograms...) already converted
+    from the Scipion sets into an output directory, so a set that keeps growing
+    while Scipion is streaming can be re-converted incrementally: only the
+    objects that are new or whose signature has changed since the last run are
+    converted again.
+
+    The state is stored as JSON in the output directory, one entry per set
+    (identified by a key, usually the path of its sqlite file) mapping the
+    identifier of each object converted to its signature.
+
+    :param state_file: path of the JSON file.
+    """
+
+    def __init__(self, state_file: Path):
+        self.state_file = state_file
+        self._sets: Dict[str, Dict[str, Signature]] = {}
+
+    @classmethod
+    def load(cls, out_directory: os.PathLike | str) -> "ConversionState":
+        """Loads the state of an output directory. If there is no state file
+        or it cannot be read, the state is empty, so everything is converted."""
+        state = cls(Path(out_directory).expanduser() / STATE_FILE_NAME)
+        if state.state_file.exists():
+            try:
+                with open(state.state_file) as f:
+                    content = json.load(f)
+                if content.get("version") == STATE_VERSION:
+                    state._sets = content["sets"]
+                else:
+                    logger.warning(
+                        "Ignoring the state file %s: old version.", state.state_file
+                    )
+            except (OSError, ValueError, KeyError, AttributeError) as e:
+                logger.warning(
+                    "Unable to read the state file %s -> %s", state.state_file, e
+                )
+        return state
+
+    def get_changed(self, set_key: str, signatures: Dict[str, Signature]) -> List[str]:
+        """Returns the identifiers of the objects that are new or whose signature
+        differs from the one stored, in the same order as introduced.
+
+        :param set_key: identifier of the set, e.g. the path of its sqlite file.
+        :param signatures: current signature of each object of the set.
+        """
+        stored = self._sets.get(set_key, {})
+        # Round-trip through JSON, so tuples compare equal to the stored lists
+        return [
+            obj_id
+            for obj_id, signature in signatures.items()
+            if stored.get(obj_id) != json.loads(json.dumps(signature))
+        ]
+
+    def update(
+        self,
+        set_key: str,
+        signatures: Dict[str, Signature],
+        obj_ids: Iterable[str] | None = None,
+    ) -> None:
+        """Stores the signature of the objects converted.
+
+        :param set_key: identifier of the set.
+        :param signatures: signature of each object of the set.
+        :param obj_ids: identifiers of the objects actually converted. If not
+        provided, all the objects of signatures are stored.
+        """
+        obj_ids = signatures.keys() if obj_ids is None else obj_ids
+        stored = self._sets.setdefault(set_key, {})
+        for obj_id in obj_ids:
+            stored[obj_id] = json.loads(json.dumps(signatures[obj_id]))
+
+    def save(self) -> None:
+        """Writes the state file. It is written to a temporary file first, which
+        then replaces it, so an interrupted run never leaves a corrupted state."""
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.state_file.with_name(
+            f".{self.state_file.name}.{uuid.uuid4().hex}.tmp"
+        )
+        try:
+            with open(tmp_file, "x") as f:
+                json.dump({"version": STATE_VERSION, "sets": self._sets}, f, indent=1)
+            os.replace(tmp_file, self.state_file)
+        finally:
+            if tmp_file.exists():
+                tmp_file.unlink()
@@ -0,0 +1,220 @@
+import json
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None  # type: ignore[assignment]
+
+# Stages recorded by the converters. The times are inclusive: a stage run
+# inside another one (e.g. an MRC header read while building the tilt-images)
+# is counted in both
+SQLITE_CONNECT = "sqlite.connect"
+SQLITE_READ = "sqlite.read"  # items: rows
+MRC_READ_HEADER = "mrc.read_header"  # items: headers, bytes: read
+MATRIX_PARSE = "matrix.parse"  # items: matrices
+MODEL_BUILD = "model.build"  # items: CETS objects built (pydantic)
+MODEL_DUMP = "model.dump"  # items: CETS objects dumped to dicts
+YAML_WRITE = "yaml.write"  # items: files, bytes: written
+FORMAT_WRITE = "format.write"  # items: files, bytes: written
+
+# Counters of the caches, from which the hit rates are computed
+MRC_CACHE_HITS = "mrc_header_cache.hits"
+MRC_CACHE_MISSES = "mrc_header_cache.misses"
+LAZY_CACHE_HITS = "lazy_cache.hits"
+LAZY_CACHE_MISSES = "lazy_cache.misses"
+CONVERSION_CACHE_HITS = "conversion_cache.hits"
+CONVERSION_CACHE_MISSES = "conversion_cache.misses"
+
+
+class StageStats:
+    """Accumulated wall time, number of calls, items processed and bytes read
+    or written by a stage of the conversions."""
+
+    __slots__ = ("calls", "seconds", "items", "n_bytes")
+
+    def __init__(
+        self, calls: int = 0, seconds: float = 0.0, items: int = 0, n_bytes: int = 0
+    ):
+        self.calls = calls
+        self.seconds = seconds
+        self.items = items
+        self.n_bytes = n_bytes
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "seconds": self.seconds,
+            "items": self.items,
+            "bytes": self.n_bytes,
+        }
+
+
+class ConversionReport:
+    """Per-stage timings and counters of the conversions done in a process. It
+    is thread-safe, and cheap enough to be always on: the stages are recorded
+    per query, per batch of rows or per file, never per row.
+
+    The process-wide instance REPORT is fed by the converters and the writers.
+    Reset it before a conversion to get the report of that conversion only. The
+    reports of several processes (e.g. the workers of convert_project) are
+    combined with merge.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.stages: Dict[str, StageStats] = {}
+        self.counters: Dict[str, int] = {}
+        # None if the peak memory cannot be measured, see get_peak_rss_mb
+        self.peak_rss_mb: float | None = None
+        self.started = time.time()
+
+    def add(self, stage: str, seconds: float, items: int = 0, n_bytes: int = 0) -> None:
+        """Records a call to a stage."""
+        with self._lock:
+            stats = self.stages.get(stage, None)
+            if stats is None:
+                stats = self.stages[stage] = StageStats()
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.items += items
+            stats.n_bytes += n_bytes
+
+    def count(self, counter: str, n: int = 1) -> None:
+        """Increases a counter, e.g. the hits of a cache."""
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def reset(self) -> None:
+        with self._lock:
+            self.stages.clear()
+            self.counters.clear()
+            self.peak_rss_mb = None
+            self.started = time.time()
+
+    def merge(self, report: Dict[str, Any]) -> None:
+        """Adds the stages and counters of another report, as returned by its
+        to_dict method, e.g. the one of a worker process."""
+        with self._lock:
+            for stage, values in report["stages"].items():
+                stats = self.stages.get(stage, None)
+                if stats is None:
+                    stats = self.stages[stage] = StageStats()
+                stats.calls += values["calls"]
+                stats.seconds += values["seconds"]
+                stats.items += values["items"]
+                stats.n_bytes += values["bytes"]
+            for counter, n in report["counters"].items():
+                self.counters[counter] = self.counters.get(counter, 0) + n
+            self.peak_rss_mb = _max_rss(self.peak_rss_mb, report["peak_rss_mb"])
+
+    def to_dict(self) -> Dict[str, Any]:
+        """JSON-serializable content of the report, with the hit rate of each
+        cache (counters ending in .hits and .misses) and the peak memory of the
+        process."""
+        with self._lock:
+            self.peak_rss_mb = _max_rss(self.peak_rss_mb, get_peak_rss_mb())
+            counters = dict(self.counters)
+            return {
+                "wall_seconds": time.time() - self.started,
+                "peak_rss_mb": self.peak_rss_mb,
+                "stages": {
+                    stage: stats.to_dict() for stage, stats in self.stages.items()
+                },
+                "counters": counters,
+                "hit_rates": _get_hit_rates(counters),
+            }
+
+    def write_json(self, json_file: os.PathLike | str) -> None:
+        with open(json_file, "w") as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def format(self) -> str:
+        """Human-readable summary of the report, one line per stage."""
+        report = self.to_dict()
+        lines = [f"{'stage':<18}{'calls':>10}{'seconds':>12}{'items':>12}{'MiB':>10}"]
+        for stage, values in sorted(report["stages"].items()):
+            lines.append(
+                f"{stage:<18}{values['calls']:>10}{values['seconds']:>12.3f}"
+                f"{values['items']:>12}{values['bytes'] / 2**20:>10.2f}"
+            )
+        for cache, hit_rate in report["hit_rates"].items():
+            lines.append(f"{cache} hit rate: {100 * hit_rate:.1f}%")
+        peak_rss_mb = report["peak_rss_mb"]
+        lines.append(
+            "Peak memory: unavailable"
+            if peak_rss_mb is None
+            else f"Peak memory: {peak_rss_mb:.1f} MiB"
+        )
+        return "\n".join(lines)
+
+
+class Stage:
+    """Context manager that records the wall time of a stage in REPORT. The
+    items and bytes processed can be set inside the block.
+
+    Example:
+        with Stage(SQLITE_READ) as stage:
+            rows = cursor.fetchall()
+            stage.items = len(rows)
+    """
+
+    __slots__ = ("name", "items", "n_bytes", "_start")
+
+    def __init__(self, name: str, items: int = 0):
+        self.name = name
+        self.items = items
+        self.n_bytes = 0
+
+    def __enter__(self) -> "Stage":
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        REPORT.add(
+            self.name, time.perf_counter() - self._start, self.items, self.n_bytes
+        )
+
+
+def get_peak_rss_mb() -> float | None:
+    """Peak resident memory of the current process, in MiB. None if it cannot be
+    measured, as the resource module is not available (e.g. on Windows)."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB on Linux
+    return max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+
+
+def get_file_size(file_path: os.PathLike | str) -> int:
+    try:
+        return Path(file_path).stat().st_size
+    except OSError:
+        return 0
+
+
+def _max_rss(rss_mb: float | None, other_rss_mb: float | None) -> float | None:
+    """Highest of two peak memories, ignoring the ones not measured (None)."""
+    if rss_mb is None or other_rss_mb is None:
+        return other_rss_mb if rss_mb is None else rss_mb
+    return max(rss_mb, other_rss_mb)
+
+
+def _get_hit_rates(counters: Dict[str, int]) -> Dict[str, float]:
+    hit_rates = {}
+    caches: List[str] = [
+        counter[: -len(".hits")] for counter in counters if counter.endswith(".hits")
+    ]
+    for cache in caches:
+        n_requests = counters[f"{cache}.hits"] + counters.get(f"{cache}.misses", 0)
+        hit_rates[cache] = counters[f"{cache}.hits"] / n_requests if n_requests else 0.0
+    return hit_rates
+
+
+# Process-wide report fed by all the converters
+REPORT = ConversionReport()
@@ -0,0 +1,88 @@
+from typing import Sequence, Tuple
+
+import numpy as np
+
+from scipion.utils.utils_instrumentation import Stage, MATRIX_PARSE
+
+# Translation table to turn Scipion's nested-list text representation of a
+# matrix, e.g. "[[1.0, 0.0], [0.0, 1.0]]", into whitespace-separated numbers
+_MATRIX_TEXT_TABLE = str.maketrans("[],", "   ")
+
+
+def get_matrix_shape(matrix_str: str) -> Tuple[int, int]:
+    """Infers the shape of a matrix from its Scipion text representation.
+
+    :param matrix_str: matrix stored as text, e.g. "[[1.0, 0.0], [0.0, 1.0]]".
+    """
+    n_rows = matrix_str.count("[") - 1
+    n_elements = matrix_str.count(",") + 1
+    if n_rows < 1 or n_elements % n_rows:
+        raise ValueError(f"Unable to infer the shape of the matrix {matrix_str}")
+    return n_rows, n_elements // n_rows
+
+
+def parse_matrices(
+    matrix_strs: Sequence[str],
+    shape: Tuple[int, int] | None = None,
+    column: str | None = None,
+) -> np.ndarray:
+    """Parses a whole column of matrices stored as text by Scipion into a single
+    float64 array of shape (N, rows, cols), in one step instead of evaluating each
+    string separately.
+
+    :param matrix_strs: matrices stored as text, e.g. "[[1.0, 0.0], [0.0, 1.0]]".
+    All of them must have the same shape. Non-finite values, e.g. "nan", are kept.
+    :type matrix_strs: Sequence[str].
+
+    :param shape: shape (rows, cols) of each matrix. If not provided, it is
+    inferred from the first matrix.
+    :type shape: Tuple[int, int] or None, optional. Defaults to None.
+
+    :param column: name of the column read, for the error messages.
+    :type column: str or None, optional. Defaults to None.
+    """
+    n_matrices = len(matrix_strs)
+    with Stage(MATRIX_PARSE, items=n_matrices):
+        return _parse_matrices(matrix_strs, n_matrices, shape, column)
+
+
+def _parse_matrices(
+    matrix_strs: Sequence[str],
+    n_matrices: int,
+    shape: Tuple[int, int] | None,
+    column: str | None,
+) -> np.ndarray:
+    column_desc = f"The matrix column {column}" if column else "The matrix column"
+    if not n_matrices:
+        if shape is None:
+            raise ValueError("The shape is required to parse an empty matrix column")
+        return np.empty((0, *shape), dtype=np.float64)
+    try:
+        joined_text = " ".join(matrix_strs)
+    except TypeError:
+        raise ValueError(f"{column_desc} contains empty (NULL) values") from None
+    if shape is None:
+        shape = get_matrix_shape(matrix_strs[0])
+    # Each matrix has one more element than commas, so the number of values
+    # stored can be checked before parsing them, e.g. for ragged matrices
+    expected_size = n_matrices * shape[0] * shape[1]
+    n_values = joined_text.count(",") + n_matrices
+    if n_values != expected_size:
+        raise ValueError(
+            f"{column_desc}: unable to parse {n_matrices} matrices of shape {shape}: "
+            f"{n_values} values are stored, {expected_size} were expected."
+        )
+    try:
+        values = np.fromstring(
+            joined_text.translate(_MATRIX_TEXT_TABLE), dtype=np.float64, sep=" "
+        )
+    except ValueError as e:
+        raise ValueError(f"{column_desc} contains non-numeric values: {e}") from None
+    if values.size != expected_size:
+        # NumPy 1.x stops reading at the first non-numeric value instead of
+        # raising a ValueError
+        raise ValueError(
+            f"{column_desc} contains non-numeric values: {values.size} values "
+            f"were read, {expected_size} were expected."
+        )
+    return values.reshape(n_matrices, *shape)
@@ -0,0 +1,79 @@
+import os
+from typing import Any, List, Sequence, Tuple, Type, TypeVar
+
+import numpy as np
+from pydantic import BaseModel
+
+# Environment variable to enable the strict validation, e.g. for debugging
+STRICT_VALIDATION_ENV = "CETS_SCIPION_STRICT_VALIDATION"
+
+M = TypeVar("M", bound=BaseModel)
+
+_strict_validation = os.environ.get(STRICT_VALIDATION_ENV, "").lower() not in (
+    "",
+    "0",
+    "false",
+)
+
+
+def set_strict_validation(strict: bool) -> None:
+    """If True, the models built from trusted NumPy batches (e.g. the coordinate
+    transformations) are fully validated by pydantic, as the rest of the models.
+    Slower, but useful to debug the converters. It can also be enabled setting
+    the environment variable CETS_SCIPION_STRICT_VALIDATION=1."""
+    global _strict_validation
+    _strict_validation = strict
+
+
+def is_strict_validation() -> bool:
+    return _strict_validation
+
+
+def check_batch(
+    values: np.ndarray, item_shape: Tuple[int, ...], name: str
+) -> np.ndarray:
+    """Validates once a batch of values from which models will be built without
+    validation. Returns it as a float64 array of shape (N, *item_shape).
+
+    :param values: batch of values, e.g. as returned by parse_matrices.
+    :param item_shape: shape of the values of each item.
+    :param name: name of the values, for the error messages.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim != len(item_shape) + 1 or values.shape[1:] != item_shape:
+        raise ValueError(
+            f"Invalid {name} shape {values.shape}. Expected: (N, "
+            f"{', '.join(map(str, item_shape))})"
+        )
+    return values
+
+
+def build_models(
+    model_class: Type[M], field: str, values: Sequence[Any], **common: Any
+) -> List[M]:
+    """Builds a batch of models that only differ in the value of a field, from
+    trusted values already checked with check_batch and converted to Python types
+    (e.g. with ndarray.tolist). A prototype is validated once, with the common
+    fields and the first value, and the rest of the models are created with
+    model_construct from its validated fields and the value of field, without
+    the per-model validation of pydantic, which is about twice as slow. The
+    values of the common fields are shared by all the models. In strict mode
+    (see set_strict_validation) each model is validated as usual.
+
+    :param model_class: pydantic model to be built.
+    :param field: name of the field whose value changes among the models.
+    :param values: value of field of each model.
+    :param common: values of the rest of fields, the same for all the models.
+    """
+    if _strict_validation:
+        return [model_class(**common, **{field: value}) for value in values]
+    if not len(values):
+        return []
+    prototype = model_class(**common, **{field: values[0]})
+    fields = {**prototype.__dict__, **(prototype.model_extra or {})}
+    fields_set = prototype.model_fields_set
+    construct = model_class.model_construct
+    return [
+        construct(_fields_set=set(fields_set), **{**fields, field: value})
+        for value in values
+    ]
@@ -0,0 +1,275 @@
+import os
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, List, NamedTuple, Set, Tuple
+
+from scipion.utils.utils_instrumentation import (
+    REPORT,
+    Stage,
+    MRC_READ_HEADER,
+    MRC_CACHE_HITS,
+    MRC_CACHE_MISSES,
+)
+
+# Resolved path, modification time (ns) and size (bytes)
+HeaderKey = Tuple[str, int, int]
+
+DEFAULT_MRC_CACHE_SIZE = 4096
+
+# Max number of threads reading MRC headers concurrently (see get_many)
+DEFAULT_MRC_READERS = 16
+
+# Size of the main header of an MRC file, in bytes
+MRC_HEADER_SIZE = 1024
+# Offset of the "MAP " signature of the MRC2014 format
+_MAP_ID_OFFSET = 208
+_MAP_ID = b"MAP "
+# Offset of the machine stamp, which encodes the byte order of the header
+_MACHINE_STAMP_OFFSET = 212
+
+
+class MrcHeaderInfo(NamedTuple):
+    """Dimensions and data mode of an MRC file, as read by read_mrc_header."""
+
+    size_x: int
+    size_y: int
+    size_z: int
+    mode: int
+
+
+def read_mrc_header(filename: os.PathLike | str) -> MrcHeaderInfo:
+    """Reads the dimensions of an MRC file from its main header. Only its first
+    MRC_HEADER_SIZE bytes are read, in a single call, whatever the size of the
+    extended header or of the data. Raises ValueError if the file is too small
+    or has no "MAP " signature."""
+    with open(filename, "rb") as f:
+        header = f.read(MRC_HEADER_SIZE)
+    if len(header) < MRC_HEADER_SIZE:
+        raise ValueError(
+            f"{filename} is not an MRC file: {len(header)} bytes, smaller than the "
+            f"header ({MRC_HEADER_SIZE} bytes)"
+        )
+    map_id = header[_MAP_ID_OFFSET : _MAP_ID_OFFSET + len(_MAP_ID)]
+    if map_id != _MAP_ID:
+        raise ValueError(
+            f"{filename} is not an MRC file: {map_id!r} found instead of the "
+            f"{_MAP_ID!r} signature"
+        )
+    byte_order = _get_byte_order(header)
+    size_x, size_y, size_z, mode = struct.unpack_from(f"{byte_order}4i", header)
+    return MrcHeaderInfo(size_x, size_y, size_z, mode)
+
+
+def _get_byte_order(header: bytes) -> str:
+    """struct byte order of an MRC header, from its machine stamp or, if it is
+    not a valid one (as written by some old programs), the one in which the data
+    mode is valid."""
+    stamp = header[_MACHINE_STAMP_OFFSET]
+    if stamp in (0x44, 0x41):
+        return "<"
+    if stamp in (0x11, 0x17):
+        return ">"
+    (mode,) = struct.unpack_from("<i", header, 12)
+    return "<" if 0 <= mode < 256 else ">"
+
+
+class MrcHeaderCache:
+    """LRU cache of MRC header information, shared by all the converters.
+
+    The entries are keyed by the resolved path of the file together with its
+    modification time and size, so a file that is rewritten (e.g. by a Scipion
+    protocol still running) is read again instead of returning stale data.
+
+    The files requested can be recorded with record. The recorders belong to the
+    thread that opens them, so the conversions run concurrently in other threads
+    do not add their files to them.
+    """
+
+    def __init__(
+        self,
+        max_size: int = DEFAULT_MRC_CACHE_SIZE,
+        loader: Callable[[Path], Any] = read_mrc_header,
+        max_readers: int = DEFAULT_MRC_READERS,
+    ):
+        """
+        :param max_size: maximum number of headers kept in memory. When reached,
+        the least recently used entry is evicted.
+        :type max_size: int, optional. Defaults to DEFAULT_MRC_CACHE_SIZE.
+
+        :param loader: function used to read the header of a file not present in
+        the cache.
+        :type loader: Callable, optional. Defaults to read_mrc_header.
+
+        :param max_readers: max number of threads reading headers concurrently in
+        get_many. If 1, they are read one at a time.
+        :type max_readers: int, optional. Defaults to DEFAULT_MRC_READERS.
+        """
+        if max_size < 1:
+            raise ValueError(f"The cache size must be greater than 0: {max_size}")
+        self.max_size = max_size
+        # Threads of get_many, created on first use and shared by all its calls,
+        # and the process that created them
+        self._executor: ThreadPoolExecutor | None = None
+        self._executor_pid = 0
+        self._max_readers = DEFAULT_MRC_READERS
+        self._executor_lock = threading.Lock()
+        self.max_readers = max_readers
+        self._loader = loader
+        self._entries: OrderedDict[HeaderKey, Any] = OrderedDict()
+        self._lock = threading.Lock()
+        # Recorders open by each thread, see record
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def max_readers(self) -> int:
+        return self._max_readers
+
+    @max_readers.setter
+    def max_readers(self, max_readers: int) -> None:
+        if max_readers < 1:
+            raise ValueError(
+                f"The number of readers must be greater than 0: {max_readers}"
+            )
+        with self._executor_lock:
+            if self._executor is not None and max_readers != self._max_readers:
+                # Replaced on next use, once the reads in progress finish
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            self._max_readers = max_readers
+
+    @property
+    def hit_rate(self) -> float:
+        n_requests = self.hits + self.misses
+        return self.hits / n_requests if n_requests else 0.0
+
+    def get(self, filename: os.PathLike | str) -> Any:
+        """Returns the header information of the introduced MRC file, reading
+        it only if it is not already cached."""
+        return self._get(filename, self._get_recorders())
+
+    def _get(self, filename: os.PathLike | str, recorders: List[Set[HeaderKey]]) -> Any:
+        """See get. The key of the file is added to recorders, the ones of the
+        thread that requested it."""
+        key = self._get_key(filename)
+        with self._lock:
+            for recorded in recorders:
+                recorded.add(key)
+            img_info = self._entries.get(key, None)
+            if img_info is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                REPORT.count(MRC_CACHE_HITS)
+                return img_info
+            self.misses += 1
+        REPORT.count(MRC_CACHE_MISSES)
+        # Read out of the lock, so slow storage does not serialize other threads
+        with Stage(MRC_READ_HEADER, items=1) as stage:
+            img_info = self._loader(Path(key[0]))
+            stage.n_bytes = MRC_HEADER_SIZE
+        with self._lock:
+            self._entries[key] = img_info
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return img_info
+
+    def get_many(self, filenames: Iterable[os.PathLike | str]) -> List[Any]:
+        """Returns the header information of several MRC files, in the same
+        order as introduced. Each distinct file is looked up once, and the ones
+        not cached are read concurrently by up to max_readers threads, so a high
+        per-file latency (e.g. on a parallel filesystem) is not paid once per
+        file. The threads are kept for the next calls."""
+        filenames = list(filenames)
+        unique_filenames = list(dict.fromkeys(filenames))
+        n_threads = min(self.max_readers, len(unique_filenames))
+        # The files read by the worker threads are recorded by the caller's
+        recorders = self._get_recorders()
+        if n_threads <= 1:
+            img_infos = [
+                self._get(filename, recorders) for filename in unique_filenames
+            ]
+        else:
+            with self._executor_lock:
+                # The threads are not inherited by the processes forked, e.g. the
+                # workers of convert_project
+                if self._executor is None or self._executor_pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_readers, thread_name_prefix="mrc-header"
+                    )
+                    self._executor_pid = os.getpid()
+                # All the reads are submitted here, so they are not affected by
+                # a change of max_readers meanwhile
+                results = self._executor.map(
+                    lambda filename: self._get(filename, recorders), unique_filenames
+                )
+            img_infos = list(results)
+        info_by_filename = dict(zip(unique_filenames, img_infos))
+        return [info_by_filename[filename] for filename in filenames]
+
+    @contextmanager
+    def record(self) -> Iterator[Set[HeaderKey]]:
+        """Collects the key (path, modification time and size) of every file
+        requested, cached or not, by the current thread while in the block. They
+        are the MRC files referenced by a conversion run in the block, e.g. to
+        check later if any of them has changed."""
+        recorded: Set[HeaderKey] = set()
+        recorders = self._get_recorders()
+        recorders.append(recorded)
+        try:
+            yield recorded
+        finally:
+            recorders.remove(recorded)
+
+    def _get_recorders(self) -> List[Set[HeaderKey]]:
+        """Recorders open by the current thread."""
+        recorders = getattr(self._local, "recorders", None)
+        if recorders is None:
+            recorders = self._local.recorders = []
+        return recorders
+
+    def clear(self) -> None:
+        """Removes all the entries and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    @staticmethod
+    def _get_key(filename: os.PathLike | str) -> HeaderKey:
+        resolved_fn = Path(filename).expanduser().resolve()
+        st = resolved_fn.stat()
+        return str(resolved_fn), st.st_mtime_ns, st.st_size
+
+    @staticmethod
+    def is_current(key: HeaderKey) -> bool:
+        """True if the file of a key has not changed since the key was taken."""
+        try:
+            return MrcHeaderCache._get_key(key[0]) == key
+        except OSError:
+            return False
+
+
+# Process-wide cache used by all the converters
+MRC_HEADER_CACHE = MrcHeaderCache()
+
+
+def get_mrc_info_cached(filename: os.PathLike | str) -> Any:
+    """Drop-in replacement of get_mrc_info that goes through the process-wide
+    MRC header cache."""
+    return MRC_HEADER_CACHE.get(filename)
+
+
+def get_mrc_infos_cached(filenames: Iterable[os.PathLike | str]) -> List[Any]:
+    """Header information of several MRC files, in the same order, read
+    concurrently through the process-wide MRC header cache. See
+    MrcHeaderCache.get_many."""
+    return MRC_HEADER_CACHE.get_many(filenames)
@@ -0,0 +1,134 @@
+import functools
+import logging
+import os
+from contextlib import closing
+from pathlib import Path
+from typing import Dict, List, NamedTuple
+
+from scipion.constants import (
+    PROP_SELF,
+    RUNS_DIR,
+    SET_OF_TILT_SERIES,
+    SET_OF_CTF_TOMO_SERIES,
+    SET_OF_TOMOGRAMS,
+    SET_OF_COORDINATES_3D,
+    SET_OF_SUBTOMOGRAMS,
+    TS_ID,
+    TOMO_ID,
+    SUBTOMO_ID,
+)
+from scipion.utils.utils_sqlite import (
+    open_read_only_db,
+    map_classes_table,
+    map_properties_table,
+    get_distinct_from_obj_tbl,
+)
+
+logger = logging.getLogger(__name__)
+
+# Field containing the tilt-series or tomogram identifier of each supported set
+SET_ID_FIELDS: Dict[str, str] = {
+    SET_OF_TILT_SERIES: TS_ID,
+    SET_OF_CTF_TOMO_SERIES: TS_ID,
+    SET_OF_TOMOGRAMS: TS_ID,
+    SET_OF_COORDINATES_3D: TOMO_ID,
+    SET_OF_SUBTOMOGRAMS: SUBTOMO_ID,
+}
+
+
+def get_project_path(db_path: os.PathLike | str) -> Path:
+    """Returns the Scipion project directory of a set sqlite file, without
+    changing the working directory, so it is safe to call it from several
+    threads. The expected layout is ProjectName/Runs/ProtocolDir/[...]/file.sqlite.
+    If the file is not inside a Runs/ProtocolDir directory, the directory two
+    levels above the one containing the file is returned, i.e. db_path/../..
+
+    :param db_path: path of the sqlite file.
+    """
+    return _get_project_path(Path(db_path).expanduser().resolve().parent)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_project_path(db_dir: Path) -> Path:
+    # Memoized per directory, as all the sets of a run share it
+    for protocol_dir in (db_dir, *db_dir.parents):
+        runs_dir = protocol_dir.parent
+        if runs_dir.name == RUNS_DIR and runs_dir != protocol_dir:
+            return runs_dir.parent
+    project_path = db_dir.parent.parent
+    logger.warning(
+        "%s is not inside a Scipion %s/ProtocolDir directory. Using %s as the "
+        "project directory.",
+        db_dir,
+        RUNS_DIR,
+        project_path,
+    )
+    return project_path
+
+
+class ScipionSetFile(NamedTuple):
+    """A Scipion set sqlite file found in a project."""
+
+    db_path: Path
+    set_class: str
+    ids: List[str]  # tilt-series or tomogram identifiers, sorted
+
+    @property
+    def run_name(self) -> str:
+        return self.db_path.parent.name
+
+
+def discover_sets(project_path: os.PathLike | str) -> List[ScipionSetFile]:
+    """Finds the supported Scipion sets (see SET_ID_FIELDS) in the runs of a
+    Scipion project, i.e. the files ProjectName/Runs/ProtocolDir/*.sqlite.
+    The result is sorted by path, so it is deterministic and follows the
+    order in which the protocols were executed.
+
+    :param project_path: path of the Scipion project directory.
+    """
+    runs_dir = Path(project_path).expanduser() / RUNS_DIR
+    if not runs_dir.is_dir():
+        raise FileNotFoundError(
+            f"{project_path} is not a Scipion project: {runs_dir} not found."
+        )
+    set_files = []
+    for db_path in sorted(runs_dir.glob("*/*.sqlite")):
+        set_file = read_set_file(db_path)
+        if set_file is not None:
+            set_files.append(set_file)
+    return set_files
+
+
+def read_set_file(db_path: Path) -> ScipionSetFile | None:
+    """Reads the class and the identifiers of a Scipion set sqlite file. Returns
+    None if it is not a supported set (see SET_ID_FIELDS) or it is not readable.
+
+    :param db_path: path of the sqlite file.
+    """
+    try:
+        with closing(open_read_only_db(db_path)) as conn:
+            set_class = map_properties_table(conn).get(PROP_SELF, None)
+            if set_class not in SET_ID_FIELDS:
+                return None
+            id_field = SET_ID_FIELDS[set_class]
+            ids = get_distinct_from_obj_tbl(conn, id_field, map_classes_table(conn))
+    except Exception as e:
+        logger.warning("Skipping %s, it is not a readable Scipion set: %s", db_path, e)
+        return None
+    return ScipionSetFile(db_path.resolve(), set_class, ids)
+
+
+def find_matching_set(
+    set_file: ScipionSetFile, candidates: List[ScipionSetFile]
+) -> ScipionSetFile | None:
+    """Returns the candidate sharing more identifiers with the introduced set,
+    e.g. the set of CTF corresponding to a set of tilt-series. In case of a tie,
+    the last candidate (the most recent run) is returned.
+    """
+    best_match, best_overlap = None, 0
+    ids = set(set_file.ids)
+    for candidate in candidates:
+        overlap = len(ids.intersection(candidate.ids))
+        if overlap and overlap >= best_overlap:
+            best_match, best_overlap = candidate, overlap
+    return best_match
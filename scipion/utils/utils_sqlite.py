@@ -1,6 +1,11 @@
+import operator
+import os
 import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, Callable, Iterator, List, NamedTuple, Sequence, Tuple
 
 from scipion.constants import (
     CLASSES_TBL,
@@ -10,33 +15,266 @@ from scipion.constants import (
     PROP_KEY,
     PROP_VALUE,
     OBJECTS_TBL,
+    PROP_STREAM_STATE,
+    STREAM_CLOSED,
 )
+from scipion.utils.utils_instrumentation import Stage, SQLITE_CONNECT, SQLITE_READ
 
+# Number of rows fetched at once when the rows are processed in batches
+FETCH_CHUNK_SIZE = 10000
 
-def connect_db(db_path: Path) -> sqlite3.Connection | None:
-    try:
-        print(f"Connecting to {db_path}...")
-        conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row  # optional, handy if you want dict-like rows
+# Connection tuning
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024  # bytes
+SQLITE_CACHE_SIZE = 64 * 1024  # KiB
+# Max connections of each thread kept open by the pool
+DEFAULT_POOL_CONNECTIONS = 32
+
+
+class SharedConnection(sqlite3.Connection):
+    """Connection shared by several callers, as those of ConnectionPool and
+    ConnectionScope. Its close method raises an error, as the connection is
+    closed by its owner (see _close_connection) when no longer needed."""
+
+    def close(self) -> None:
+        raise sqlite3.ProgrammingError(
+            "A shared connection (see connect_db) must not be closed by its users"
+        )
+
+
+def _close_connection(conn: sqlite3.Connection) -> None:
+    """Closes a connection, even a SharedConnection."""
+    sqlite3.Connection.close(conn)
+
+
+class _PooledConnection(NamedTuple):
+    conn: sqlite3.Connection
+    # (modification time, size) of the file when opened, for the immutable
+    # connections, which do not detect the changes of the file
+    file_state: Tuple[int, int] | None
+
+
+class ConnectionPool:
+    """Pool of read-only connections to the Scipion sets, one per database path.
+
+    The sqlite3 connections cannot be shared among threads, so each thread has
+    its own connections, at most max_connections: when exceeded, the least
+    recently used connection of the thread is closed. The connections of a
+    thread are closed too when the thread ends. An immutable connection (see
+    open_read_only_db) is reopened if its file has changed since it was opened,
+    e.g. if Scipion has reopened a finished set. The pool is reset in processes
+    forked from the one that created it, as the connections cannot be used
+    across a fork either.
+
+    The connections are SharedConnection, so they cannot be closed by the
+    callers. A connection taken from the pool must not be kept while more than
+    max_connections other sets are read from the same thread, as it could be
+    evicted and closed. Use connect_db(db_path, pooled=False) instead.
+    """
+
+    def __init__(self, max_connections: int = DEFAULT_POOL_CONNECTIONS):
+        """
+        :param max_connections: max number of connections of each thread.
+        :type max_connections: int, optional. Defaults to DEFAULT_POOL_CONNECTIONS.
+        """
+        if max_connections < 1:
+            raise ValueError(
+                f"The number of connections must be greater than 0: {max_connections}"
+            )
+        self.max_connections = max_connections
+        self._pid = os.getpid()
+        self._local = threading.local()
+
+    def get(self, db_path: Path) -> sqlite3.Connection:
+        """Returns the connection to db_path of the current thread, opening it
+        if required."""
+        connections = self._get_connections()
+        key = str(db_path)
+        pooled = connections.get(key, None)
+        if pooled is not None:
+            if pooled.file_state is None or pooled.file_state == _get_file_state(
+                db_path
+            ):
+                connections.move_to_end(key)
+                return pooled.conn
+            # The file has changed since the immutable connection was opened
+            del connections[key]
+            _close_connection(pooled.conn)
+        file_state = _get_file_state(db_path)
+        conn, immutable = _open_read_only_db(db_path, factory=SharedConnection)
+        connections[key] = _PooledConnection(conn, file_state if immutable else None)
+        while len(connections) > self.max_connections:
+            _, evicted = connections.popitem(last=False)
+            _close_connection(evicted.conn)
         return conn
+
+    def discard(self, db_path: Path) -> None:
+        """Closes and removes the connection to db_path of the current thread,
+        e.g. to see the changes of a set once Scipion has closed it."""
+        pooled = self._get_connections().pop(str(db_path), None)
+        if pooled is not None:
+            _close_connection(pooled.conn)
+
+    def close_all(self) -> None:
+        """Closes all the connections of the current thread."""
+        connections = self._get_connections()
+        for pooled in connections.values():
+            _close_connection(pooled.conn)
+        connections.clear()
+
+    def _get_connections(self) -> "_ThreadConnections":
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._local = threading.local()
+        if not hasattr(self._local, "connections"):
+            self._local.connections = _ThreadConnections()
+        return self._local.connections
+
+
+class _ThreadConnections(OrderedDict[str, _PooledConnection]):
+    """Connections of a thread, least recently used first. They are closed when
+    the thread ends, as its thread-local data is released."""
+
+    def __del__(self) -> None:
+        for pooled in self.values():
+            _close_connection(pooled.conn)
+
+
+# Process-wide pool used by connect_db
+CONNECTION_POOL = ConnectionPool()
+
+# Scope of the connections of the current thread, if any
+_active_scope = threading.local()
+
+
+class ConnectionScope:
+    """Connections of a computation advanced from several threads, one step at
+    a time, e.g. a generator iterated by AsyncRequest.iterate. While the scope
+    is active in a thread, connect_db returns the connections of the scope,
+    opened with connect_db(db_path, pooled=False) on first use, instead of the
+    ones of the thread in the pool, which other calls running in the thread
+    could use or evict meanwhile. The steps must not run concurrently, and the
+    connections are closed by close.
+    """
+
+    def __init__(self) -> None:
+        self._connections: Dict[str, sqlite3.Connection] = {}
+
+    def get(self, db_path: Path) -> sqlite3.Connection:
+        key = str(db_path)
+        conn = self._connections.get(key, None)
+        if conn is None:
+            conn, _ = _open_read_only_db(db_path, factory=SharedConnection)
+            self._connections[key] = conn
+        return conn
+
+    @contextmanager
+    def activate(self) -> Iterator["ConnectionScope"]:
+        """Makes connect_db use the connections of the scope in the current
+        thread until exited."""
+        previous = getattr(_active_scope, "scope", None)
+        _active_scope.scope = self
+        try:
+            yield self
+        finally:
+            _active_scope.scope = previous
+
+    def close(self) -> None:
+        for conn in self._connections.values():
+            _close_connection(conn)
+        self._connections.clear()
+
+
+def _get_file_state(db_path: Path) -> Tuple[int, int]:
+    st = os.stat(db_path)
+    return st.st_mtime_ns, st.st_size
+
+
+def open_read_only_db(db_path: Path) -> sqlite3.Connection:
+    """Opens a Scipion set in read-only mode, so no locks are taken on a database
+    that Scipion may still be writing. If the set is closed (the property
+    _streamState is STREAM_CLOSED), it is reopened as immutable, which avoids
+    any locking and change detection. The memory map and page cache sizes are
+    tuned for sequential reads of large tables.
+    """
+    return _open_read_only_db(db_path)[0]
+
+
+def _open_read_only_db(
+    db_path: Path, factory: type[sqlite3.Connection] = sqlite3.Connection
+) -> Tuple[sqlite3.Connection, bool]:
+    """See open_read_only_db. Also returns whether the connection is immutable.
+
+    :param factory: class of the connection returned.
+    """
+    db_uri = Path(db_path).expanduser().resolve().as_uri()
+    try:
+        with Stage(SQLITE_CONNECT):
+            conn = sqlite3.connect(
+                f"{db_uri}?mode=ro", uri=True, check_same_thread=False, factory=factory
+            )
+            immutable = _is_stream_closed(conn)
+            if immutable:
+                _close_connection(conn)
+                conn = sqlite3.connect(
+                    f"{db_uri}?mode=ro&immutable=1",
+                    uri=True,
+                    check_same_thread=False,
+                    factory=factory,
+                )
+            conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+            conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE}")
+            conn.row_factory = sqlite3.Row  # optional, handy if you want dict-like rows
+        return conn, immutable
     except sqlite3.Error as e:
         if "conn" in locals():
-            conn.close()
-        raise Exception(f"SQLite error: {e}")
+            _close_connection(conn)
+        raise Exception(f"SQLite error opening {db_path}: {e}")
+
+
+def _is_stream_closed(conn: sqlite3.Connection) -> bool:
+    try:
+        cur = conn.execute(
+            f"SELECT {PROP_VALUE} FROM {PROPERTIES_TBL} WHERE {PROP_KEY} = ?",
+            (PROP_STREAM_STATE,),
+        )
+        row = cur.fetchone()
+    except sqlite3.OperationalError:  # No Properties table
+        return False
+    return row is not None and str(row[0]) == STREAM_CLOSED
+
+
+def connect_db(db_path: Path, pooled: bool = True) -> sqlite3.Connection | None:
+    """Returns a read-only connection to a Scipion set sqlite file.
+
+    :param db_path: path of the sqlite file.
+    :param pooled: if True, the connection is taken from (and kept in) the
+    process-wide pool, so it is reused by later calls from the same thread and
+    cannot be closed by the caller (see SharedConnection). If a ConnectionScope is active in the
+    thread, it is taken from the scope instead. If False, a new connection is
+    returned.
+    """
+    if pooled:
+        scope = getattr(_active_scope, "scope", None)
+        if scope is not None:
+            return scope.get(db_path)
+        return CONNECTION_POOL.get(db_path)
+    return open_read_only_db(db_path)
 
 
 def _map_master_table(
     conn: sqlite3.Connection, table_name: str, column_names: list[str]
 ) -> Dict[str, str]:
-    cur = conn.cursor()
     col0, col1 = column_names
     # Only take rows where both fields are not NULL (optional but common-sense)
-    cur.execute(f"""
+    rows = fetch_all(
+        conn.cursor(),
+        f"""
         SELECT {col0}, {col1}
         FROM {table_name}
         WHERE {col0} IS NOT NULL AND {col1} IS NOT NULL
-    """)
-    return {row[0]: row[1] for row in cur.fetchall()}
+    """,
+    )
+    return {row[0]: row[1] for row in rows}
 
 
 def map_classes_table(
@@ -59,11 +297,9 @@ def _get_values_from_table(
     """Get the tilt-series identifiers from a sqlite connection to a
     tilt-series movies sqlite file generated by Scipion."""
     try:
-        cur = conn.cursor()
-        cur.execute(f"SELECT {field_name} FROM {table_name}")
-        return [row[0] for row in cur.fetchall()]
+        rows = fetch_all(conn.cursor(), f"SELECT {field_name} FROM {table_name}")
+        return [row[0] for row in rows]
     except sqlite3.OperationalError as e:
-        conn.close()
         raise Exception(
             f"Error consulting the table {table_name}. The "
             f"introduced file may not be a SetOfTiltSeriesMovies "
@@ -80,8 +316,108 @@ def get_from_obj_tbl(
     )
 
 
+def get_distinct_from_obj_tbl(
+    conn: sqlite3.Connection, field_name: str, class_dict: dict
+) -> list[str]:
+    """Returns the distinct values of a field of the table Objects, sorted."""
+    col_name = class_dict[field_name]
+    rows = fetch_all(
+        conn.cursor(),
+        f'SELECT DISTINCT "{col_name}" FROM {OBJECTS_TBL} ORDER BY "{col_name}"',
+    )
+    return [row[0] for row in rows]
+
+
 def get_row_value(
     row: sqlite3.Row, mapped_class_dict: Dict[str, str], field: str
 ) -> Any:
+    """Value of a labelled field of a row, or None if the field is not mapped or
+    not present in the row. To read many rows, use a RowExtractor instead."""
     mapped_field = mapped_class_dict.get(field, None)
-    return row[mapped_field] if mapped_field in row.keys() else None
+    if mapped_field is None:
+        return None
+    try:
+        return row[mapped_field]
+    except IndexError:  # Column not selected
+        return None
+
+
+class RowExtractor:
+    """Positional access to the fields of the rows of a Scipion table, compiled
+    once per table from its Classes mapping (see map_classes_table) and the
+    labelled names of the fields to be read, e.g. TILT_SERIES_FIELDS.
+
+    The query built with sql_fields selects the fields in the order introduced,
+    the ones not present in the table as NULL, so the missing columns are resolved
+    once and each row, read as a plain tuple with get_tuple_cursor, holds the
+    value of each field at the same position.
+
+    :param mapped_class_dict: dict mapping the labelled names with the column
+    names, e.g. _tsId : c03.
+    :param fields: labelled names of the fields to be read.
+    """
+
+    def __init__(self, mapped_class_dict: Dict[str, str], fields: Sequence[str]):
+        self.fields = tuple(fields)
+        self.columns = tuple(mapped_class_dict.get(field, None) for field in fields)
+        self.sql_fields = ", ".join(
+            f'"{column}"' if column else "NULL" for column in self.columns
+        )
+        self._indices = {field: i for i, field in enumerate(self.fields)}
+
+    def index(self, field: str) -> int:
+        """Position of a field in the rows."""
+        return self._indices[field]
+
+    def getter(self, *fields: str) -> Callable[[Sequence[Any]], Any]:
+        """Returns a function that takes a row and returns the value of the field
+        introduced or, if several, a tuple with their values."""
+        return operator.itemgetter(*(self._indices[field] for field in fields))
+
+    def column(self, rows: Sequence[Sequence[Any]], field: str) -> List[Any]:
+        """Values of a field in the introduced rows."""
+        i = self._indices[field]
+        return [row[i] for row in rows]
+
+
+def get_tuple_cursor(conn: sqlite3.Connection) -> sqlite3.Cursor:
+    """Returns a cursor that returns the rows as plain tuples, whatever the
+    row_factory of the connection, which is much cheaper than sqlite3.Row."""
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return cursor
+
+
+def execute_query(
+    cursor: sqlite3.Cursor, query: str, params: Sequence[Any] = ()
+) -> sqlite3.Cursor:
+    """Executes a query, recording its time in the SQLITE_READ stage. The rows
+    are then read with fetch_in_chunks."""
+    with Stage(SQLITE_READ):
+        return cursor.execute(query, params)
+
+
+def fetch_all(
+    cursor: sqlite3.Cursor, query: str, params: Sequence[Any] = ()
+) -> List[Any]:
+    """Executes a query and returns all the resulting rows, recording the time
+    and the number of rows in the SQLITE_READ stage."""
+    with Stage(SQLITE_READ) as stage:
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        stage.items = len(rows)
+    return rows
+
+
+def fetch_in_chunks(
+    cursor: sqlite3.Cursor, chunk_size: int = FETCH_CHUNK_SIZE
+) -> Iterator[List[Any]]:
+    """Yields the rows resulting from the last query executed by the cursor in
+    lists of at most chunk_size rows."""
+    while True:
+        with Stage(SQLITE_READ) as stage:
+            rows = cursor.fetchmany(chunk_size)
+            stage.items = len(rows)
+        if not rows:
+            return
+        yield rows
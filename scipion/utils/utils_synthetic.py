@@ -0,0 +1,468 @@
+import os
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, NamedTuple, Sequence, Tuple
+
+import mrcfile
+import numpy as np
+
+from scipion.constants import (
+    RUNS_DIR,
+    CLASSES_TBL,
+    OBJECTS_TBL,
+    PROPERTIES_TBL,
+    PROP_SELF,
+    PROP_STREAM_STATE,
+    STREAM_CLOSED,
+    SET_OF_TILT_SERIES,
+    SET_OF_CTF_TOMO_SERIES,
+    SET_OF_TOMOGRAMS,
+    SET_OF_COORDINATES_3D,
+    SET_OF_SUBTOMOGRAMS,
+    TS_ID,
+    FILE_NAME,
+    INDEX,
+    ACQUISITION_ORDER,
+    TILT_ANGLE,
+    ACCUMULATED_DOSE,
+    TRANSFORMATION_MATRIX,
+    ODD_EVEN_FN,
+    CTF_CORRECTED,
+    SET_SIZE,
+    DEFOCUS_U,
+    DEFOCUS_V,
+    DEFOCUS_ANGLE,
+    PHASE_SHIFT,
+    ODD_EVEN_TOMOS_FN,
+    COORD_X,
+    COORD_Y,
+    COORD_Z,
+    TOMO_ID,
+    EULER_MATRIX,
+    SUBTOMO_X,
+    SUBTOMO_Y,
+    SUBTOMO_Z,
+    SUBTOMO_COORD_MATRIX,
+    SUBTOMO_TRANSFORM_MATRIX,
+    SUBTOMO_ID,
+)
+
+# Label, Scipion class and sqlite type of each column of an Objects table
+Column = Tuple[str, str, str]
+
+# Run directory and sqlite file of each set written, as in a real project
+SYNTHETIC_SETS: Dict[str, Tuple[str, str]] = {
+    SET_OF_TILT_SERIES: ("000002_ProtImportTs", "tiltseries.sqlite"),
+    SET_OF_CTF_TOMO_SERIES: ("000003_ProtImportTsCTF", "ctftomoseries.sqlite"),
+    SET_OF_TOMOGRAMS: ("000004_ProtImportTomograms", "tomograms.sqlite"),
+    SET_OF_COORDINATES_3D: (
+        "000005_ProtImportCoordinates3DFromStar",
+        "coordinates3d.sqlite",
+    ),
+    SET_OF_SUBTOMOGRAMS: ("000006_ProtExtractSubtomos", "subtomograms.sqlite"),
+}
+
+TILT_SERIES_COLUMNS: List[Column] = [
+    (TS_ID, "String", "TEXT"),
+    (CTF_CORRECTED, "Boolean", "INTEGER"),
+    (SET_SIZE, "Integer", "INTEGER"),
+]
+TILT_IMAGE_COLUMNS: List[Column] = [
+    (TS_ID, "String", "TEXT"),
+    (FILE_NAME, "String", "TEXT"),
+    (INDEX, "Integer", "INTEGER"),
+    (ACQUISITION_ORDER, "Integer", "INTEGER"),
+    (TILT_ANGLE, "Float", "REAL"),
+    (ACCUMULATED_DOSE, "Float", "REAL"),
+    (TRANSFORMATION_MATRIX, "Matrix", "TEXT"),
+    (ODD_EVEN_FN, "CsvList", "TEXT"),
+]
+CTF_TOMO_SERIES_COLUMNS: List[Column] = [(TS_ID, "String", "TEXT")]
+CTF_TOMO_COLUMNS: List[Column] = [
+    (DEFOCUS_U, "Float", "REAL"),
+    (DEFOCUS_V, "Float", "REAL"),
+    (DEFOCUS_ANGLE, "Float", "REAL"),
+    (PHASE_SHIFT, "Float", "REAL"),
+    (ACQUISITION_ORDER, "Integer", "INTEGER"),
+]
+TOMOGRAM_COLUMNS: List[Column] = [
+    (TS_ID, "String", "TEXT"),
+    (FILE_NAME, "String", "TEXT"),
+    (CTF_CORRECTED, "Boolean", "INTEGER"),
+    (ODD_EVEN_TOMOS_FN, "CsvList", "TEXT"),
+]
+COORD_3D_COLUMNS: List[Column] = [
+    (COORD_X, "Float", "REAL"),
+    (COORD_Y, "Float", "REAL"),
+    (COORD_Z, "Float", "REAL"),
+    (TOMO_ID, "String", "TEXT"),
+    (EULER_MATRIX, "Matrix", "TEXT"),
+    ("_score", "Float", "REAL"),
+]
+SUBTOMO_COLUMNS: List[Column] = [
+    (FILE_NAME, "String", "TEXT"),
+    (SUBTOMO_X, "Float", "REAL"),
+    (SUBTOMO_Y, "Float", "REAL"),
+    (SUBTOMO_Z, "Float", "REAL"),
+    (SUBTOMO_COORD_MATRIX, "Matrix", "TEXT"),
+    (SUBTOMO_TRANSFORM_MATRIX, "Matrix", "TEXT"),
+    (SUBTOMO_ID, "String", "TEXT"),
+]
+
+
+class SyntheticProject(NamedTuple):
+    """Size and content of a synthetic Scipion project, see
+    write_synthetic_project.
+
+    :param n_tilt_series: number of tilt-series, and of CTFTomoSeries.
+    :param n_tilt_images: number of tilt-images of each tilt-series, acquired
+    with a dose-symmetric scheme.
+    :param n_tomograms: number of tomograms, one per tilt-series (from the
+    first). None for one per tilt-series.
+    :param n_particles: number of coordinates and of subtomograms per tomogram.
+    :param tilt_step: degrees between two consecutive tilt-images.
+    :param dose_per_tilt: dose of each tilt-image, in e/A^2.
+    :param ts_size: size of the tilt-images (x, y), in pixels.
+    :param tomo_size: size of the tomograms (x, y, z), in pixels.
+    :param box_size: size of the subtomograms, in pixels.
+    :param sampling_rate: sampling rate of all the sets, in A/pixel.
+    :param seed: seed of the random values, so the projects are reproducible.
+    """
+
+    n_tilt_series: int = 10
+    n_tilt_images: int = 41
+    n_tomograms: int | None = None
+    n_particles: int = 100
+    tilt_step: float = 3.0
+    dose_per_tilt: float = 3.0
+    ts_size: Tuple[int, int] = (4096, 4096)
+    tomo_size: Tuple[int, int, int] = (1024, 1024, 256)
+    box_size: int = 32
+    sampling_rate: float = 1.35
+    seed: int = 0
+
+    @property
+    def ts_ids(self) -> List[str]:
+        return [f"TS_{i + 1:03d}" for i in range(self.n_tilt_series)]
+
+    @property
+    def tomo_ids(self) -> List[str]:
+        n_tomograms = (
+            self.n_tilt_series if self.n_tomograms is None else self.n_tomograms
+        )
+        if n_tomograms > self.n_tilt_series:
+            raise ValueError(
+                f"There cannot be more tomograms ({n_tomograms}) than tilt-series "
+                f"({self.n_tilt_series})"
+            )
+        return self.ts_ids[:n_tomograms]
+
+
+def write_synthetic_project(
+    project_path: os.PathLike | str, params: SyntheticProject = SyntheticProject()
+) -> Dict[str, Path]:
+    """Writes a synthetic Scipion project with a set of each supported class
+    (tilt-series, CTF, tomograms, coordinates and subtomograms), laid out as a
+    real one: ProjectName/Runs/ProtocolDir/set.sqlite, with the Classes, Objects
+    and Properties master tables and the per-item tables (<tsId>_Objects,
+    id<N>_Objects...). The images referenced are header-only MRC files, so a
+    large project takes little disk space but the converters read their
+    headers as they would do with a real one. Useful to test and benchmark
+    the converters without a real project.
+
+    :param project_path: directory of the project. It is created if needed and
+    the existing sets are overwritten.
+    :param params: size and content of the project.
+    :return: dictionary of type key: Scipion set class, value: sqlite file.
+    """
+    project_path = Path(project_path).expanduser()
+    rng = np.random.default_rng(params.seed)
+    db_paths = {}
+    for set_class, writer in (
+        (SET_OF_TILT_SERIES, _write_tilt_series_set),
+        (SET_OF_CTF_TOMO_SERIES, _write_ctf_set),
+        (SET_OF_TOMOGRAMS, _write_tomograms_set),
+        (SET_OF_COORDINATES_3D, _write_coordinates_set),
+        (SET_OF_SUBTOMOGRAMS, _write_subtomograms_set),
+    ):
+        run_name, db_name = SYNTHETIC_SETS[set_class]
+        run_path = project_path / RUNS_DIR / run_name
+        (run_path / "extra").mkdir(parents=True, exist_ok=True)
+        db_path = run_path / db_name
+        if db_path.exists():
+            db_path.unlink()
+        with closing(sqlite3.connect(db_path)) as conn:
+            with conn:  # Single transaction
+                n_items = writer(conn, project_path, run_path, params, rng)
+                _write_properties_table(
+                    conn,
+                    {
+                        PROP_SELF: set_class,
+                        "_size": str(n_items),
+                        PROP_STREAM_STATE: STREAM_CLOSED,
+                        "_mapperPath": f"{db_path.relative_to(project_path)}, ",
+                        "_samplingRate": str(params.sampling_rate),
+                    },
+                )
+        db_paths[set_class] = db_path
+    return db_paths
+
+
+def write_mrc_header(mrc_file: Path, size: Sequence[int], voxel_size: float) -> None:
+    """Writes a header-only MRC file (float32 data) of size (x, y, z)."""
+    nx, ny, nz = size
+    header = np.zeros((), dtype=mrcfile.dtypes.HEADER_DTYPE)
+    header["nx"], header["ny"], header["nz"] = nx, ny, nz
+    header["mode"] = 2
+    header["mx"], header["my"], header["mz"] = nx, ny, nz
+    header["cella"] = (nx * voxel_size, ny * voxel_size, nz * voxel_size)
+    header["cellb"] = (90.0, 90.0, 90.0)
+    header["mapc"], header["mapr"], header["maps"] = 1, 2, 3
+    header["ispg"] = 1 if nz > 1 else 0
+    header["map"] = mrcfile.constants.MAP_ID
+    header["machst"] = mrcfile.utils.machine_stamp_from_byte_order(
+        header["mode"].dtype.byteorder
+    )
+    header["nversion"] = 20141
+    with open(mrc_file, "wb") as f:
+        f.write(header.tobytes())
+
+
+def _write_tilt_series_set(
+    conn: sqlite3.Connection,
+    project_path: Path,
+    run_path: Path,
+    params: SyntheticProject,
+    rng: np.random.Generator,
+) -> int:
+    n_images = params.n_tilt_images
+    tilt_angles = (np.arange(n_images) - (n_images - 1) / 2) * params.tilt_step
+    acq_orders = _get_dose_symmetric_order(tilt_angles)
+    accum_doses = acq_orders * params.dose_per_tilt
+    _write_objects_tables(
+        conn,
+        "",
+        "TiltSeries",
+        TILT_SERIES_COLUMNS,
+        ((ts_id, 0, n_images) for ts_id in params.ts_ids),
+    )
+    for ts_id in params.ts_ids:
+        ts_file = run_path / "extra" / f"{ts_id}.mrcs"
+        write_mrc_header(ts_file, (*params.ts_size, n_images), params.sampling_rate)
+        ts_fn = str(ts_file.relative_to(project_path))
+        odd_even_fn = f"{ts_fn[:-5]}_odd.mrcs,{ts_fn[:-5]}_even.mrcs"
+        rotations = np.deg2rad(rng.normal(85.0, 0.5, n_images))
+        shifts = rng.normal(0.0, 20.0, (n_images, 2))
+        rows = (
+            (
+                ts_id,
+                ts_fn,
+                i + 1,
+                int(acq_orders[i]),
+                float(tilt_angles[i]),
+                float(accum_doses[i]),
+                _format_matrix(_get_2d_transform(rotations[i], shifts[i])),
+                odd_even_fn,
+            )
+            for i in range(n_images)
+        )
+        _write_objects_tables(conn, f"{ts_id}_", "TiltImage", TILT_IMAGE_COLUMNS, rows)
+    return params.n_tilt_series
+
+
+def _write_ctf_set(
+    conn: sqlite3.Connection,
+    project_path: Path,
+    run_path: Path,
+    params: SyntheticProject,
+    rng: np.random.Generator,
+) -> int:
+    n_images = params.n_tilt_images
+    tilt_angles = (np.arange(n_images) - (n_images - 1) / 2) * params.tilt_step
+    acq_orders = _get_dose_symmetric_order(tilt_angles)
+    _write_objects_tables(
+        conn,
+        "",
+        "CTFTomoSeries",
+        CTF_TOMO_SERIES_COLUMNS,
+        ((ts_id,) for ts_id in params.ts_ids),
+    )
+    for obj_id in range(1, params.n_tilt_series + 1):
+        defocus_u = rng.uniform(20000.0, 40000.0) + rng.normal(0.0, 300.0, n_images)
+        defocus_v = defocus_u - rng.uniform(100.0, 1000.0, n_images)
+        defocus_angle = rng.uniform(-90.0, 90.0, n_images)
+        rows = zip(
+            defocus_u.tolist(),
+            defocus_v.tolist(),
+            defocus_angle.tolist(),
+            [0.0] * n_images,
+            acq_orders.tolist(),
+        )
+        # The tables of each CTFTomoSeries are named after its row id
+        _write_objects_tables(conn, f"id{obj_id}_", "CTFTomo", CTF_TOMO_COLUMNS, rows)
+    return params.n_tilt_series
+
+
+def _write_tomograms_set(
+    conn: sqlite3.Connection,
+    project_path: Path,
+    run_path: Path,
+    params: SyntheticProject,
+    rng: np.random.Generator,
+) -> int:
+    rows = []
+    for tomo_id in params.tomo_ids:
+        tomo_file = run_path / "extra" / f"{tomo_id}.mrc"
+        write_mrc_header(tomo_file, params.tomo_size, params.sampling_rate)
+        tomo_fn = str(tomo_file.relative_to(project_path))
+        half_maps = f"{tomo_fn[:-4]}_odd.mrc,{tomo_fn[:-4]}_even.mrc"
+        rows.append((tomo_id, tomo_fn, 0, half_maps))
+    _write_objects_tables(conn, "", "Tomogram", TOMOGRAM_COLUMNS, rows)
+    return len(rows)
+
+
+def _write_coordinates_set(
+    conn: sqlite3.Connection,
+    project_path: Path,
+    run_path: Path,
+    params: SyntheticProject,
+    rng: np.random.Generator,
+) -> int:
+    rows: List[Tuple[Any, ...]] = []
+    for tomo_id in params.tomo_ids:
+        positions = _get_random_positions(params, rng)
+        matrices = _get_random_3d_transforms(params.n_particles, rng, max_shift=0.0)
+        scores = rng.uniform(0.0, 1.0, params.n_particles)
+        for position, matrix, score in zip(positions, matrices, scores.tolist()):
+            rows.append((*position, tomo_id, _format_matrix(matrix), score))
+    _write_objects_tables(conn, "", "Coordinate3D", COORD_3D_COLUMNS, rows)
+    return len(rows)
+
+
+def _write_subtomograms_set(
+    conn: sqlite3.Connection,
+    project_path: Path,
+    run_path: Path,
+    params: SyntheticProject,
+    rng: np.random.Generator,
+) -> int:
+    box_size = (params.box_size,) * 3
+    rows: List[Tuple[Any, ...]] = []
+    for tomo_id in params.tomo_ids:
+        positions = _get_random_positions(params, rng)
+        coord_matrices = _get_random_3d_transforms(
+            params.n_particles, rng, max_shift=0.0
+        )
+        matrices = _get_random_3d_transforms(params.n_particles, rng, max_shift=3.0)
+        for i, (position, coord_matrix, matrix) in enumerate(
+            zip(positions, coord_matrices, matrices)
+        ):
+            subtomo_file = run_path / "extra" / f"{tomo_id}_{i + 1:06d}.mrc"
+            write_mrc_header(subtomo_file, box_size, params.sampling_rate)
+            rows.append(
+                (
+                    str(subtomo_file.relative_to(project_path)),
+                    *position,
+                    _format_matrix(coord_matrix),
+                    _format_matrix(matrix),
+                    tomo_id,
+                )
+            )
+    _write_objects_tables(conn, "", "SubTomogram", SUBTOMO_COLUMNS, rows)
+    return len(rows)
+
+
+def _write_objects_tables(
+    conn: sqlite3.Connection,
+    prefix: str,
+    item_class: str,
+    columns: Sequence[Column],
+    rows: Iterable[Sequence[Any]],
+) -> None:
+    """Writes the tables Classes and Objects of a set (or of an item of a set,
+    with a prefix such as TS_001_), with the same schema as Scipion."""
+    classes_tbl, objects_tbl = f"{prefix}{CLASSES_TBL}", f"{prefix}{OBJECTS_TBL}"
+    conn.execute(
+        f'CREATE TABLE "{classes_tbl}" (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+        f"label_property TEXT UNIQUE, column_name TEXT UNIQUE, "
+        f"class_name TEXT DEFAULT NULL)"
+    )
+    column_names = [f"c{i + 1:02d}" for i in range(len(columns))]
+    conn.executemany(
+        f'INSERT INTO "{classes_tbl}" (label_property, column_name, class_name) '
+        f"VALUES (?, ?, ?)",
+        [(PROP_SELF, "c00", item_class)]
+        + [
+            (label, column_name, class_name)
+            for (label, class_name, _), column_name in zip(columns, column_names)
+        ],
+    )
+    column_defs = "".join(
+        f", {column_name} {sql_type} DEFAULT NULL"
+        for (_, _, sql_type), column_name in zip(columns, column_names)
+    )
+    conn.execute(
+        f'CREATE TABLE "{objects_tbl}" (id INTEGER PRIMARY KEY, '
+        f"enabled INTEGER DEFAULT 1, label TEXT DEFAULT NULL, "
+        f"comment TEXT DEFAULT NULL, creation DATE{column_defs})"
+    )
+    placeholders = ", ".join("?" * len(columns))
+    conn.executemany(
+        f'INSERT INTO "{objects_tbl}" (creation, {", ".join(column_names)}) '
+        f"VALUES (datetime('now'), {placeholders})",
+        rows,
+    )
+
+
+def _write_properties_table(conn: sqlite3.Connection, properties: Dict[str, str]):
+    conn.execute(
+        f"CREATE TABLE {PROPERTIES_TBL} (key TEXT UNIQUE, value TEXT DEFAULT NULL)"
+    )
+    conn.executemany(
+        f"INSERT INTO {PROPERTIES_TBL} (key, value) VALUES (?, ?)", properties.items()
+    )
+
+
+def _get_dose_symmetric_order(tilt_angles: np.ndarray) -> np.ndarray:
+    """Acquisition order of the tilt-images of a dose-symmetric scheme: from
+    the lowest absolute tilt angle, alternating the positive and negative ones."""
+    order = np.lexsort((tilt_angles < 0, np.abs(tilt_angles)))
+    acq_orders = np.empty(len(tilt_angles), dtype=np.int64)
+    acq_orders[order] = np.arange(len(tilt_angles))
+    return acq_orders
+
+
+def _get_2d_transform(rotation: float, shift: np.ndarray) -> np.ndarray:
+    cos, sin = np.cos(rotation), np.sin(rotation)
+    return np.array([[cos, -sin, shift[0]], [sin, cos, shift[1]], [0.0, 0.0, 1.0]])
+
+
+def _get_random_positions(
+    params: SyntheticProject, rng: np.random.Generator
+) -> List[List[float]]:
+    """Random particle positions, centered in the tomogram as in Scipion."""
+    half_size = np.array(params.tomo_size) / 2
+    positions = rng.uniform(-half_size, half_size, (params.n_particles, 3))
+    return np.round(positions, 2).tolist()
+
+
+def _get_random_3d_transforms(
+    n_matrices: int, rng: np.random.Generator, max_shift: float
+) -> np.ndarray:
+    """Random 4x4 transformation matrices (uniform rotations, and shifts of up
+    to max_shift pixels)."""
+    # Orthonormalize random matrices with QR, fixing the signs to get rotations
+    q, r = np.linalg.qr(rng.normal(size=(n_matrices, 3, 3)))
+    q *= np.sign(np.diagonal(r, axis1=1, axis2=2))[:, np.newaxis, :]
+    q[np.linalg.det(q) < 0, :, 0] *= -1
+    matrices = np.zeros((n_matrices, 4, 4))
+    matrices[:, :3, :3] = q
+    matrices[:, :3, 3] = rng.uniform(-max_shift, max_shift, (n_matrices, 3))
+    matrices[:, 3, 3] = 1.0
+    return matrices
+
+
+def _format_matrix(matrix: np.ndarray) -> str:
+    """Matrix as stored by Scipion, e.g. [[1.0, 0.0], [0.0, 1.0]]."""
+    return str(matrix.tolist())
@@ -0,0 +1,203 @@
+import itertools
+from typing import Any, Callable, Dict, Hashable, Iterator, List, TextIO, Tuple
+
+from yaml.representer import SafeRepresenter
+from yaml.resolver import Resolver
+from yaml.serializer import Serializer
+
+try:
+    # libyaml-based emitter, if PyYAML was built with it
+    from yaml.cyaml import CEmitter as _Emitter
+except ImportError:
+    from yaml.emitter import Emitter as _Emitter
+
+# Fields shared by the coordinate transformations of the same kind, written once
+# per file in the compact YAML files and included with a merge key
+TRANSFORM_TEMPLATE_KEYS = ("name", "input", "output", "type")
+
+_MERGE_TAG = "tag:yaml.org,2002:merge"
+_SEQ_TAG = "tag:yaml.org,2002:seq"
+
+
+class _MergeKey:
+    """Key << of a YAML merge: the mapping of its value is included into the
+    mapping containing it."""
+
+
+MERGE_KEY = _MergeKey()
+
+
+class _FlowList(list):
+    """List of scalars, e.g. a vector or a matrix row, written in flow style:
+    [x, y, z]."""
+
+
+class CompactYamlDumper(_Emitter, Serializer, SafeRepresenter, Resolver):
+    """Dumper of the data prepared by compact_yaml_data. The objects found more
+    than once are written the first time with an anchor and then referenced with
+    aliases, the merge keys are written as such and the lists of scalars in flow
+    style.
+
+    As in yaml.CDumper, the text is written by libyaml if available, but the
+    events are generated by the Python serializer, so the anchor names are taken
+    from anchor_ids and can be kept unique across several dumps into the same
+    document (see ParticleSetYamlWriter).
+    """
+
+    open = Serializer.open
+    close = Serializer.close
+    serialize = Serializer.serialize
+
+    def __init__(
+        self,
+        stream: TextIO,
+        default_style: str | None = None,
+        default_flow_style: bool | None = False,
+        canonical: bool | None = None,
+        indent: int | None = None,
+        width: int | None = None,
+        allow_unicode: bool | None = None,
+        line_break: str | None = None,
+        encoding: str | None = None,
+        explicit_start: bool | None = None,
+        explicit_end: bool | None = None,
+        version: Tuple[int, int] | None = None,
+        tags: Dict[str, str] | None = None,
+        sort_keys: bool = True,
+        anchor_ids: Iterator[int] | None = None,
+    ):
+        _Emitter.__init__(
+            self,
+            stream,
+            canonical=canonical,
+            indent=indent,
+            width=width,
+            allow_unicode=allow_unicode,
+            line_break=line_break,
+        )
+        Serializer.__init__(
+            self,
+            encoding=encoding,
+            explicit_start=explicit_start,
+            explicit_end=explicit_end,
+            version=version,
+            tags=tags,
+        )
+        SafeRepresenter.__init__(
+            self,
+            default_style=default_style,
+            default_flow_style=default_flow_style,
+            sort_keys=sort_keys,
+        )
+        Resolver.__init__(self)
+        self.anchor_ids = itertools.count(1) if anchor_ids is None else anchor_ids
+
+    def generate_anchor(self, node: Any) -> str:
+        return "id%03d" % next(self.anchor_ids)
+
+    def ignore_aliases(self, data: Any) -> bool:
+        return isinstance(data, _MergeKey) or super().ignore_aliases(data)
+
+
+CompactYamlDumper.add_representer(
+    _MergeKey, lambda dumper, data: dumper.represent_scalar(_MERGE_TAG, "<<")
+)
+CompactYamlDumper.add_representer(
+    _FlowList,
+    lambda dumper, data: dumper.represent_sequence(_SEQ_TAG, data, flow_style=True),
+)
+
+
+def compact_yaml_data(data: Any) -> Any:
+    """Prepares data, e.g. the result of model_dump(mode="json"), to be written
+    with CompactYamlDumper:
+
+    - The equal mappings and lists become the same object, so they are written
+      once, e.g. the coordinate systems of the tilt-images or the identity
+      matrices.
+    - The coordinate transformations (mappings with TRANSFORM_TEMPLATE_KEYS and
+      some other field) include their name, input, output and type with a merge
+      key, so these are written once per kind of transformation.
+    - The lists of scalars are written in flow style.
+
+    Any YAML loader, e.g. yaml.safe_load, expands the aliases and merge keys
+    back into the original data.
+    """
+    # Key of each unique mapping or list -> (shared object, id). The keys refer to
+    # the nested mappings and lists by their id, so they are hashed in constant time
+    memo: Dict[Hashable, Tuple[Any, int]] = {}
+
+    def intern(key: Hashable, make: Callable[[], Any]) -> Tuple[Any, Hashable]:
+        found = memo.get(key)
+        if found is None:
+            found = memo[key] = (make(), len(memo))
+        return found
+
+    def key(scalar: Any) -> Hashable:
+        # 0.0 == -0.0, but they are different values
+        if scalar.__class__ is float and not scalar:
+            return float, repr(scalar)
+        return scalar.__class__, scalar
+
+    def compact(value: Any) -> Tuple[Any, Hashable]:
+        """Returns the shared object equal to value and its key: the id of the
+        object for the mappings and lists."""
+        if isinstance(value, dict):
+            entries: List[Tuple[Any, Any, Hashable]] = [
+                (k, *compact(v)) if isinstance(v, (dict, list)) else (k, v, key(v))
+                for k, v in value.items()
+            ]
+            if len(value) > len(TRANSFORM_TEMPLATE_KEYS) and all(
+                k in value for k in TRANSFORM_TEMPLATE_KEYS
+            ):
+                template_items = [e for e in entries if e[0] in TRANSFORM_TEMPLATE_KEYS]
+                template = intern(
+                    ("d", *((k, v_key) for k, _, v_key in template_items)),
+                    lambda: {k: v for k, v, _ in template_items},
+                )
+                entries = [(MERGE_KEY, *template)] + [
+                    e for e in entries if e[0] not in TRANSFORM_TEMPLATE_KEYS
+                ]
+            return intern(
+                ("d", *((k, v_key) for k, _, v_key in entries)),
+                lambda: {k: v for k, v, _ in entries},
+            )
+        if isinstance(value, list):
+            if any(isinstance(v, (dict, list)) for v in value):
+                elements = [compact(v) for v in value]
+                return intern(
+                    ("l", *(v_key for _, v_key in elements)),
+                    lambda: [v for v, _ in elements],
+                )
+            # Much faster than a key per scalar. The repr also tells apart 0.0
+            # from -0.0 and 1 from 1.0 or True
+            return intern(("s", repr(value)), lambda: _FlowList(value))
+        return value, key(value)
+
+    return compact(data)[0]
+
+
+def dump_compact_yaml(
+    data: Any,
+    stream: TextIO,
+    explicit_start: bool = False,
+    anchor_ids: Iterator[int] | None = None,
+) -> None:
+    """Writes data to stream in compact YAML (see compact_yaml_data). The keys
+    keep their order.
+
+    :param data: data to be written, e.g. the result of model_dump(mode="json").
+    :param stream: text file.
+    :param explicit_start: if True, the document starts with ---.
+    :param anchor_ids: numbers of the anchors. The same iterator must be used
+    for the several dumps of the same document. By default, they start at 1.
+    """
+    dumper = CompactYamlDumper(
+        stream, sort_keys=False, explicit_start=explicit_start, anchor_ids=anchor_ids
+    )
+    try:
+        dumper.open()
+        dumper.represent(compact_yaml_data(data))
+        dumper.close()
+    finally:
+        dumper.dispose()